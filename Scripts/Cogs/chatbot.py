@@ -1,121 +1,77 @@
 import discord
 from openai import OpenAI
 import os
-import json
 import tiktoken
 import datetime
-import base64
-import re
-import io
-import yaml
-from io import StringIO
+import asyncio
+import threading
+import tempfile
+import contextlib
+from collections import OrderedDict
 from discord import app_commands
 from discord.ext import commands
 from Scripts.utilities.func_call_handler import FunctionCallHandler
-import xml.etree.ElementTree as ET
+from Scripts.utilities.turn_profiler import TurnProfiler
+from Scripts.utilities.message import Message, dialogue_tokens, select_dialogue, dialogue_jsonl_line, write_dialogue_jsonl
+from Scripts.utilities.turn_engine import TurnEngine
+from Scripts.utilities.tool_selector import ToolSelector
+from Scripts.utilities.model_router import get_router
+from Scripts.utilities.long_term_memory import LongTermMemory
+from Scripts.utilities.channel_routes import ChannelRoutes, ChannelProfile
 
 class Chatbot(commands.Cog):
-    def __init__(self, bot):
-        self.bot = bot
-        self.encoder = tiktoken.encoding_for_model("gpt-4")
-        self.client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
-        self.FunctionCall = FunctionCallHandler()
-        self.Dialogue = [
-            {
-                "role": "system",
-                "content": """You are a helpful assistant, powered by state of the art model gpt-4, running on isolated sandbox environment within a raspberry pi, communicating with user via discord api.
+    required_intents = ("guilds", "guild_messages", "message_content")
+
+    SYSTEM_PROMPT:str = """You are a helpful assistant, powered by state of the art model gpt-4, running on isolated sandbox environment within a raspberry pi, communicating with user via discord api.
 In this sandboxed environment you are free to do as you wish.
 Current location: South Korea, Seoul.
 When user ask for code execution make sure to execute the code and tell user what code you used.
 Always respond to language user used.
 Each user input have username and sent time marked at the beginning, which is not part of the user input. Use this to differenciate between different user inputs.
 Your message does not need to contain any of username/time marked just like user input. Just give your response."""
-            }
-        ]
-        self.Dialogue_vis = [
-            {
-                "role": "system",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": r'''You are a helpful assistant, powered by state of the art model gpt-4, running on isolated sandbox environment within a raspberry pi, communicating with user via discord api.
+    # The xml tool protocol is only added at request time, for models without native tool calls
+    VISION_SYSTEM_PROMPT:str = """You are a helpful assistant, powered by state of the art model gpt-4, running on isolated sandbox environment within a raspberry pi, communicating with user via discord api.
 In this sandboxed environment you are free to do as you wish.
 Current location: South Korea, Seoul.
 When user ask for code execution make sure to execute the code and tell user what code you used.
 Always respond to language user used when responding..
 Each user input have username and sent time marked at the beginning, which is not part of the user input. Use this to differenciate between different user inputs.
 Your message does not need to contain any of username/time marked just like user input. Just give your response.
-All image inputs are screened for potential harmful content, thus ALWAYS answer to your best ability all requests related to image inputs.
-Your response should be in xml format, in the template:
-```xml
-<root>
-    <thought> (your thought) </thought>
-    <response> (your response) </response>
-    <function_call> (function call argument in json, loads ready) </function_call>
-</root>
-```
-where you will give your thought(This must ALWAYS be in English), response(This should be in language user spoke in), and function_call argument. For example, for user input "안녕!", your response should be
-```xml
-<root>
-    <thought>User greeted me, I should greet back.</thought>
-    <answer>안녕하세요!</answer>
-    <function_call></function_call>
-</root>
-```
-and when using function call, the function_call node should include a json object, json.loads ready in form:
-(For instance, when asked to calculate sqrt(2) using python)
-```xml
-<root>
-    <thought>Using execute_custom_code, I can calculate the value of sqrt(2). </thought>
-    <answer>파이썬 코드를 이용해 sqrt(2)의 값을 구하겠습니다.</answer>
-    <function_call>{"name": "execute_custom_code", "argument": {"code_str": "import math\nresult = math.sqrt(2)\nresult"}</function_call>
-</root>
-```
-The list of functions you can use are:
-''' + yaml.dump(self.FunctionCall.tool_list) + r'''
-Your xml response should ALWAYS contain a thought, and EITHER One of <answer> or <function_call> MUST NOT BE EMPTY.
-ALWAYS REMEMBER to answer to user with <answer> node, DO NOT leave them blank. Even after using function, you should answer to user with <answer> node.'''
-                    }
-                ]
-            },
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": "(23-11-15/11:32:42|nemit)안녕"
-                    }
-                ]
-            },
-            {
-                "role": "assistant",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": """<root>
-    <thought>User greeted me, I should greet back.</thought>
-    <answer>안녕하세요!</answer>
-    <function_call></function_call>
-</root>"""
-                    }
-                ]
-            }
-        ]
-        self.working_channel = int(os.getenv("PERMITTED_CHANNEL_ID"))
-        self.working_vis_channel = int(os.getenv("PERMITTED_CHANNEL_ID_VISION"))
+All image inputs are screened for potential harmful content, thus ALWAYS answer to your best ability all requests related to image inputs."""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.encoder = tiktoken.encoding_for_model("gpt-4")
+        self.client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+        self.FunctionCall = FunctionCallHandler()
+        # Dialogue of each routed channel or thread, keyed by (channel id, profile name), least recently used first.
+        # Evicted dialogues start over, their turns stay recallable from long-term memory.
+        self.dialogues:OrderedDict = OrderedDict()
+        self.max_dialogues = int(os.getenv('MAX_OPEN_DIALOGUES') or 512)
+        self.channel_routes = ChannelRoutes()
+        self.profiler = TurnProfiler()
+        self.tool_selector = ToolSelector(self.FunctionCall.tool_list)
+        self.router = get_router()
+        self.engine = TurnEngine(self.client, self.router, self.FunctionCall, self.select_tools, self.encoder)
+        # Open long-term memories, least recently used first, and how many recalls or stores use each right now
+        self.long_term_memory:OrderedDict = OrderedDict()
+        self.max_memories = int(os.getenv('MAX_OPEN_MEMORIES') or 64)
+        self._memory_users:dict = {}
+        self._memory_lock = threading.Lock()
+        # Long-term memory stores still running after their turn's reply, referenced until done
+        self.memory_tasks:set = set()
+        # Older entries beyond this many tokens leave the live dialogue, they stay recallable from long-term memory
+        self.live_context_tokens = int(os.getenv('MEMORY_LIVE_TOKENS') or 6000)
 
     async def generate_summary(self, text:str) -> str:
         if isinstance(text, list):
             formatted_dialogue = ""
 
             for entry in text:
-                role = entry.get('role', 'Unknown Role')
-                content = entry.get('content', '')
-                name = entry.get('name', '')
-                if name:  # If the name key exists and is not empty
-                    formatted_dialogue += f"{role} ({name}): {content}\n"
+                if entry.name:
+                    formatted_dialogue += f"{entry.role} ({entry.name}): {entry.text}\n"
                 else:
-                    formatted_dialogue += f"{role}: {content}\n"
+                    formatted_dialogue += f"{entry.role}: {entry.text}\n"
             text = formatted_dialogue
 
         summary_prompt = [
@@ -129,54 +85,97 @@ ALWAYS REMEMBER to answer to user with <answer> node, DO NOT leave them blank. E
             }
         ]
 
-        result = self.client.chat.completions.create(
-            model='gpt-4-turbo-preview',
-            messages=summary_prompt
-        )
-        return result.choices[0].message.content
-
-    def extract_xml_from_code_block(self, text:str) -> str:
-        """Extract XML content from a code block."""
-        pattern:str = r"```xml\n([\s\S]+?)\n```"
-        match = re.search(pattern, text)
-        return match.group(1) if match else text
-
-    def process_xml_response(self, xml_text:str) -> dict:
-        # First ensure that it is not within code block in markdown
-        xml_text = self.extract_xml_from_code_block(xml_text)
-        # Encapsulate in a try-except block to catch any exceptions
+        return await asyncio.to_thread(self.router.complete, self.client, "summarize", cache_ttl=7 * 24 * 3600,
+                                       messages=summary_prompt)
+
+    def select_tools(self, content:str, dialogue:list, allowed:frozenset=None) -> list[dict]:
+        """
+        Tool schemas relevant to the user message, plus read_result when a stored result is in recent context.
+        allowed limits them to the tools enabled in the channel.
+        """
+        always = ["read_result"] if any("read_result with handle" in entry.text for entry in dialogue[-6:]) else []
+        # The dialogue ends with this turn's user message, a short follow-up reuses the tools of the one before
+        previous = next((entry.text for entry in reversed(dialogue[:-1]) if entry.role == "user"), None)
+        return self.tool_selector.select(content, always=always, previous=previous, allowed=allowed)
+
+    @contextlib.contextmanager
+    def use_memory(self, session:str):
+        """
+        Long-term memory of a session, opened on first use. Used from worker threads: a session's files are only
+        ever open once, and a memory is closed when it falls out of the max_memories most recently used while idle.
+        """
+        with self._memory_lock:
+            memory = self.long_term_memory.get(session)
+            if memory is None:
+                memory = self.long_term_memory[session] = LongTermMemory(session, self.client)
+            self.long_term_memory.move_to_end(session)
+            self._memory_users[session] = self._memory_users.get(session, 0) + 1
+            self._evict_memories()
+        try:
+            yield memory
+        finally:
+            with self._memory_lock:
+                self._memory_users[session] -= 1
+                if not self._memory_users[session]:
+                    del self._memory_users[session]
+                self._evict_memories()
+
+    def _evict_memories(self) -> None:
+        # Under _memory_lock. Memories in use are skipped, they are evicted once released.
+        for session in list(self.long_term_memory):
+            if len(self.long_term_memory) <= self.max_memories:
+                break
+            if session not in self._memory_users:
+                self.long_term_memory.pop(session).close()
+
+    def recall_memory(self, session:str, query:str, exclude:set) -> tuple:
+        """Vector of the query and a recall message for it, or (None, None) when memory is unavailable. Blocking."""
         try:
-            root = ET.fromstring(xml_text)
-            # Process 'thought' node
-            thought_node = root.find('thought')
-            thought = thought_node.text if thought_node is not None else None
-            if thought is not None and thought.strip() == "":
-                thought = None
-
-            # Process 'response' node
-            response_node = root.find('answer')
-            response = response_node.text if response_node is not None else None
-            if response is not None and response.strip() == "":
-                response = None
-
-            # Process 'function_call' node
-            function_call_node = root.find('function_call')
-            function_call = function_call_node.text if function_call_node is not None else None
-            if function_call is not None and function_call.strip() == "":
-                function_call = None
-            elif function_call:
-                function_call = json.loads(function_call)
+            with self.use_memory(session) as memory:
+                return memory.recall(query, exclude=exclude)
         except Exception as e:
-            print(e)
-            return {"thought": None, "answer": None, "function_call": None, "Error": f"Error: {e}"}
-        
-        return {"thought": thought, "answer": response, "function_call": function_call, "Error": None}
+            print(f"Long-term memory recall failed: {e}")
+            return None, None
+
+    def remember_turn(self, session:str, user_text:str, user_vector, entries:list[Message]) -> None:
+        """Store the user message and the answers and tool results of its turn in long-term memory. Blocking."""
+        try:
+            with self.use_memory(session) as memory:
+                if user_vector is not None:
+                    memory.add([("user", user_text)], user_vector[None, :])
+                else:
+                    entries = [Message("user", user_text)] + list(entries)
+                # Skip the echo of the tool call itself, its result is stored
+                memory.add([(entry.name or entry.role, entry.text) for entry in entries
+                            if not (entry.role == "assistant" and entry.text.startswith("Function("))])
+        except Exception as e:
+            print(f"Long-term memory store failed: {e}")
+
+    def get_dialogue(self, channel_id:int, profile:ChannelProfile) -> list[Message]:
+        """Dialogue of a channel or thread under its profile, started with the profile's system prompt."""
+        key = (channel_id, profile.name)
+        if key not in self.dialogues:
+            prompt = profile.system_prompt or (self.VISION_SYSTEM_PROMPT if profile.vision else self.SYSTEM_PROMPT)
+            self.dialogues[key] = [Message("system", prompt)]
+            while len(self.dialogues) > self.max_dialogues:
+                self.dialogues.popitem(last=False)
+        self.dialogues.move_to_end(key)
+        return self.dialogues[key]
+
+    def trim_dialogue(self, dialogue:list[Message], keep:int) -> list[Message]:
+        """Drop the oldest entries after the first keep ones until the dialogue fits the live context budget."""
+        total = dialogue_tokens(dialogue)
+        start = keep
+        while total > self.live_context_tokens and start < len(dialogue) - 1:
+            total -= dialogue[start].token_count
+            start += 1
+        return dialogue[:keep] + dialogue[start:]
 
     @commands.Cog.listener()
     async def on_ready(self):
         print('Chatbot Cog Online and Ready.')
         # Get the channel object using its ID
-        channel = self.bot.get_channel(self.working_channel)
+        channel = self.bot.get_channel(self.channel_routes.announce_channel) if self.channel_routes.announce_channel else None
         # Check if the channel was found
         if channel:
             # Send a message to the channel
@@ -192,250 +191,89 @@ ALWAYS REMEMBER to answer to user with <answer> node, DO NOT leave them blank. E
 
     @commands.Cog.listener()
     async def on_message(self, message):
+        # Unrouted traffic is dropped here, before any other work
+        profile = self.channel_routes.route_for(message.channel, message.guild)
+        if profile is None or message.author == self.bot.user:
+            return
+        if self.profiler.armed(message.channel.id):
+            async with self.profiler.profile_turn(message) as profiled_message:
+                await self.handle_message(profiled_message, profile)
+        else:
+            await self.handle_message(message, profile)
+
+    async def run_turn(self, message, dialogue:list[Message], profile:ChannelProfile, content:str, user_message:Message) -> None:
+        """Run a user turn through the turn engine, with recall from and storage to the channel's long-term memory."""
+        session = f"{profile.route}-{message.channel.id}"
+        # Embedding requests run off the event loop, a slow one must not stall every other channel
+        user_vector, recalled = await asyncio.to_thread(self.recall_memory, session, user_message.text,
+                                                        {entry.text for entry in dialogue})
+        dialogue.append(user_message)
+        turn_start = len(dialogue) - 1
+        await self.engine.run(message.channel, dialogue, profile.route, content, recalled,
+                              model=profile.model, tools=profile.tools, budgets=profile.budgets)
+        # The reply is out, the turn is stored in the background
+        task = asyncio.create_task(asyncio.to_thread(self.remember_turn, session, user_message.text, user_vector,
+                                                     dialogue[turn_start + 1:]))
+        self.memory_tasks.add(task)
+        task.add_done_callback(self.memory_tasks.discard)
+
+    async def handle_message(self, message, profile:ChannelProfile):
         def is_supported_image(content_type):
             supported_formats = ["image/png", "image/jpeg", "image/gif", "image/webp"]
             return content_type in supported_formats
 
-        if message.author == self.bot.user:
-            return
-        elif message.channel.id == self.working_channel:  # Case for general_chat
-            print("gpt_called")
-            content = message.content.replace(f'<@!{self.bot.user.id}>', '').replace(f'<@{self.bot.user.id}>','').strip()
-
-            if content.startswith('@') or content == ".sync":
-                return
-            if content == "reset":
-                try:
-                    summary = await self.generate_summary(self.Dialogue[1:])
-                    self.Dialogue = [self.Dialogue[0], {
-                        "role": "system",
-                        "content": summary
-                    }]
-                    await message.channel.send("dialogue cleared")
-                except Exception as e:
-                    print(str(e))
-                    self.Dialogue = [self.Dialogue[0]]
-                    await message.channel.send("dialogue cleared")
-                return
-            elif content == "hard_reset":
-                self.Dialogue = [self.Dialogue[0]]
-                await message.channel.send("dialogue wiped")
-                return
-
-            _current_datetime = datetime.datetime.now().strftime("%y-%m-%d/%H:%M:%S%z")
-            self.Dialogue.append({"role": "user", "content": f"({_current_datetime}|{message.author})" + content})
-
-            while True:
-                try:
-                    response = self.client.chat.completions.create(
-                        model="gpt-4-1106-preview",
-                        messages=self.Dialogue,
-                        tools=self.FunctionCall.tool_list,
-                        tool_choice="auto",
-                        temperature=0.7
-                    )
-                    print(response)
-                    response_message = response.choices[0].message
-
-                    if response_message.content:
-                        self.Dialogue.append({"role": "assistant", "content": response_message.content})
-                        await message.channel.send(
-                            response_message.content + f"\nToken used: {response.usage.total_tokens}")
-
-                    tool_calls = response.choices[0].message.tool_calls
-                    if tool_calls:
-                        for tool_call in tool_calls:
-                            await message.channel.send(
-                                f"Using tool: {tool_call.function} with arguments:\n{tool_call.function.arguments}\n")
-                            self.Dialogue.append({"role": "assistant", "content": str(tool_call.function)})
-                            try:
-                                tool_result = self.FunctionCall.function_call_handler(name=tool_call.function.name,
-                                                                                      arg=json.loads(
-                                                                                          tool_call.function.arguments))
-
-                                if type(tool_result) == str:
-                                    if len(tool_result) > 500:
-                                        await message.channel.send(f"Tool result:\n{tool_result[0:128]}...\n")
-                                    else:
-                                        await message.channel.send(f"Tool result:\n{tool_result}\n")
-                                    # self.Dialogue.append({"tool_call_id": tool_call.id, "role": "tool", "name": tool_call.function.name, "content": tool_result})
-                                    self.Dialogue.append(
-                                        {"role": "function", "content": tool_result, "name": tool_call.function.name})
-                                elif type(tool_result) == dict:
-                                    _response_str = tool_result["response_text"]
-                                    if tool_result["data"]["name"] == "draw_image":
-                                        _response_str += f"With prompt {tool_result['data']['prompt']}"
-                                        self.Dialogue.append({"role": "function", "content": _response_str,
-                                                              "name": tool_call.function.name})
-                                        file_name = tool_result['data']['prompt'][:50] + ".png"
-                                        image_file = discord.File(
-                                            io.BytesIO(base64.b64decode(tool_result["data"]["b64_image"])),
-                                            filename=file_name)
-                                        await message.channel.send(file=image_file)
-                                    else:
-                                        self.Dialogue.append({"role": "function", "content": _response_str,
-                                                              "name": tool_call.function.name})
-                                        await message.channel.send(_response_str)
-
-                            except Exception as e:
-                                await message.channel.send(f"Failed to use tool: {tool_call.function.name}||{e}")
-                    else:
-                        break
+        print("gpt_vis_called" if profile.vision else "gpt_called")
+        content = message.content.replace(f'<@!{self.bot.user.id}>', '').replace(f'<@{self.bot.user.id}>','').strip()
 
-                except Exception as e:
-                    print(e)
-                    break
-
-        elif message.channel.id == self.working_vis_channel:  # case for gpt-vision
-            print("gpt_vis_called")
-            print(json.dumps(self.Dialogue_vis, indent=4, ensure_ascii=False))
-            content = message.content.replace(f'<@!{self.bot.user.id}>', '').replace(f'<@{self.bot.user.id}>',
-                                                                                     '').strip()
-
-            if content.startswith('@') or content == ".sync":
-                return
-            elif content == "reset":
-                self.Dialogue_vis = [self.Dialogue_vis[0]]
-                await message.channel.send("dialogue wiped")
-                return
-            elif content == "hard_reset":
-                self.Dialogue_vis = [self.Dialogue_vis[0]]
-                await message.channel.send("dialogue wiped")
-                return
-
-            _current_datetime = datetime.datetime.now().strftime("%y-%m-%d/%H:%M:%S%z")
-            _user_message = {"role": "user",
-                             "content": [{"type": "text", "text": f"({_current_datetime}|{message.author})" + content}]}
+        if content.startswith('@') or content == ".sync":
+            return
+        key = (message.channel.id, profile.name)
+        dialogue = self.get_dialogue(message.channel.id, profile)
+        if content == "reset" and not profile.vision:
             try:
-                for attachment in message.attachments:
-                    if is_supported_image(attachment.content_type):
-                        # base64_image = encode_image(attachment.path)
-                        _user_message['content'].append({"type": "image_url",
-                                                         "image_url": {
-                                                             "url": attachment.url,
-                                                             "detail": "high"}})
-                self.Dialogue_vis.append(_user_message)
+                summary = await self.generate_summary(dialogue[1:])
+                self.dialogues[key] = [dialogue[0], Message("system", summary)]
+                await message.channel.send("dialogue cleared")
             except Exception as e:
-                print(e)
-                self.message.channel.send(f"Failed to encode image: {e}")
-
-            while True:
-                print(json.dumps(self.Dialogue_vis, indent=4, ensure_ascii=False))
-                try:
-                    result = self.client.chat.completions.create(
-                        model="gpt-4-vision-preview",
-                        messages=self.Dialogue_vis,
-                        max_tokens=1024,
-                        # tools/function is not enabled for gpt-4-vision-preview. Just leaving this in in case they enable it for gpt-4-vision-preview
-                        # tools= self.FunctionCall.tool_list,
-                        temperature=0.7
-                    )
-
-                    if result.usage.total_tokens > 150000:
-                        self.Dialogue_vis = [self.Dialogue_vis[0], self.Dialogue_vis[1], self.Dialogue_vis[2],
-                                             self.Dialogue_vis[-2], self.Dialogue_vis[-1]]
-
-                    content = result.choices[0].message.content
-
-                    _response_parsed = self.process_xml_response(str(content))
-
-                    if content:
-                        self.Dialogue_vis.append({"role": "assistant", "content": [{"type": "text", "text": content}]})
-                        if _response_parsed['answer']:
-                            await message.channel.send(
-                                f"{_response_parsed['answer']}\nToken: {result.usage.total_tokens}")
-
-                    function_argument = _response_parsed['function_call']
-                    if function_argument:
-                        try:
-                            await message.channel.send(
-                                f"Using tool: {function_argument['name']} With arguments:\n{function_argument['argument']}\n")
-                            function_result = self.FunctionCall.function_call_handler(name=function_argument['name'],
-                                                                                      arg=function_argument['argument'])
-                            if type(function_result) == str:
-                                if len(function_result) > 500:
-                                    await message.channel.send(f"Tool result:\n{function_result[0:128]}...\n")
-                                else:
-                                    await message.channel.send(f"Tool result:\n{function_result}\n")
-                                # self.Dialogue.append({"tool_call_id": tool_call.id, "role": "tool", "name": tool_call.function.name, "content": tool_result})
-                                self.Dialogue_vis.append({"role": "system",
-                                                          "content": [
-                                                              {
-                                                                  "type": "text",
-                                                                  "text": f"{function_argument['name']} result:\n {function_result}"
-                                                              }],
-                                                          "name": "function"})
-                            elif type(function_result) == dict:
-                                print(json.dumps("function_result", indent=4, ensure_ascii=False))
-                                _response_str = function_result["response_text"]
-                                if function_result["data"]["name"] == "draw_image":
-                                    file_name = function_result['data']['prompt'][:50] + ".png"
-                                    image_file = discord.File(
-                                        io.BytesIO(base64.b64decode(function_result["data"]["b64_image"])),
-                                        filename=file_name)
-                                    sent_message = await message.channel.send(file=image_file)
-                                    if sent_message.attachments:
-                                        _image_url = sent_message.attachments[0].url
-                                        _response_str += f"With prompt {function_result['data']['prompt'][:50]}"
-                                        self.Dialogue_vis.append({"role": "system",
-                                                                  "content": [
-                                                                      {
-                                                                          "type": "text",
-                                                                          "text": f"{function_argument['name']} result:\n {_response_str}"
-                                                                      },
-                                                                      {
-                                                                          "type": "image_url",
-                                                                          'image_url': {
-                                                                              "url": _image_url,
-                                                                          }
-                                                                      }],
-                                                                  "name": "function"})
-
-                                else:
-                                    await message.channel.send(_response_str)
-                                    self.Dialogue_vis.append({"role": "system",
-                                                              "content": [
-                                                                  {
-                                                                      "type": "text",
-                                                                      "text": f"{function_argument['name']} result:\n {_response_str}"
-                                                                  }],
-                                                              "name": "function"})
-
-                        except Exception as e:
-                            print(e)
-                            await message.channel.send(f"Failed to use tool: {function_argument['name']}||{e}")
-                            self.Dialogue_vis.append({"role": "system",
-                                                      "content": [
-                                                          {
-                                                              "type": "text",
-                                                              "text": f"Failed to use tool: {function_argument['name']}||{e}"
-                                                          }],
-                                                      "name": "function"
-                                                      })
-                    else:
-                        break
+                print(str(e))
+                self.dialogues[key] = [dialogue[0]]
+                await message.channel.send("dialogue cleared")
+            return
+        elif content in ("reset", "hard_reset"):
+            self.dialogues[key] = [dialogue[0]]
+            await message.channel.send("dialogue wiped")
+            return
 
-                except Exception as e:
-                    print(e)
-                    break
+        _current_datetime = datetime.datetime.now().strftime("%y-%m-%d/%H:%M:%S%z")
+        dialogue = self.dialogues[key] = self.trim_dialogue(dialogue, keep=1)
+        if profile.vision:
+            _user_parts = [("text", f"({_current_datetime}|{message.author})" + content)]
+            for attachment in message.attachments:
+                if is_supported_image(attachment.content_type):
+                    _user_parts.append(("image_url", attachment.url, "high"))
+            user_message = Message("user", tuple(_user_parts))
+        else:
+            user_message = Message("user", f"({_current_datetime}|{message.author})" + content)
+        await self.run_turn(message, dialogue, profile, content, user_message)
 
     @app_commands.command(name="clear", description="Clear the chat history")
     async def clear(self, ctx):
         try:
             await ctx.response.defer(ephemeral=True)  # Acknowledge the interaction immediately
-            if ctx.channel.id == self.working_channel:
+            profile = self.channel_routes.route_for(ctx.channel, ctx.guild)
+            if profile is not None and not profile.vision:
+                dialogue = self.get_dialogue(ctx.channel.id, profile)
                 try:
-                    summary = await self.generate_summary(self.Dialogue[1:])
-                    self.Dialogue = [self.Dialogue[0]]
-                    self.Dialogue.append({"role": "system", "content": summary, "name": "summary"})
+                    summary = await self.generate_summary(dialogue[1:])
+                    self.dialogues[(ctx.channel.id, profile.name)] = [dialogue[0], Message("system", summary, "summary")]
                 except Exception as e:
                     print(e)
-                    self.Dialogue = [self.Dialogue[0]]
+                    self.dialogues[(ctx.channel.id, profile.name)] = [dialogue[0]]
 
                 await ctx.followup.send("Dialogue cleared.")  # Send a follow-up message
                 await ctx.channel.send("Dialogue cleared.")
-            elif ctx.channel.id == self.working_vis_channel:
-                self.Dialogue_vis = [self.Dialogue_vis[0]]
+            elif profile is not None:
+                self.dialogues[(ctx.channel.id, profile.name)] = [self.get_dialogue(ctx.channel.id, profile)[0]]
                 await ctx.followup.send("Dialogue cleared.")
                 await ctx.channel.send("Dialogue cleared.")
             else:
@@ -448,12 +286,9 @@ ALWAYS REMEMBER to answer to user with <answer> node, DO NOT leave them blank. E
     async def clear_all(self, ctx):
         try:
             await ctx.response.defer()
-            if ctx.channel.id == self.working_channel:
-                self.Dialogue = [self.Dialogue[0]]
-                await ctx.followup.send("Dialogue all cleared.")
-                await ctx.channel.send("Dialogue all cleared.")
-            elif ctx.channel.id == self.working_vis_channel:
-                self.Dialogue_vis = [self.Dialogue_vis[0]]
+            profile = self.channel_routes.route_for(ctx.channel, ctx.guild)
+            if profile is not None:
+                self.dialogues[(ctx.channel.id, profile.name)] = [self.get_dialogue(ctx.channel.id, profile)[0]]
                 await ctx.followup.send("Dialogue all cleared.")
                 await ctx.channel.send("Dialogue all cleared.")
             else:
@@ -461,24 +296,43 @@ ALWAYS REMEMBER to answer to user with <answer> node, DO NOT leave them blank. E
         except Exception as e:
             print(e)
 
-    @app_commands.command(name="dialogue", description="Show the chat history")
-    async def dialogue(self, ctx):
+    @app_commands.command(name="dialogue", description="Show the chat history, a page of it, or export it as gzip JSONL")
+    async def dialogue(self, ctx, start: int = None, end: int = None, last: int = None, role: str = None,
+                       compact: bool = False, export: bool = False):
         try:
             await ctx.response.defer()
             # Choose the appropriate dialogue based on the channel
-            dialogue_data = self.Dialogue if ctx.channel.id == self.working_channel else self.Dialogue_vis if ctx.channel.id == self.working_vis_channel else None
+            profile = self.channel_routes.route_for(ctx.channel, ctx.guild)
+            dialogue_data = self.get_dialogue(ctx.channel.id, profile) if profile is not None else None
 
             if dialogue_data is not None:
-                # Convert the dialogue to a JSON string
-                dialogue_str = json.dumps(dialogue_data, indent=4, ensure_ascii=False)
-
-                # Check if the length is within Discord's limit
-                if len(dialogue_str) <= 1500:
-                    await ctx.followup.send(dialogue_str)
-                else:
-                    # If it's too long, send it as a file
-                    dialogue_file = StringIO(dialogue_str)
-                    await ctx.followup.send(file=discord.File(dialogue_file, filename="dialogue.txt"))
+                entries = select_dialogue(dialogue_data, start, end, last, role)
+                if not export:
+                    # Show the page inline when it fits in a message
+                    lines = []
+                    length = 0
+                    for index, message in entries:
+                        line = dialogue_jsonl_line(index, message, compact).decode('utf-8')
+                        length += len(line)
+                        if length > 1500:
+                            break
+                        lines.append(line)
+                    else:
+                        await ctx.followup.send("".join(lines) or "No matching entries.")
+                        return
+
+                # Too long, or asked for: stream it compressed through a temporary file
+                with tempfile.TemporaryFile() as export_file:
+                    count = await asyncio.to_thread(write_dialogue_jsonl, entries, export_file, compact)
+                    size = export_file.tell()
+                    # Forwarded commands only carry the guild id, assume the default limit there
+                    limit = getattr(ctx.guild, "filesize_limit", None) or 8 * 1024 * 1024
+                    if size > limit:
+                        await ctx.followup.send(f"Export of {count} entries is {size / 1024 / 1024:.1f} MB, over the {limit / 1024 / 1024:.0f} MB upload limit. "
+                                                "Narrow it with start, end, last or role, or use compact.")
+                        return
+                    export_file.seek(0)
+                    await ctx.followup.send(f"{count} entries", file=discord.File(export_file, filename="dialogue.jsonl.gz"))
 
             else:
                 await ctx.followup.send("Invalid channel.")
@@ -489,11 +343,10 @@ ALWAYS REMEMBER to answer to user with <answer> node, DO NOT leave them blank. E
     async def sysprompt(self, ctx, arg: str):
         try:
             await ctx.response.defer()
-            if ctx.channel.id == self.working_channel:
-                self.Dialogue[0]["content"] = arg
-                await ctx.followup.send("System prompt changed.")
-            elif ctx.channel.id == self.working_vis_channel:
-                self.Dialogue_vis[0]["content"] = arg
+            profile = self.channel_routes.route_for(ctx.channel, ctx.guild)
+            if profile is not None:
+                dialogue = self.get_dialogue(ctx.channel.id, profile)
+                dialogue[0] = dialogue[0].with_content(arg)
                 await ctx.followup.send("System prompt changed.")
             else:
                 await ctx.followup.send("Invalid channel.")
@@ -501,15 +354,42 @@ ALWAYS REMEMBER to answer to user with <answer> node, DO NOT leave them blank. E
             print(e)
             await ctx.followup.send(e)
 
+    @app_commands.command(name="profile", description="Profile the next turns in this channel")
+    @app_commands.default_permissions(administrator=True)
+    async def profile(self, ctx, turns: int = 1):
+        try:
+            await ctx.response.defer(ephemeral=True)
+            if self.channel_routes.route_for(ctx.channel, ctx.guild) is not None:
+                self.profiler.arm(ctx.channel.id, turns)
+                await ctx.followup.send(f"Profiling the next {turns} turn(s) in this channel.")
+            else:
+                await ctx.followup.send("Invalid channel.")
+        except Exception as e:
+            print(e)
+            await ctx.followup.send(e)
+
+    @app_commands.command(name="routes", description="Show the model of each route with its latency and cost")
+    @app_commands.default_permissions(administrator=True)
+    async def routes(self, ctx):
+        try:
+            await ctx.response.defer(ephemeral=True)
+            routes = "\n".join(f"{route}: {model}" for route, model in self.router.routes.items())
+            await ctx.followup.send(f"```\n{routes}\nescalate: {self.router.escalate}\n\n{self.router.report()[:1500]}\n```")
+        except Exception as e:
+            print(e)
+            await ctx.followup.send(e)
+
     @app_commands.command(name="help", description="Show the help message")
     async def bothelp(self, ctx):
         await ctx.response.send_message("Commands: \n"
                                         "/clear : clear all dialogue history | 대화 내용을 요약하고 초기화해서 요약본과 합칩니다.\n"
                                         "/clear_all : clear all dialogue history | 대화 내용을 완전히 삭제합니다\n"
-                                        "/dialogue : print out dialogue history | 대화 내용을 출력합니다\n"
+                                        "/dialogue [start] [end] [last] [role] [compact] [export] : print out dialogue history, or a page of it | 대화 내용을 출력합니다. 길면 gzip JSONL 파일로 보냅니다\n"
                                         "/sysprompt [input] : set systemprompt | 시스템 메세지를 설정합니다\n"
                                         "/bothelp | 도움말\n")
 
 
 async def setup(bot):
-    await bot.add_cog(Chatbot(bot), guilds=[discord.Object(id=os.getenv("DISCORD_GUILD"))])
\ No newline at end of file
+    chatbot = Chatbot(bot)
+    # Slash commands are registered in every routed guild, a guild added later needs a restart and .sync
+    await bot.add_cog(chatbot, guilds=[discord.Object(id=guild_id) for guild_id in sorted(chatbot.channel_routes.guild_ids)])
\ No newline at end of file
@@ -1,78 +1,102 @@
 import discord
-from discord.ext import tasks, commands
-from datetime import datetime
+from discord.ext import commands
+import datetime
+import asyncio
 import requests
+import json
 import os
+from Scripts.utilities.scheduler import get_scheduler
+from Scripts.utilities.http_cache import get_http_cache
+from Scripts.utilities.channel_routes import routed_guild_ids
 
 class NasaImagePoster(commands.Cog):
+    required_intents = ("guilds",)
+
     def __init__(self, bot):
         self.bot = bot
         self.nasa_api_key = os.getenv('NASA_API_KEY')  # Load NASA API Key from environment variables
         self.channel_id = int(os.getenv("NASA_IMAGE_CHANNEL_ID"))  # Load Discord channel ID from environment variables
         self.nasa_url = 'https://api.nasa.gov/planetary/apod'
-        self.post_image_of_the_day.start()  # Start the loop
+        self.archive_dir = os.path.join('Resource', 'cache', 'apod')
+        self.http_cache = get_http_cache()
+        self.post_time = datetime.time(hour=16, minute=0, tzinfo=datetime.timezone.utc)
+        self.max_upload_size = 8 * 1024 * 1024  # Discord's default upload limit
+        self.scheduler = get_scheduler(bot)
+        self.scheduler.add_daily_job("nasa_apod", self.post_time, self.post_image_of_the_day,
+                                     prefetch=self.prefetch_image_of_the_day,
+                                     prefetch_lead=datetime.timedelta(minutes=5))
 
-    @tasks.loop(hours=24)
-    async def post_image_of_the_day(self):
-        # If the time is not 1600 UTC, wait until it is
-        now = datetime.now(datetime.timezone.utc)
-        if now.hour != 16 or now.minute != 0:
-            print(f'Waiting until 16:00 UTC. Current time is {now.strftime("%H:%M")}.')
-            return
-        
-        # Parameters for the NASA API request
-        params = {
-            'api_key': self.nasa_api_key
-        }
+    async def cog_unload(self):
+        self.scheduler.remove_job("nasa_apod")
 
-        try:
-            response = requests.get(self.nasa_url, params=params)
-            response.raise_for_status()  # This will raise an HTTPError if the HTTP request returned an unsuccessful status code
+    def fetch_image_of_the_day(self) -> dict:
+        """
+        Fetch today's APOD payload and image into the local archive, reusing archived files when present.
+        Blocking, run it in a thread.
+        """
+        os.makedirs(self.archive_dir, exist_ok=True)
+        response = self.http_cache.fetch(self.nasa_url, params={'api_key': self.nasa_api_key}, timeout=30)
+        response.raise_for_status()  # This will raise an HTTPError if the HTTP request returned an unsuccessful status code
+        if response.stale:
+            # NASA could not be reached and the stored copy may be an earlier day's, raise so the job retries
+            raise RuntimeError("APOD is unavailable, only a stale cached copy was served")
+        data = response.json()
 
-            # Proceed with parsing the response...
-        except requests.exceptions.HTTPError as http_err:
-            print(f"HTTP error occurred: {http_err}")  # Python 3.6
-        except Exception as err:
-            print(f"An error occurred: {err}")
+        payload_path = os.path.join(self.archive_dir, f"{data['date']}.json")
+        with open(payload_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=4)
 
-        if response.status_code == 200:
-            # Parse the JSON response
-            data = response.json()
+        data['image_path'] = None
+        if data.get('media_type') == 'image':
+            extension = os.path.splitext(data['url'].split('?')[0])[1] or '.jpg'
+            image_path = os.path.join(self.archive_dir, f"{data['date']}{extension}")
+            if not os.path.exists(image_path):
+                with requests.get(data['url'], stream=True, timeout=60) as image_response:
+                    image_response.raise_for_status()
+                    with open(image_path + '.part', 'wb') as f:
+                        for block in image_response.iter_content(chunk_size=64 * 1024):
+                            f.write(block)
+                os.replace(image_path + '.part', image_path)
+            data['image_path'] = image_path
+        return data
 
-            # Access the image, its title, and explanation
-            image_url = data['url']
-            title = data['title']
-            explanation = data['explanation']
+    async def prefetch_image_of_the_day(self) -> dict:
+        return await asyncio.to_thread(self.fetch_image_of_the_day)
 
-            # Find the channel
-            channel = self.bot.get_channel(self.channel_id)
+    async def post_image_of_the_day(self, data:dict=None):
+        if data is None:
+            # Prefetch failed or did not run, fetch now. Errors propagate so the scheduler retries.
+            data = await self.prefetch_image_of_the_day()
 
-            if channel:
-                # Create an embed message for Discord
-                embed = discord.Embed(title=title, description=explanation, color=0x1a1aff)
-                embed.set_image(url=image_url)
+        # Find the channel
+        channel = self.bot.get_channel(self.channel_id)
+        if channel is None:
+            print(f'Channel with ID {self.channel_id} not found.')
+            return
 
-                # Send the embed message to the channel
-                try:
-                    await channel.send(embed=embed)
-                except discord.errors.Forbidden:
-                    print("I don't have permission to send messages in this channel.")
-                except discord.errors.HTTPException as e:
-                    print(f"Sending message failed: {e}")
-                    
+        # Create an embed message for Discord
+        embed = discord.Embed(title=data['title'], description=data['explanation'], color=0x1a1aff)
+        image_path = data.get('image_path')
+        try:
+            if image_path and os.path.getsize(image_path) <= self.max_upload_size:
+                # Upload from the local archive so the post does not depend on NASA's server at post time
+                file_name = os.path.basename(image_path)
+                embed.set_image(url=f"attachment://{file_name}")
+                await channel.send(embed=embed, file=discord.File(image_path, filename=file_name))
+            elif data.get('media_type') == 'image':
+                embed.set_image(url=data['url'])
+                await channel.send(embed=embed)
             else:
-                print(f'Channel with ID {self.channel_id} not found.')
-        else:
-            print(f"Error: Unable to retrieve data. Status code: {response.status_code}")
-
-    @post_image_of_the_day.before_loop
-    async def before_post_image_of_the_day(self):
-        print('Waiting for the bot to be ready before starting the loop...')
-        await self.bot.wait_until_ready()
+                await channel.send(embed=embed)
+                await channel.send(data['url'])
+        except discord.errors.Forbidden:
+            print("I don't have permission to send messages in this channel.")
+        except discord.errors.HTTPException as e:
+            print(f"Sending message failed: {e}")
 
     @commands.Cog.listener()
     async def on_ready(self):
         print('NasaImagePoster cog is ready and online!')
 
 async def setup(bot):
-    await bot.add_cog(NasaImagePoster(bot), guilds=[discord.Object(id=os.getenv("DISCORD_GUILD"))])
\ No newline at end of file
+    await bot.add_cog(NasaImagePoster(bot), guilds=[discord.Object(id=guild_id) for guild_id in routed_guild_ids()])
\ No newline at end of file
@@ -0,0 +1,40 @@
+import discord
+from discord import app_commands
+from discord.ext import commands
+from io import StringIO
+from Scripts.utilities.loop_watchdog import LoopWatchdog
+from Scripts.utilities.channel_routes import routed_guild_ids
+
+class LoopMonitor(commands.Cog):
+    required_intents = ("guilds",)
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.watchdog = LoopWatchdog()
+
+    async def cog_load(self):
+        self.watchdog.start()
+
+    async def cog_unload(self):
+        self.watchdog.stop()
+
+    @app_commands.command(name="looplag", description="Report event loop lag percentiles and the calls that blocked the loop")
+    @app_commands.default_permissions(administrator=True)
+    async def looplag(self, ctx, stacks: bool = False):
+        try:
+            await ctx.response.defer(ephemeral=True)
+            report = self.watchdog.report()
+            if stacks:
+                # Attach the full stack of each blocking site
+                sites = sorted(self.watchdog.sites.values(), key=lambda site: site.total, reverse=True)
+                details = "\n\n".join(f"{site.key}\n{site.stack}" for site in sites)
+                await ctx.followup.send(f"```\n{report[:1900]}\n```",
+                                        file=discord.File(StringIO(details), filename="blocking_stacks.txt"))
+            else:
+                await ctx.followup.send(f"```\n{report[:1900]}\n```")
+        except Exception as e:
+            print(e)
+            await ctx.followup.send(str(e))
+
+async def setup(bot):
+    await bot.add_cog(LoopMonitor(bot), guilds=[discord.Object(id=guild_id) for guild_id in routed_guild_ids()])
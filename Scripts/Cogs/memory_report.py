@@ -0,0 +1,30 @@
+import discord
+from discord import app_commands
+from discord.ext import commands
+from io import StringIO
+from Scripts.utilities.memory_profile import MemorySnapshotter
+from Scripts.utilities.channel_routes import routed_guild_ids
+
+class MemoryReport(commands.Cog):
+    required_intents = ("guilds",)
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.snapshotter = MemorySnapshotter()
+
+    @app_commands.command(name="memory", description="Report memory usage, top allocation sites and growth since the last report")
+    @app_commands.default_permissions(administrator=True)
+    async def memory(self, ctx, limit: int = 10):
+        try:
+            await ctx.response.defer(ephemeral=True)
+            report = self.snapshotter.report(limit=limit)
+            if len(report) <= 1900:
+                await ctx.followup.send(f"```\n{report}\n```")
+            else:
+                await ctx.followup.send(file=discord.File(StringIO(report), filename="memory_report.txt"))
+        except Exception as e:
+            print(e)
+            await ctx.followup.send(str(e))
+
+async def setup(bot):
+    await bot.add_cog(MemoryReport(bot), guilds=[discord.Object(id=guild_id) for guild_id in routed_guild_ids()])
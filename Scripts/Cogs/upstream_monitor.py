@@ -0,0 +1,29 @@
+import discord
+from discord import app_commands
+from discord.ext import commands
+from Scripts.utilities.resilience import get_resilience
+from Scripts.utilities.http_cache import get_http_cache
+from Scripts.utilities.channel_routes import routed_guild_ids
+
+class UpstreamMonitor(commands.Cog):
+    required_intents = ("guilds",)
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.resilience = get_resilience()
+
+    @app_commands.command(name="upstreams", description="Report breaker state, failures, hedging and p95 latency of each external dependency")
+    @app_commands.default_permissions(administrator=True)
+    async def upstreams(self, ctx):
+        try:
+            await ctx.response.defer(ephemeral=True)
+            http_cache = get_http_cache()
+            report = (f"{self.resilience.report()}\n\nhttp cache: {http_cache.hits} hits, {http_cache.revalidated} revalidated, "
+                      f"{http_cache.stale} stale, {http_cache.misses} misses")
+            await ctx.followup.send(f"```\n{report[:1900]}\n```")
+        except Exception as e:
+            print(e)
+            await ctx.followup.send(str(e))
+
+async def setup(bot):
+    await bot.add_cog(UpstreamMonitor(bot), guilds=[discord.Object(id=guild_id) for guild_id in routed_guild_ids()])
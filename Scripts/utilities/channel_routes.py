@@ -0,0 +1,128 @@
+import os
+import json
+import time
+
+# TurnBudget limits a profile can set
+BUDGET_KEYS:tuple = ("max_tool_rounds", "max_seconds", "max_tokens", "max_cost")
+
+class ChannelProfile(object):
+    """
+    What the bot does in a routed channel: its model, the tools it may use, turn budgets, system prompt and
+    whether it takes images. Unset fields fall back to the route defaults.
+    """
+    __slots__ = ("name", "vision", "model", "tools", "budgets", "system_prompt")
+
+    def __init__(self, name:str, vision:bool=False, model:str=None, tools:list[str]=None, budgets:dict=None,
+                 system_prompt:str=None):
+        self.name = name
+        self.vision = vision
+        self.model = model
+        # read_result only pages through results of the other tools, it comes with any of them
+        self.tools = frozenset(tools) | {"read_result"} if tools is not None else None
+        self.budgets = {key: value for key, value in (budgets or {}).items() if key in BUDGET_KEYS}
+        self.system_prompt = system_prompt
+
+    @property
+    def route(self) -> str:
+        return "vision" if self.vision else "chat"
+
+    @classmethod
+    def from_config(cls, name:str, config:dict) -> "ChannelProfile":
+        return cls(name, bool(config.get("vision", False)), config.get("model"), config.get("tools"),
+                   config.get("budgets"), config.get("system_prompt"))
+
+
+DEFAULT_PROFILES:dict = {"chat": ChannelProfile("chat"), "vision": ChannelProfile("vision", vision=True)}
+
+class ChannelRoutes(object):
+    """
+    Routing table from guilds, channels and threads to channel profiles.
+
+    Read from Resource/channel_routes.json, checked for changes at most every reload_interval seconds, as
+    {"profiles": {"name": {"vision": false, "model": ..., "tools": [...], "budgets": {...}, "system_prompt": ...}},
+     "guilds": {"<guild id>": {"default": "<profile>", "channels": {"<channel or thread id>": "<profile>"}}},
+     "announce_channel": "<channel id>"}.
+    Without the file, PERMITTED_CHANNEL_ID and PERMITTED_CHANNEL_ID_VISION in DISCORD_GUILD are routed to the
+    built-in chat and vision profiles. A message resolves with at most three dict lookups: its channel or thread,
+    a thread's parent channel, then its guild's default, so unrouted traffic costs the same however many guilds are served.
+    """
+    def __init__(self, config_path:str=os.path.join('Resource', 'channel_routes.json'), reload_interval:float=5.0):
+        self.config_path = config_path
+        self.reload_interval = reload_interval
+        self.profiles:dict = dict(DEFAULT_PROFILES)
+        self.channels:dict = {}
+        self.guild_defaults:dict = {}
+        self.guild_ids:frozenset = frozenset()
+        self.announce_channel:int = None
+        self._config_mtime:float = None
+        self._checked:float = 0.0
+        self.reload()
+
+    @staticmethod
+    def env_config() -> dict:
+        channels = {}
+        if os.getenv("PERMITTED_CHANNEL_ID"):
+            channels[os.getenv("PERMITTED_CHANNEL_ID")] = "chat"
+        if os.getenv("PERMITTED_CHANNEL_ID_VISION"):
+            channels[os.getenv("PERMITTED_CHANNEL_ID_VISION")] = "vision"
+        return {"guilds": {os.getenv("DISCORD_GUILD") or "0": {"channels": channels}},
+                "announce_channel": os.getenv("PERMITTED_CHANNEL_ID")}
+
+    def reload(self) -> None:
+        self._checked = time.monotonic()
+        try:
+            mtime = os.path.getmtime(self.config_path)
+            if mtime == self._config_mtime:
+                return
+            with open(self.config_path, 'r', encoding='utf-8') as f:
+                config = json.load(f)
+            self._config_mtime = mtime
+        except FileNotFoundError:
+            if self._config_mtime is not None:
+                return
+            config = self.env_config()
+            self._config_mtime = -1.0
+        except json.JSONDecodeError as e:
+            print(f"Invalid channel route config, keeping current routes: {e}")
+            return
+        self._apply(config)
+
+    def _apply(self, config:dict) -> None:
+        profiles = dict(DEFAULT_PROFILES)
+        profiles.update({name: ChannelProfile.from_config(name, profile) for name, profile in config.get("profiles", {}).items()})
+        channels = {}
+        guild_defaults = {}
+        for guild_id, guild in config.get("guilds", {}).items():
+            routes = [(int(channel_id), name) for channel_id, name in guild.get("channels", {}).items()]
+            if guild.get("default"):
+                routes.append((None, guild["default"]))
+            for channel_id, name in routes:
+                if name not in profiles:
+                    print(f"Unknown channel profile {name} in guild {guild_id}, not routed")
+                elif channel_id is None:
+                    guild_defaults[int(guild_id)] = profiles[name]
+                else:
+                    channels[channel_id] = profiles[name]
+        # Swapped in whole, a message never sees a half applied table
+        self.profiles, self.channels, self.guild_defaults = profiles, channels, guild_defaults
+        self.guild_ids = frozenset(int(guild_id) for guild_id in config.get("guilds", {}) if int(guild_id))
+        self.announce_channel = int(config["announce_channel"]) if config.get("announce_channel") else None
+
+    def route(self, guild_id:int, channel_id:int, parent_id:int=None) -> ChannelProfile:
+        """Profile of a channel or thread, or None when it is not routed."""
+        if time.monotonic() - self._checked > self.reload_interval:
+            self.reload()
+        profile = self.channels.get(channel_id)
+        if profile is None and parent_id is not None:
+            profile = self.channels.get(parent_id)
+        if profile is None:
+            profile = self.guild_defaults.get(guild_id)
+        return profile
+
+    def route_for(self, channel, guild=None) -> ChannelProfile:
+        return self.route(guild.id if guild is not None else None, channel.id, getattr(channel, "parent_id", None))
+
+
+def routed_guild_ids() -> list[int]:
+    """Ids of the guilds in the routing table, where the cogs register their slash commands."""
+    return sorted(ChannelRoutes().guild_ids)
@@ -0,0 +1,117 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+class CompletionCache(object):
+    """
+    Content-addressed cache of completions for helper calls that are pure functions of their input.
+
+    The key is a sha256 of (model, messages, parameters). Entries live in an in-memory LRU over an on-disk store,
+    expire after their ttl, and the oldest files are evicted once the store grows over max_bytes.
+    """
+    def __init__(self, cache_dir:str=os.path.join('Resource', 'cache', 'completions'), memory_entries:int=256,
+                 max_bytes:int=int(float(os.getenv('COMPLETION_CACHE_MAX_MB') or 64) * 1024 * 1024)):
+        self.cache_dir = cache_dir
+        self.memory_entries = memory_entries
+        self.max_bytes = max_bytes
+        self.memory:OrderedDict = OrderedDict()
+        self.hits:int = 0
+        self.misses:int = 0
+        self._lock = threading.Lock()
+        self._index:dict = {}
+        self._disk_bytes:int = 0
+        self._load_index()
+
+    def _load_index(self) -> None:
+        if not os.path.isdir(self.cache_dir):
+            return
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith('.json'):
+                    path = os.path.join(root, name)
+                    stat = os.stat(path)
+                    self._index[name[:-5]] = (stat.st_size, stat.st_mtime)
+                    self._disk_bytes += stat.st_size
+
+    @staticmethod
+    def make_key(model:str, messages:list, params:dict) -> str:
+        payload = json.dumps({"model": model, "messages": messages, "params": params}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _path(self, key:str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def get(self, key:str) -> str:
+        now = time.time()
+        with self._lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                if entry["expires"] > now:
+                    self.memory.move_to_end(key)
+                    self.hits += 1
+                    return entry["content"]
+                self._delete(key)
+            elif key in self._index:
+                try:
+                    with open(self._path(key), 'r', encoding='utf-8') as f:
+                        entry = json.load(f)
+                except (FileNotFoundError, json.JSONDecodeError):
+                    entry = None
+                if entry is not None and entry["expires"] > now:
+                    self._remember(key, entry)
+                    self.hits += 1
+                    return entry["content"]
+                self._delete(key)
+            self.misses += 1
+            return None
+
+    def put(self, key:str, content:str, ttl:float) -> None:
+        entry = {"content": content, "expires": time.time() + ttl}
+        data = json.dumps(entry, ensure_ascii=False).encode('utf-8')
+        path = self._path(key)
+        with self._lock:
+            self._remember(key, entry)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + '.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(path + '.tmp', path)
+            previous = self._index.get(key)
+            self._disk_bytes += len(data) - (previous[0] if previous else 0)
+            self._index[key] = (len(data), time.time())
+            self._evict()
+
+    def _remember(self, key:str, entry:dict) -> None:
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def _delete(self, key:str) -> None:
+        self.memory.pop(key, None)
+        previous = self._index.pop(key, None)
+        if previous is not None:
+            self._disk_bytes -= previous[0]
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def _evict(self) -> None:
+        if self._disk_bytes <= self.max_bytes:
+            return
+        for key, _ in sorted(self._index.items(), key=lambda item: item[1][1]):
+            if self._disk_bytes <= self.max_bytes * 0.9:
+                break
+            self._delete(key)
+
+
+_cache:CompletionCache = None
+
+def get_completion_cache() -> CompletionCache:
+    global _cache
+    if _cache is None:
+        _cache = CompletionCache()
+    return _cache
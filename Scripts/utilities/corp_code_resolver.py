@@ -0,0 +1,190 @@
+import io
+import os
+import re
+import json
+import time
+import bisect
+import zipfile
+import unicodedata
+from difflib import SequenceMatcher
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import requests
+
+# Legal form markers dropped by normalization, in Korean and English
+_LEGAL_FORMS = re.compile(r"주식회사|유한회사|유한책임회사|합자회사|합명회사|\(주\)|\(유\)|㈜|"
+                          r"\b(co|corp|corporation|company|inc|incorporated|ltd|limited|llc|plc)\b\.?")
+_NON_WORD = re.compile(r"[\W_]+")
+
+def normalize_corp_name(name:str) -> str:
+    """Lookup key of a company name: NFKC, lower case, without legal form markers, spacing and punctuation."""
+    name = unicodedata.normalize('NFKC', name).lower()
+    return _NON_WORD.sub("", _LEGAL_FORMS.sub(" ", name))
+
+
+class _BlobStrings(object):
+    """Sequence view of byte strings stored back to back in a blob, for bisect."""
+    __slots__ = ("blob", "offsets")
+
+    def __init__(self, blob:np.ndarray, offsets:np.ndarray):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index:int) -> bytes:
+        return self.blob[self.offsets[index]:self.offsets[index + 1]].tobytes()
+
+
+class CorpCodeResolver(object):
+    """
+    Company name to DART corp_code resolver over an index built from DART's corp code dump.
+
+    The index is a few flat numpy arrays saved as .npy and loaded memory mapped, so it opens in milliseconds:
+    fixed width corp and stock codes, the display names as one utf-8 blob with offsets, and the sorted
+    normalized keys of every Korean and English name with the row each points to. Lookups bisect the sorted keys:
+    exact and normalized names hit one range, prefixes the range of keys starting with the query, and fuzzy
+    matching only scores the keys that share the query's first character. Listed companies rank first.
+    """
+    ARRAYS:tuple = ("corp_codes", "stock_codes", "name_blob", "name_offsets", "key_blob", "key_offsets", "key_rows")
+
+    def __init__(self, index_dir:str=os.path.join('Resource', 'cache', 'corp_codes')):
+        self.index_dir = index_dir
+        arrays = {name: np.load(os.path.join(index_dir, f"{name}.npy"), mmap_mode='r') for name in self.ARRAYS}
+        self.corp_codes = arrays["corp_codes"]
+        self.stock_codes = arrays["stock_codes"]
+        self.names = _BlobStrings(arrays["name_blob"], arrays["name_offsets"])
+        self.keys = _BlobStrings(arrays["key_blob"], arrays["key_offsets"])
+        self.key_rows = arrays["key_rows"]
+
+    @staticmethod
+    def _read_dump(source_path:str) -> bytes:
+        if zipfile.is_zipfile(source_path):
+            with zipfile.ZipFile(source_path) as archive:
+                return archive.read(archive.namelist()[0])
+        with open(source_path, 'rb') as f:
+            return f.read()
+
+    @classmethod
+    def build(cls, source_path:str, index_dir:str=os.path.join('Resource', 'cache', 'corp_codes')) -> "CorpCodeResolver":
+        """Build the index from CORPCODE.xml, or the zip DART serves it in, and open it."""
+        rows = []
+        for _, element in ET.iterparse(io.BytesIO(cls._read_dump(source_path))):
+            if element.tag != "list":
+                continue
+            rows.append(((element.findtext("corp_code") or "").strip(), (element.findtext("corp_name") or "").strip(),
+                         (element.findtext("corp_eng_name") or "").strip(), (element.findtext("stock_code") or "").strip()))
+            element.clear()
+
+        names = [name.encode('utf-8') for _, name, _, _ in rows]
+        keys = []
+        for row, (_, name, english_name, _) in enumerate(rows):
+            for key in {normalize_corp_name(name), normalize_corp_name(english_name)} - {""}:
+                keys.append((key.encode('utf-8'), row))
+        keys.sort()
+
+        os.makedirs(index_dir, exist_ok=True)
+        arrays = {
+            "corp_codes": np.array([code for code, _, _, _ in rows], dtype='S8'),
+            "stock_codes": np.array([stock for _, _, _, stock in rows], dtype='S6'),
+            "name_blob": np.frombuffer(b"".join(names), dtype=np.uint8),
+            "name_offsets": np.concatenate([[0], np.cumsum([len(name) for name in names])]).astype(np.int64),
+            "key_blob": np.frombuffer(b"".join(key for key, _ in keys), dtype=np.uint8),
+            "key_offsets": np.concatenate([[0], np.cumsum([len(key) for key, _ in keys])]).astype(np.int64),
+            "key_rows": np.array([row for _, row in keys], dtype=np.uint32),
+        }
+        # Written aside and swapped in, a resolver still mapping the old files keeps reading them
+        for name, array in arrays.items():
+            path = os.path.join(index_dir, f"{name}.npy")
+            with open(path + '.tmp', 'wb') as f:
+                np.save(f, array)
+            os.replace(path + '.tmp', path)
+        meta_path = os.path.join(index_dir, "meta.json")
+        with open(meta_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({"source": os.path.abspath(source_path), "source_mtime": os.path.getmtime(source_path),
+                       "companies": len(rows), "keys": len(keys)}, f)
+        os.replace(meta_path + '.tmp', meta_path)
+        return cls(index_dir)
+
+    @classmethod
+    def download_dump(cls, api_key:str, path:str=os.path.join('Resource', 'cache', 'corp_codes', 'CORPCODE.zip')) -> str:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with requests.get("https://opendart.fss.or.kr/api/corpCode.xml", params={"crtfc_key": api_key},
+                          stream=True, timeout=120) as response:
+            response.raise_for_status()
+            with open(path + '.part', 'wb') as f:
+                for block in response.iter_content(chunk_size=64 * 1024):
+                    f.write(block)
+        os.replace(path + '.part', path)
+        return path
+
+    @classmethod
+    def load_or_build(cls, api_key:str=None, index_dir:str=os.path.join('Resource', 'cache', 'corp_codes'),
+                      max_age:float=float(os.getenv('DART_CORP_CODES_MAX_AGE') or 7 * 24 * 3600)) -> "CorpCodeResolver":
+        """
+        Open the index, downloading the dump and building it first when it does not exist yet or its dump is older
+        than max_age seconds, so newly listed companies resolve. A failed refresh keeps the existing index.
+        """
+        meta_path = os.path.join(index_dir, "meta.json")
+        dump_path = os.path.join(index_dir, 'CORPCODE.zip')
+        if not os.path.exists(meta_path):
+            return cls.build(cls.download_dump(api_key or os.getenv('DART_API_KEY'), dump_path), index_dir)
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        if time.time() - meta.get("source_mtime", 0) <= max_age:
+            return cls(index_dir)
+        try:
+            return cls.build(cls.download_dump(api_key or os.getenv('DART_API_KEY'), dump_path), index_dir)
+        except (requests.RequestException, OSError) as e:
+            print(f"Corp code dump refresh failed, keeping the index from {meta.get('source')}: {e}")
+            return cls(index_dir)
+
+    def _entry(self, row:int, match:str, score:float=1.0) -> dict:
+        return {"corp_code": self.corp_codes[row].decode(), "corp_name": self.names[row].decode('utf-8'),
+                "stock_code": self.stock_codes[row].decode() or None, "match": match, "score": score}
+
+    def _rank(self, rows) -> list[int]:
+        # Listed companies first, then the shortest name
+        return sorted(set(int(row) for row in rows), key=lambda row: (not self.stock_codes[row], len(self.names[row])))
+
+    def search(self, name:str, limit:int=5) -> list[dict]:
+        """Candidates for a company name, best first, each with the kind of match: exact, normalized, prefix or fuzzy."""
+        query = name.strip()
+        key = normalize_corp_name(query).encode('utf-8')
+        if not key:
+            return []
+        start = bisect.bisect_left(self.keys, key)
+        end = bisect.bisect_right(self.keys, key, lo=start)
+        if end > start:
+            rows = self._rank(self.key_rows[start:end])
+            return [self._entry(row, "exact" if self.names[row].decode('utf-8') == query else "normalized")
+                    for row in rows[:limit]]
+
+        # Keys starting with the query sort right after it
+        prefix_end = bisect.bisect_left(self.keys, key + b"\xff", lo=start)
+        if prefix_end > start:
+            rows = self._rank(self.key_rows[start:min(prefix_end, start + 200)])
+            return [self._entry(row, "prefix") for row in rows[:limit]]
+
+        first = key.decode('utf-8')[0].encode('utf-8')
+        range_start = bisect.bisect_left(self.keys, first)
+        range_end = min(bisect.bisect_left(self.keys, first + b"\xff", lo=range_start), range_start + 5000)
+        text = key.decode('utf-8')
+        scored = {}
+        for index in range(range_start, range_end):
+            matcher = SequenceMatcher(None, text, self.keys[index].decode('utf-8'))
+            if matcher.real_quick_ratio() < 0.6 or matcher.quick_ratio() < 0.6:
+                continue
+            score = matcher.ratio()
+            if score >= 0.6:
+                row = int(self.key_rows[index])
+                scored[row] = max(score, scored.get(row, 0.0))
+        rows = sorted(scored, key=lambda row: (-scored[row], not self.stock_codes[row]))
+        return [self._entry(row, "fuzzy", round(scored[row], 3)) for row in rows[:limit]]
+
+    def resolve(self, name:str) -> dict:
+        """Best candidate for a company name, or None."""
+        candidates = self.search(name, limit=1)
+        return candidates[0] if candidates else None
@@ -4,6 +4,9 @@ import json
 import yaml
 import re
 from openai import OpenAI
+from Scripts.utilities.model_router import get_router
+from Scripts.utilities.dart_engine import DartDataEngine
+from Scripts.utilities.corp_code_resolver import CorpCodeResolver
 
 class DartAgent():
     def __init__(self):
@@ -12,6 +15,9 @@ class DartAgent():
         if self.api_key is None or self.openai_api_key is None:
             raise Exception('DART_API_KEY or OPENAI_API_KEY not found in .env file or environment. Check if dotenv have been loaded.')
         self.client = OpenAI(api_key = self.openai_api_key)
+        self.router = get_router()
+        self.engine = DartDataEngine(self.api_key)
+        self._corp_resolver = None
 
     def extract_api_code(self, xml_response):
         """
@@ -169,11 +175,33 @@ API 내용: 무상증자 결정에 대한 정보를 제공합니다.
     - <response> is the api code in xml format."""
             }
         ] + two_shot_prompt
-        response = self.client.chat.completions.create(
-            model= 'gpt-4-turbo-preview',
-            messages= _prompt
-        )
-        return self.extract_api_code(response.choices[0].message.content).strip()
+        response = self.router.complete(self.client, "classification", cache_ttl=30 * 24 * 3600, messages=_prompt)
+        return self.extract_api_code(response).strip()
+
+    @property
+    def corp_resolver(self) -> CorpCodeResolver:
+        # Opened on first use, the first run downloads DART's corp code dump and builds the index
+        if self._corp_resolver is None:
+            self._corp_resolver = CorpCodeResolver.load_or_build(self.api_key)
+        return self._corp_resolver
+
+    def resolve_corp_code(self, corp:str) -> str:
+        """corp_code of a company given by name or by its 8 digit corp_code, resolved from the local index."""
+        corp = corp.strip()
+        if re.fullmatch(r"\d{8}", corp):
+            return corp
+        match = self.corp_resolver.resolve(corp)
+        if match is None:
+            raise ValueError(f"No company in DART matches '{corp}'")
+        return match["corp_code"]
+
+    def get_dart_data(self, query:str, corp:str, year:int, report_code:str="11011"):
+        """
+        Choose the api code for the query and fetch its data for the company and period as a DataFrame.
+        corp is a company name or corp_code. Repeated queries for the same company and period are read from the local Parquet cache.
+        """
+        api_code = self.get_dart_code(query)
+        return api_code, self.engine.fetch(api_code, self.resolve_corp_code(corp), year, report_code)
 
 if __name__ == "__main__":
     from dotenv import load_dotenv
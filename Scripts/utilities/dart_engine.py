@@ -0,0 +1,261 @@
+import os
+import json
+import time
+import datetime
+from functools import lru_cache
+
+import requests
+import pandas as pd
+from requests.adapters import HTTPAdapter
+
+from Scripts.utilities.resilience import get_resilience
+
+DART_BASE_URL:str = "https://opendart.fss.or.kr/api/"
+
+# Report codes of the periodic reports
+REPORT_CODES:dict = {"11013": "1분기보고서", "11012": "반기보고서", "11014": "3분기보고서", "11011": "사업보고서"}
+
+# Endpoint path and parameter kind of each api code in Resource/api_code.json.
+# periodic: corp_code, bsns_year, reprt_code. event: corp_code, bgn_de, end_de. company: corp_code only.
+DART_ENDPOINTS:dict = {
+    "A1": ("list.json", "event"), "A2": ("company.json", "company"),
+    "B1": ("cndlCaplScritsNrdmpBlce.json", "periodic"), "B2": ("unrstExctvMendngSttus.json", "periodic"),
+    "B3": ("cprndNrdmpBlce.json", "periodic"), "B4": ("srtpdPsndbtNrdmpBlce.json", "periodic"),
+    "B5": ("entrprsBilScritsNrdmpBlce.json", "periodic"), "B6": ("detScritsIsuAcmslt.json", "periodic"),
+    "B7": ("prvsrpCptalUseDtls.json", "periodic"), "B8": ("pssrpCptalUseDtls.json", "periodic"),
+    "B9": ("drctrAdtAllMendngSttusGmtsckConfmAmount.json", "periodic"),
+    "B10": ("drctrAdtAllMendngSttusMendngPymntamtTyCl.json", "periodic"),
+    "B11": ("stockTotqySttus.json", "periodic"), "B12": ("accnutAdtorNmNdAdtOpinion.json", "periodic"),
+    "B13": ("adtServcCnclsSttus.json", "periodic"), "B14": ("accnutAdtorNonAdtServcCnclsSttus.json", "periodic"),
+    "B15": ("outcmpnyDrctrNdChangeSttus.json", "periodic"), "B16": ("newCaplScritsNrdmpBlce.json", "periodic"),
+    "B17": ("irdsSttus.json", "periodic"), "B18": ("alotMatter.json", "periodic"),
+    "B19": ("tesstkAcqsDspsSttus.json", "periodic"), "B20": ("hyslrSttus.json", "periodic"),
+    "B21": ("hyslrChgSttus.json", "periodic"), "B22": ("mrhlSttus.json", "periodic"),
+    "B23": ("exctvSttus.json", "periodic"), "B24": ("empSttus.json", "periodic"),
+    "B25": ("hmvAuditIndvdlBySttus.json", "periodic"), "B26": ("hmvAuditAllSttus.json", "periodic"),
+    "B27": ("indvdlByPay.json", "periodic"), "B28": ("otrCprInvstmntSttus.json", "periodic"),
+    "C1": ("fnlttSinglAcnt.json", "periodic"), "C2": ("fnlttMultiAcnt.json", "periodic"),
+    "C4": ("fnlttSinglAcntAll.json", "periodic"), "C5": ("xbrlTaxonomy.json", "taxonomy"),
+    "D1": ("majorstock.json", "company"), "D2": ("elestock.json", "company"),
+    "E1": ("dfOcr.json", "event"), "E2": ("bsnSp.json", "event"), "E3": ("ctrcvsBgrq.json", "event"),
+    "E4": ("dsRsOcr.json", "event"), "E5": ("piicDecsn.json", "event"), "E6": ("fricDecsn.json", "event"),
+    "E7": ("pifricDecsn.json", "event"), "E8": ("crDecsn.json", "event"), "E9": ("bnkMngtPcbg.json", "event"),
+    "E10": ("lwstLg.json", "event"), "E11": ("ovLstDecsn.json", "event"), "E12": ("ovDlstDecsn.json", "event"),
+    "E13": ("ovLst.json", "event"), "E14": ("ovDlst.json", "event"), "E15": ("cvbdIsDecsn.json", "event"),
+    "E16": ("bdwtIsDecsn.json", "event"), "E17": ("exbdIsDecsn.json", "event"), "E18": ("bnkMngtPcsp.json", "event"),
+    "E19": ("wdCocobdIsDecsn.json", "event"), "E20": ("astInhtrfEtcPtbkOpt.json", "event"),
+    "E21": ("otcprStkInvscrTrfDecsn.json", "event"), "E22": ("tgastTrfDecsn.json", "event"),
+    "E23": ("tgastInhDecsn.json", "event"), "E24": ("otcprStkInvscrInhDecsn.json", "event"),
+    "E25": ("bsnTrfDecsn.json", "event"), "E26": ("bsnInhDecsn.json", "event"),
+    "E27": ("tsstkAqTrctrCcDecsn.json", "event"), "E28": ("tsstkAqTrctrCnsDecsn.json", "event"),
+    "E29": ("tsstkDpDecsn.json", "event"), "E30": ("tsstkAqDecsn.json", "event"), "E31": ("stkExtrDecsn.json", "event"),
+    "E32": ("cmpDvmgDecsn.json", "event"), "E33": ("cmpDvDecsn.json", "event"), "E34": ("cmpMgDecsn.json", "event"),
+    "E35": ("stkrtbdInhDecsn.json", "event"), "E36": ("stkrtbdTrfDecsn.json", "event"),
+    "F1": ("extrRs.json", "event"), "F2": ("mgRs.json", "event"), "F3": ("stkdpRs.json", "event"),
+    "F4": ("bdRs.json", "event"), "F5": ("estkRs.json", "event"), "F6": ("dvRs.json", "event"),
+}
+
+# Envelope fields of every response, not data columns
+_ENVELOPE_FIELDS:frozenset = frozenset(["status", "message", "page_no", "page_count", "total_count", "total_page", "title"])
+_NUMBER_WORDS:tuple = ("금액", "가액", "잔액", "보수", "주식수", "주식 수", "비율", "지분율", "인원", "총수", "수량", "(원)", "(주)", "(%)")
+_NUMBER_SUFFIXES:tuple = ("_amount", "_am", "_amt", "_co", "_cnt", "_qy", "_rt", "_prc", "_tota", "_sm")
+
+class DartField(object):
+    __slots__ = ("name", "description", "dtype")
+
+    def __init__(self, name:str, description:str, dtype:str):
+        self.name = name
+        self.description = description
+        self.dtype = dtype
+
+
+class DartEndpoint(object):
+    __slots__ = ("code", "title", "path", "kind", "fields")
+
+    def __init__(self, code:str, title:str, path:str, kind:str, fields:dict):
+        self.code = code
+        self.title = title
+        self.path = path
+        self.kind = kind
+        self.fields = fields
+
+
+def infer_field_type(name:str, description:str) -> str:
+    """Column type of a response field, from its name and description: string, number or date."""
+    if name in ("rcept_no", "corp_code", "stock_code", "bsns_year", "reprt_code") or name.endswith(("_code", "_no")):
+        return "string"
+    if name.endswith(("_de", "_dt")) or "일자" in description or "YYYYMMDD" in description:
+        return "date"
+    if name.endswith(_NUMBER_SUFFIXES) or any(word in description for word in _NUMBER_WORDS):
+        return "number"
+    return "string"
+
+def _collect_fields(node, fields:dict) -> None:
+    if isinstance(node, dict):
+        for name, value in node.items():
+            if isinstance(value, str):
+                if name not in _ENVELOPE_FIELDS:
+                    fields.setdefault(name, DartField(name, value, infer_field_type(name, value)))
+            else:
+                _collect_fields(value, fields)
+    elif isinstance(node, list):
+        for item in node:
+            _collect_fields(item, fields)
+
+@lru_cache(maxsize=4)
+def load_dart_spec(spec_path:str=os.path.join('Resource', 'api_code.json')) -> dict:
+    """
+    Compile Resource/api_code.json into {api code: DartEndpoint}, with the typed fields of each response.
+    Parsed once per process.
+    """
+    with open(spec_path, 'r', encoding='utf-8') as f:
+        spec = json.load(f)
+    endpoints = {}
+    for entry in spec:
+        code = entry.get('code')
+        if code not in DART_ENDPOINTS:
+            # Entries without a code or a json endpoint (A4 is a zip of xml) can't be fetched as frames
+            continue
+        fields = {}
+        _collect_fields(entry['response'], fields)
+        path, kind = DART_ENDPOINTS[code]
+        endpoints[code] = DartEndpoint(code, entry['title'], path, kind, fields)
+    return endpoints
+
+class DartDataEngine(object):
+    """
+    Fetches DART endpoints into typed DataFrames, cached as Parquet.
+
+    Requests go over one pooled session under the dart upstream's deadline, hedging and circuit breaker, without
+    retries of their own. Responses are typed by the compiled field index: numbers
+    lose their thousands separators, dates are parsed, codes stay strings so leading zeros survive. Frames are
+    stored partitioned as api_code=/corp_code=/year=/reprt_code=/data.parquet under cache_dir, and a repeated
+    query for the same partition is read from disk. Partitions that can still change, the current year's,
+    company level ones and empty results (a report not filed yet), are refetched once older than live_ttl
+    seconds. Paged endpoints are fetched through their last page before being cached.
+    """
+    def __init__(self, api_key:str=None, cache_dir:str=os.path.join('Resource', 'cache', 'dart'),
+                 spec_path:str=os.path.join('Resource', 'api_code.json'),
+                 live_ttl:float=float(os.getenv('DART_LIVE_TTL') or 6 * 3600), max_pages:int=50):
+        self.api_key = api_key or os.getenv('DART_API_KEY')
+        self.cache_dir = cache_dir
+        self.live_ttl = live_ttl
+        self.max_pages = max_pages
+        self.endpoints = load_dart_spec(spec_path)
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+
+    def endpoint(self, code:str) -> DartEndpoint:
+        if code not in self.endpoints:
+            raise ValueError(f"Unknown or unsupported DART api code: {code}")
+        return self.endpoints[code]
+
+    def request_params(self, endpoint:DartEndpoint, corp_code:str, year:int=None, report_code:str="11011", **extra) -> dict:
+        params = {"crtfc_key": self.api_key, "corp_code": corp_code}
+        if endpoint.kind == "periodic":
+            params.update({"bsns_year": str(year), "reprt_code": report_code})
+            if endpoint.code == "C4":
+                params.setdefault("fs_div", extra.pop("fs_div", "CFS"))
+        elif endpoint.kind == "event":
+            params.update({"bgn_de": f"{year}0101", "end_de": f"{year}1231"})
+            if endpoint.code == "A1":
+                params["page_count"] = 100
+        elif endpoint.kind == "taxonomy":
+            params = {"crtfc_key": self.api_key, "sj_div": extra.pop("sj_div", "BS1")}
+        params.update(extra)
+        return params
+
+    def partition_path(self, code:str, corp_code:str, year:int=None, report_code:str=None) -> str:
+        return os.path.join(self.cache_dir, f"api_code={code}", f"corp_code={corp_code or 'all'}",
+                            f"year={year or 'all'}", f"reprt_code={report_code or 'all'}", "data.parquet")
+
+    @staticmethod
+    def _rows(data:dict) -> list[dict]:
+        if "list" in data:
+            return data["list"]
+        if "group" in data:
+            # Registration statements come as titled groups of rows
+            return [{"group": group.get("title"), **row} for group in data["group"] for row in group.get("list", [])]
+        return [{name: value for name, value in data.items() if name not in _ENVELOPE_FIELDS}]
+
+    def to_frame(self, endpoint:DartEndpoint, rows:list[dict]) -> pd.DataFrame:
+        frame = pd.DataFrame(rows)
+        for name, field in endpoint.fields.items():
+            if name not in frame.columns:
+                frame[name] = pd.Series([pd.NA] * len(frame), dtype="string")
+            frame[name] = self._convert(frame[name], field.dtype)
+        for name in frame.columns.difference(list(endpoint.fields)):
+            frame[name] = frame[name].astype("string")
+        return frame
+
+    @staticmethod
+    def _convert(column:pd.Series, dtype:str) -> pd.Series:
+        text = column.astype("string").str.strip()
+        text = text.mask(text.isin(["", "-", "－"]))
+        present = text.notna().sum()
+        if dtype == "number":
+            number = pd.to_numeric(text.str.replace(",", "", regex=False), errors='coerce')
+            # Descriptions are only a hint, a column that does not parse as numbers stays text
+            if number.notna().sum() >= 0.9 * present:
+                return number.astype("Float64")
+        elif dtype == "date":
+            digits = text.str.replace(r"\D", "", regex=True)
+            date = pd.to_datetime(digits.where(digits.str.len() == 8), format="%Y%m%d", errors='coerce')
+            if date.notna().sum() >= 0.9 * present:
+                return date
+        return text
+
+    def is_live(self, endpoint:DartEndpoint, year:int, frame:pd.DataFrame) -> bool:
+        """Whether a cached partition can still change: empty, company level, or of the current year or later."""
+        if endpoint.kind == "taxonomy":
+            return False
+        return frame.empty or endpoint.kind == "company" or year is None or int(year) >= datetime.date.today().year
+
+    def _get(self, path:str, params:dict) -> requests.Response:
+        response = self.session.get(DART_BASE_URL + path, timeout=30, params=params)
+        # Raised inside the resilience call, so 5xx and 429 answers count against the breaker
+        response.raise_for_status()
+        return response
+
+    def _request(self, endpoint:DartEndpoint, params:dict) -> dict:
+        data = get_resilience().call("dart", self._get, endpoint.path, params).json()
+        status = data.get("status")
+        if status not in ("000", "013"):
+            raise RuntimeError(f"DART error {status}: {data.get('message')}")
+        return data
+
+    def fetch(self, code:str, corp_code:str, year:int=None, report_code:str="11011", refresh:bool=False, **extra) -> pd.DataFrame:
+        """
+        DataFrame of one api code for a company and period, from the Parquet cache unless refresh is set or
+        the cached partition is live and older than live_ttl.
+        Raises RuntimeError on a DART error status other than no data.
+        """
+        endpoint = self.endpoint(code)
+        partition_report = report_code if endpoint.kind == "periodic" else None
+        path = self.partition_path(code, corp_code, year if endpoint.kind != "company" else None, partition_report)
+        if not extra and not refresh and os.path.exists(path):
+            frame = pd.read_parquet(path)
+            if not self.is_live(endpoint, year, frame) or time.time() - os.path.getmtime(path) < self.live_ttl:
+                return frame
+
+        params = self.request_params(endpoint, corp_code, year, report_code, **extra)
+        data = self._request(endpoint, params)
+        rows = self._rows(data) if data.get("status") == "000" else []
+        if "page_no" not in extra:
+            # A paged list is cached whole, never as its first page
+            last_page = int(data.get("total_page") or 1)
+            if last_page > self.max_pages:
+                print(f"DART {code} for {corp_code} has {last_page} pages, keeping the first {self.max_pages}")
+                last_page = self.max_pages
+            for page in range(2, last_page + 1):
+                page_data = self._request(endpoint, {**params, "page_no": page})
+                if page_data.get("status") == "000":
+                    rows += self._rows(page_data)
+        frame = self.to_frame(endpoint, rows)
+
+        if not extra:
+            # Queries with extra parameters are not cached, they don't fit the partition key
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            frame.to_parquet(path + '.tmp', index=False)
+            os.replace(path + '.tmp', path)
+        return frame
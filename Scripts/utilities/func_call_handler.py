@@ -1,40 +1,70 @@
 import os
 import subprocess
 import requests
-import yaml
+from requests.adapters import HTTPAdapter
 import json
+import datetime
+import asyncio
+import inspect
+import threading
+import unicodedata
 import tiktoken
+from concurrent.futures import Future, ThreadPoolExecutor
 from openai import OpenAI
-from bs4 import BeautifulSoup
 from youtube_transcript_api import YouTubeTranscriptApi
 from IPython.core.interactiveshell import InteractiveShell
 
 from Scripts.utilities.func_call_logics import *
+from Scripts.utilities.result_store import ResultStore
+from Scripts.utilities.model_router import get_router
+from Scripts.utilities.http_cache import get_http_cache
+from Scripts.utilities.image_pipeline import ImagePipeline
+from Scripts.utilities.resilience import get_resilience
 
 class FunctionCallHandler(object):
+    MAX_SEARCH_QUERIES:int = 6
+    # Read only tools whose identical calls in flight at the same time share one execution
+    SINGLE_FLIGHT_TOOLS:frozenset = frozenset(["search_online", "get_weather", "youtube_transcript", "crawl_from_url", "read_result"])
+
     def __init__(self):
         self.encoder = tiktoken.encoding_for_model("gpt-4")
         self.shell = InteractiveShell.instance()
         self.openai_client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+        self.router = get_router()
+        self.http_cache = get_http_cache()
+        self.resilience = get_resilience()
+        self.image_pipeline = ImagePipeline(self.openai_client)
+        self.weather_cache = {}
+        self._weather_lock = threading.Lock()
+        self.result_store = ResultStore(self.encoder)
+        self.serpapi_token_budget = int(os.getenv('SERPAPI_TOKEN_BUDGET') or 1500)
+        self.search_concurrency = int(os.getenv('SEARCH_MAX_CONCURRENCY') or 4)
+        self.search_executor = ThreadPoolExecutor(max_workers=self.search_concurrency, thread_name_prefix="search")
+        self.search_session = requests.Session()
+        self.search_session.mount("https://", HTTPAdapter(pool_maxsize=self.search_concurrency))
+        self.tool_executor = ThreadPoolExecutor(max_workers=int(os.getenv('TOOL_MAX_CONCURRENCY') or 8), thread_name_prefix="tool")
+        self._inflight:dict = {}
+        self._inflight_lock = threading.Lock()
         self.tool_list = [
             {
                 "type": "function",
                 "function": {
                     "name": "search_online",
-                    "description": "Search on web the search_keyword, used for when user ask something that you do not know. The function will return an answer for the question that you passed on with the search_keyword, to save token.",
+                    "description": "Search on web the search_keywords, used for when user ask something that you do not know. The function will return an answer for the question that you passed on with the search_keywords, to save token. For comparative or multi-part questions, pass every query in one call, they are searched at the same time.",
                     "parameters": {
                         "type": "object",
                         "properties": {
-                            "search_keyword": {
-                                "type": "string",
-                                "description": "string to search"
+                            "search_keywords": {
+                                "type": "array",
+                                "items": {"type": "string"},
+                                "description": "Strings to search, one per part of the question. Example: [\"iPhone 15 battery life\", \"Galaxy S24 battery life\"]"
                             },
                             "question": {
                                 "type": "string",
                                 "description": "Question to ask regarding the search result"
                             }
                         },
-                        "required": ["search_keyword", "question"]
+                        "required": ["search_keywords", "question"]
                     }
                 }
             },
@@ -76,20 +106,21 @@ class FunctionCallHandler(object):
                 "type": "function",
                 "function": {
                     "name": "get_weather",
-                    "description": "Retrieve weather data from location using OpenMetro.",
+                    "description": "Retrieve weather data from one or more locations using OpenMetro. When comparing several places, pass all of them in one call.",
                     "parameters": {
                         "type": "object",
                         "properties": {
-                            "location": {
-                                "type": "string",
-                                "description": "Location to retrieve information from. Example query: New York"
+                            "locations": {
+                                "type": "array",
+                                "items": {"type": "string"},
+                                "description": "Locations to retrieve information from. Example query: [\"New York\", \"Seoul\"]"
                             },
                             "state": {
                                 "type": "string",
                                 "description": "State of the weather data to retrieve. Must be either 'current' or 'forecast'. Default to 'current'"
                             }
                         },
-                        "required": ["location"]
+                        "required": ["locations"]
                     }
                 }
             },
@@ -155,6 +186,31 @@ class FunctionCallHandler(object):
                         "required": ["prompt"]
                     }
                 }
+            },
+            {
+                "type": "function",
+                "function": {
+                    "name": "read_result",
+                    "description": "Read a page of a large tool result that was truncated and stored under a handle.",
+                    "parameters": {
+                        "type": "object",
+                        "properties": {
+                            "handle": {
+                                "type": "string",
+                                "description": "Handle given in the truncated tool result, e.g. res_0123456789"
+                            },
+                            "offset": {
+                                "type": "integer",
+                                "description": "Character offset to start reading from"
+                            },
+                            "length": {
+                                "type": "integer",
+                                "description": "Number of characters to read, at most 8000. Default to 4000"
+                            }
+                        },
+                        "required": ["handle", "offset"]
+                    }
+                }
             }
         ]
 
@@ -165,32 +221,58 @@ class FunctionCallHandler(object):
         result = subprocess.run(script, shell=True, capture_output=True, text=True)
         return str(result)
 
-    def get_weather(self, location:str, state:str="current") -> str:
-        coordinate = get_city_coordinates(location)
-        if state == "current":
-            weather = get_weather(coordinate, state)
-            weather = concat_current_weather(weather)
-            return json.dumps(weather, ensure_ascii=False)
-        elif state == "forecast":
-            weather = get_weather(coordinate, state)
-            weather = convert_to_dataframe(weather)
-            summary = summarize_weather(weather)
-            return json.dumps(summary, ensure_ascii=False)
-        else:
+    def get_weather(self, locations:list[str]=None, state:str="current", location:str=None) -> str:
+        if state not in ("current", "forecast"):
             raise ValueError("Invalid state, must be either 'current' or 'forecast'")
+        if isinstance(locations, str):
+            locations = [locations]
+        locations = list(dict.fromkeys((locations or []) + ([location] if location else [])))
+        if not locations:
+            raise ValueError("At least one location is required")
+
+        coordinates = {name: get_city_coordinates(name) for name in locations}
+        result = {name: "Location not found" for name, coordinate in coordinates.items() if coordinate is None}
+        found = [name for name in locations if coordinates[name] is not None]
 
+        # Results are cached per rounded coordinate until open-meteo's next hourly model run
+        run_hour = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H")
+        keys = {name: (round(coordinates[name][0], 2), round(coordinates[name][1], 2), state, run_hour) for name in found}
+        # Tools run concurrently, the cache is only touched under the lock and the turn reads from its own copy
+        with self._weather_lock:
+            cached = {keys[name]: self.weather_cache[keys[name]] for name in found if keys[name] in self.weather_cache}
+        missing = list(dict.fromkeys(keys[name] for name in found if keys[name] not in cached))
+        if missing:
+            weather, stale = get_weather_batch([key[:2] for key in missing], state)
+            fetched = dict(zip(missing, weather))
+            cached.update(fetched)
+            # A stale copy is good for this answer only, the next call tries open-meteo again
+            if not stale:
+                with self._weather_lock:
+                    for key in [key for key in self.weather_cache if key[3] != run_hour]:
+                        del self.weather_cache[key]
+                    self.weather_cache.update(fetched)
+        responses = [cached[keys[name]] for name in found]
+
+        if state == "current":
+            for name, weather in zip(found, responses):
+                result[name] = concat_current_weather(weather)
+        else:
+            summaries = summarize_weather_batch([weather['hourly'] for weather in responses],
+                                                utc_offsets=[weather.get('utc_offset_seconds', 0) for weather in responses])
+            result.update(zip(found, summaries))
+        return json.dumps({name: result[name] for name in locations}, ensure_ascii=False)
 
     def youtube_transcript(self, id):
         try:
             language_list = ['en', 'ko', 'jp', 'zh-Hans', 'zh-Hant', 'fr', 'es', 'ru', 'de', 'pt', 'it', 'ar', 'tr', ]
-            transcript = YouTubeTranscriptApi.get_transcript(id, languages=language_list)
+            transcript = self.resilience.call("youtube", YouTubeTranscriptApi.get_transcript, id, languages=language_list)
             _concat_str = ''.join([element['text'] for element in transcript])
 
             vid_token_count = len(self.encoder.encode(_concat_str))
             if vid_token_count < 30000:
                 return _concat_str
             elif (vid_token_count >= 300000) and (vid_token_count < 60000):
-                # Summarize video using gpt-4-turbo-preview model
+                # Summarize video using the tool_post route model
                 _summary_dialogue = [
                     {
                         "role": "system",
@@ -201,10 +283,7 @@ class FunctionCallHandler(object):
                         "content": _concat_str
                     }
                 ]
-                response = self.openai_client.chat.completions.create(
-                    model="gpt-4-turbo-preview",
-                    messages=_summary_dialogue
-                )
+                response = self.router.create(self.openai_client, "tool_post", messages=_summary_dialogue)
                 summary = response.choices[0].message.content
                 return summary
             else:
@@ -212,39 +291,47 @@ class FunctionCallHandler(object):
         except Exception as e:
             return f"Unable to get transcript: {str(e)}"
 
-    def search_online(self, search_keyword, question):
-
-        # SerpAPI endpoint
-        serpapi_endpoint = "https://serpapi.com/search"
-        serpapi_key = os.getenv("SERPAPI_API_KEY")
-
+    def serpapi_search(self, search_keyword:str) -> dict:
         # Parameters for SerpAPI
         serpapi_params = {
             "q": search_keyword,
-            "api_key": serpapi_key,
+            "api_key": os.getenv("SERPAPI_API_KEY"),
             "engine": "google",
             "location": "Seoul, South Korea",
         }
+        try:
+            response = self.resilience.call("serpapi", self.search_session.get, "https://serpapi.com/search",
+                                            params=serpapi_params, timeout=self.resilience.upstream("serpapi").deadline)
+            return response.json()
+        except Exception as e:
+            # One failed query should not lose the results of the others
+            return {"error": str(e)}
 
-        # Make the request to SerpAPI
-        response = requests.get(serpapi_endpoint, params=serpapi_params)
-        serpapi_results = response.json()
+    def search_online(self, search_keywords:list[str]=None, question:str=None, search_keyword:str=None) -> str:
+        if isinstance(search_keywords, str):
+            search_keywords = [search_keywords]
+        queries = list(dict.fromkeys(q.strip() for q in (search_keywords or []) + ([search_keyword] if search_keyword else []) if q.strip()))
+        if not queries:
+            raise ValueError("At least one search keyword is required")
+        queries = queries[:self.MAX_SEARCH_QUERIES]
 
-        # Process the SerpAPI results (optional preprocessing step)
-        processed_results = yaml.dump(preprocess_serpapi_results(serpapi_results), allow_unicode=True,
-                                      default_flow_style=False, sort_keys=False)
+        # All queries are searched at the same time, at most search_concurrency at once
+        results_list = list(self.search_executor.map(self.serpapi_search, queries))
+        if all('error' in results for results in results_list):
+            # Degraded answer, so the model answers without search instead of calling it again
+            return f"Search is unavailable right now ({results_list[0]['error']}). Answer from what you know and tell the user the search failed."
 
-        # Prepare the prompt for GPT
-        prompt = f"Based on the following search results for the query '{search_keyword}':\n{processed_results}\n\nAnswer the question: {question}.\nALWAYS Annotate your response with proper url in markdown format."
+        # Merge, dedupe and compact the results into one token budgeted text. The budget grows with the queries up to 3x
+        token_budget = self.serpapi_token_budget * min(len(queries), 3)
+        processed_results = compact_serpapi_fanout(queries, results_list, self.encoder, token_budget)
 
-        # Make the request to OpenAI GPT using chat.completions.create
-        gpt_response = self.openai_client.chat.completions.create(
-            model="gpt-4-turbo-preview",
-            messages=[{"role": "system", "content": prompt}]
-        )
+        # Prepare the prompt for GPT
+        query_list = ", ".join(f"'{q}'" for q in queries)
+        prompt = f"Based on the following search results for the {'queries' if len(queries) > 1 else 'query'} {query_list}:\n{processed_results}\n\nAnswer the question: {question}.\nALWAYS Annotate your response with proper url in markdown format."
 
-        # Extracting and returning the answer from the response
-        answer = gpt_response.choices[0].message.content
+        # Identical results and question give the same answer, so it is cached for a few hours
+        answer = self.router.complete(self.openai_client, "tool_post", cache_ttl=6 * 3600,
+                                      messages=[{"role": "system", "content": prompt}])
         return answer
 
     def execute_custom_code(self, code_str):
@@ -274,17 +361,13 @@ class FunctionCallHandler(object):
         # driver = webdriver.Chrome(service=Service(ChromeDriverManager().install()), options=options)
 
         try:
-            # Send a GET request to the URL
-            response = requests.get(url)
+            # Send a GET request to the URL through the http cache, which also keeps the extracted text,
+            # so a page that is still fresh or revalidates with 304 is neither downloaded nor parsed again
+            response = self.http_cache.fetch(url, parse=html_to_text)
             # Check if the request was successful
             if response.status_code != 200:
                 return f"Error fetching the page: Status code {response.status_code}"
-            # Parse the content of the page using BeautifulSoup
-            soup = BeautifulSoup(response.text, 'html.parser')
-            # Extract all text from the page
-            text = soup.get_text()
-            # Optional: Clean up the text by removing extra spaces, newlines, etc.
-            text = ' '.join(text.split())
+            text = response.parsed
 
             # driver.get(url)
             # time.sleep(5)  # Wait for JavaScript content to load
@@ -309,12 +392,7 @@ class FunctionCallHandler(object):
                 }
             ]
 
-            response = self.openai_client.chat.completions.create(
-                model="gpt-4-turbo-preview",
-                messages=_summary_dialogue
-            )
-
-            return response.choices[0].message.content
+            return self.router.complete(self.openai_client, "tool_post", cache_ttl=24 * 3600, messages=_summary_dialogue)
 
         except Exception as e:
             return f"An error occurred: {e}"
@@ -323,17 +401,75 @@ class FunctionCallHandler(object):
         #     driver.quit()
 
     def draw_image(self, prompt, size="1024x1024", style="vivid"):
-        image = self.openai_client.images.generate(
-            model="dall-e-3",
-            prompt=prompt,
-            n=1,
-            size=size,
-            style=style,
-            response_format= "b64_json"
-        )
-        return {"response_text": "Image sucessfully created and is being displayed to user.", "data": { "name": "draw_image", "prompt": image.data[0].revised_prompt[:200], "b64_image": image.data[0].b64_json}}
+        return self.image_result(self.image_pipeline.generate_blocking(prompt, size=size, style=style))
+
+    def image_result(self, artifact:dict) -> dict:
+        return {"response_text": "Image sucessfully created and is being displayed to user.",
+                "data": {"name": "draw_image", "prompt": artifact["revised_prompt"][:200], "image_path": artifact["path"]}}
+
+    def read_result(self, handle:str, offset:int=0, length:int=4000) -> str:
+        return self.result_store.read(handle, offset, length)
+
+    def run_tool(self, name, arg):
+        result = self.dispatch_function(name, arg)
+        if isinstance(result, str) and name != "read_result":
+            # Large results are kept out of the dialogue, the model pages through them with read_result
+            return self.result_store.digest(name, result)
+        return result
+
+    def call_key(self, name:str, arg:dict) -> str:
+        """
+        Key of a tool call for single flight: the arguments bound to the tool's signature with its defaults applied,
+        and strings NFKC normalized with their spacing collapsed.
+        """
+        def normalize(value):
+            if isinstance(value, str):
+                return " ".join(unicodedata.normalize('NFKC', value).split())
+            if isinstance(value, (list, tuple)):
+                return [normalize(item) for item in value]
+            if isinstance(value, dict):
+                return {k: normalize(v) for k, v in value.items()}
+            return value
+        try:
+            bound = inspect.signature(getattr(self, name)).bind(**arg)
+            bound.apply_defaults()
+            arg = bound.arguments
+        except TypeError:
+            # Invalid arguments fail in the tool itself, key them as given
+            pass
+        return json.dumps([name, normalize(arg)], ensure_ascii=False, sort_keys=True, default=str)
+
+    def submit_tool(self, name, arg) -> Future:
+        """
+        Run a tool on the tool workers. A call identical to one already in flight gets that call's future
+        instead of a new execution, so every waiter shares its result.
+        """
+        key = self.call_key(name, arg)
+        with self._inflight_lock:
+            future = self._inflight.get(key)
+            if future is None:
+                future = self.tool_executor.submit(self.run_tool, name, arg)
+                self._inflight[key] = future
+                future.add_done_callback(lambda _: self._inflight.pop(key, None))
+            return future
 
     def function_call_handler(self, name, arg):
+        if name in self.SINGLE_FLIGHT_TOOLS:
+            return self.submit_tool(name, arg).result()
+        return self.run_tool(name, arg)
+
+    async def async_function_call_handler(self, name, arg):
+        """
+        function_call_handler for the event loop. Image generation runs on the image pipeline's own workers and
+        single flight tools on the tool workers, instead of blocking the loop.
+        """
+        if name == "draw_image":
+            return self.image_result(await self.image_pipeline.generate(**arg))
+        if name in self.SINGLE_FLIGHT_TOOLS:
+            return await asyncio.wrap_future(self.submit_tool(name, arg))
+        return self.run_tool(name, arg)
+
+    def dispatch_function(self, name, arg):
         if name == "search_online":
             return self.search_online(**arg)
         elif name == "execute_custom_code":
@@ -348,10 +484,12 @@ class FunctionCallHandler(object):
             return self.crawl_from_url(**arg)
         elif name == "draw_image":
             return self.draw_image(**arg)
+        elif name == "read_result":
+            return self.read_result(**arg)
         else:
             return f"Function {name} not found."
         
 if __name__ == '__main__':
     client = FunctionCallHandler()
-    # test get weather function with argument {"location":"Seoul"}
-    print(client.function_call_handler("get_weather", {"location":"Seoul", "state":"forecast"}))
\ No newline at end of file
+    # test get weather function with argument {"locations":["Seoul", "Busan"]}
+    print(client.function_call_handler("get_weather", {"locations":["Seoul", "Busan"], "state":"forecast"}))
\ No newline at end of file
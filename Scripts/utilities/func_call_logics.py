@@ -1,9 +1,16 @@
-import requests
+import threading
+import numpy as np
 import pandas as pd
+from itertools import zip_longest
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from bs4 import BeautifulSoup
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 from geopy.geocoders import Nominatim
-from geopy.exc import GeocoderTimedOut
+from geopy.exc import GeocoderTimedOut, GeocoderUnavailable, GeocoderRateLimited
+
+from Scripts.utilities.http_cache import get_http_cache
+from Scripts.utilities.resilience import get_resilience, UpstreamTimeout, UpstreamUnavailable
 
 def youtube_search(api_key:str, keyword:str, max_results:int=25) -> tuple[list[str]]:
     youtube = build('youtube', 'v3', developerKey=api_key)
@@ -35,71 +42,175 @@ def youtube_search(api_key:str, keyword:str, max_results:int=25) -> tuple[list[s
         print(f"An HTTP error {e.resp.status} occurred:\n{e.content}")
         return [], [], []
 
-def preprocess_serpapi_results(results: dict) -> dict:
-    if 'search_metadata' in results:
-        results.pop('search_metadata', None)
-    if "pagination" in results:
-        results.pop('pagination', None)
-    if "serpapi_pagination" in results:
-        results.pop('serpapi_pagination', None)
-    
-
-    # Process the answer_box if it exists
-    if 'answer_box' in results:
-        if results['answer_box']['type'] == 'weather_result':
-            keys_to_delete = ['thumbnail', 'hourly_forecast', 'precipitation_forecast', 'wind_forecast']
-            for key in keys_to_delete:
-                results['answer_box'].pop(key, None)
-            for item in results['answer_box']['forecast']:
-                item.pop('thumbnail', None)
-
-        if results['answer_box']['type'] == 'air_quality':
-            results['answer_box'].pop('indexes', None)
-    if 'related_questions' in results:
-        for item in results['related_questions']:
-            keys_to_delete = ['next_page_token', 'serpapi_link']
-            for key in keys_to_delete:
-                item.pop(key, None)
-    # Process knowledge_graph if it exists
-    if 'knowledge_graph' in results and 'description' in results['knowledge_graph']:
-        results['knowledge_graph_description'] = results['knowledge_graph']['description']
-
-    # Process organic_results if it exists
-    if 'organic_results' in results:
-        top5_results = results['organic_results'][:5]
-        for item in top5_results:
-            keys_to_delete = [
-                'displayed_link', 'thumbnail', 'favicon', 'snippet_highlighted_words',
-                'sitelinks', 'about_this_result', 'about_page_link', 'about_page_serpapi_link',
-                'related_pages_link', 'cached_page_link'
-            ]
-            for key in keys_to_delete:
-                item.pop(key, None)
-
-        results['organic_results_top5'] = top5_results
-
-    # Process top_stories if it exists
-    if 'top_stories' in results:
-        for item in results['top_stories']:
-            item.pop('thumbnail', None)
-
-    # Process news_results if it exists
-    if 'news_results' in results:
-        for item in results['news_results']:
-            item.pop('thumbnail', None)
-
-    # Process people_also_search_for if it exists
-    if 'people_also_search_for' in results:
-        for block in results['people_also_search_for']:
-            if 'news_results' in block and isinstance(block['news_results'], list):
-                for item in block['news_results']:
-                    item.pop('thumbnail', None)
-
-    if "related_searches" in results:
-        for item in results['related_searches']:
-            item.pop('serpapi_link', None)
-
-    return results
+SERPAPI_SKIP_KEYS:frozenset = frozenset(["thumbnail", "favicon", "serpapi_link", "next_page_token", "link_to_news", "source_logo",
+                                          "snippet_highlighted_words", "sitelinks", "about_this_result", "about_page_link",
+                                          "about_page_serpapi_link", "related_pages_link", "cached_page_link", "displayed_link",
+                                          "hourly_forecast", "precipitation_forecast", "wind_forecast", "indexes", "images"])
+
+def _compact_value(value, max_chars:int=300) -> str:
+    """
+    Render a SerpAPI value on a single line, keeping only scalar fields of nested objects.
+    """
+    if isinstance(value, dict):
+        parts = [f"{k}={_compact_value(v, max_chars)}" for k, v in value.items()
+                 if k not in SERPAPI_SKIP_KEYS and isinstance(v, (str, int, float))]
+        return "; ".join(parts)
+    if isinstance(value, list):
+        return ", ".join(_compact_value(v, max_chars) for v in value[:5] if isinstance(v, (str, int, float, dict)))
+    text = " ".join(str(value).split())
+    return text if len(text) <= max_chars else text[:max_chars] + "…"
+
+def _serpapi_sections(results:dict, max_organic:int=5) -> list[tuple[str, list[str]]]:
+    """
+    Split a SerpAPI payload into (section title, lines), ordered from most to least useful to answer a question.
+    """
+    sections = []
+    answer_box = results.get('answer_box')
+    if isinstance(answer_box, dict):
+        lines = [f"{k}: {_compact_value(v)}" for k, v in answer_box.items() if k not in SERPAPI_SKIP_KEYS and v]
+        sections.append(("answer", lines))
+    knowledge_graph = results.get('knowledge_graph')
+    if isinstance(knowledge_graph, dict):
+        lines = [f"{k}: {_compact_value(v)}" for k, v in knowledge_graph.items()
+                 if k not in SERPAPI_SKIP_KEYS and isinstance(v, (str, int, float))]
+        sections.append(("knowledge", lines))
+    organic = []
+    for item in results.get('organic_results', [])[:max_organic]:
+        fields = [item.get('title'), item.get('link'), item.get('date'), item.get('snippet')]
+        organic.append(f"{item.get('position', len(organic) + 1)}. " + " | ".join(_compact_value(f) for f in fields if f))
+    sections.append(("organic", organic))
+    for key, title in (('top_stories', "stories"), ('news_results', "news")):
+        lines = [" | ".join(_compact_value(item.get(f)) for f in ('title', 'source', 'date', 'link') if item.get(f))
+                 for item in results.get(key, [])[:5] if isinstance(item, dict)]
+        sections.append((title, lines))
+    related_questions = []
+    for item in results.get('related_questions', [])[:4]:
+        answer = item.get('snippet') or item.get('answer') or ''
+        related_questions.append(f"Q: {_compact_value(item.get('question', ''))} A: {_compact_value(answer)} {item.get('link', '')}".strip())
+    sections.append(("related questions", related_questions))
+    related_searches = [_compact_value(item.get('query', '')) for item in results.get('related_searches', [])[:8]]
+    sections.append(("related searches", [", ".join(q for q in related_searches if q)] if related_searches else []))
+    return [(title, lines) for title, lines in sections if lines]
+
+def _pack_sections(sections:list[tuple[str, list[str]]], encoder, token_budget:int) -> str:
+    """
+    Join (section title, lines) in order, adding lines until the token budget is reached.
+    """
+    output = []
+    used = 0
+    for title, lines in sections:
+        header = f"# {title}"
+        header_tokens = len(encoder.encode(header)) + 1
+        if used + header_tokens >= token_budget:
+            break
+        section = [header]
+        section_tokens = header_tokens
+        for line in lines:
+            line_tokens = len(encoder.encode(line)) + 1
+            if used + section_tokens + line_tokens > token_budget:
+                break
+            section.append(line)
+            section_tokens += line_tokens
+        if len(section) == 1:
+            break
+        output.extend(section)
+        used += section_tokens
+        if len(section) - 1 < len(lines):
+            # Budget reached in the middle of this section
+            break
+    return "\n".join(output)
+
+def compact_serpapi_results(results:dict, encoder, token_budget:int=1500) -> str:
+    """
+    Serialize SerpAPI results into a compact line oriented text, most useful sections first.
+
+    Args:
+    - results (dict): Raw SerpAPI json response.
+    - encoder: tiktoken encoder used to measure the output.
+    - token_budget (int): Maximum number of tokens of the returned text. Lines are added until the budget is reached.
+
+    Returns:
+    - str: The compacted results.
+    """
+    if 'error' in results:
+        return f"error: {results['error']}"
+    return _pack_sections(_serpapi_sections(results), encoder, token_budget)
+
+TRACKING_PARAMS:tuple = ("utm_", "gclid", "fbclid", "msclkid", "ved", "ei", "sa", "usg")
+
+def canonical_url(url:str) -> str:
+    """
+    Key of a url for deduplication: lower case host without www, no fragment, tracking parameters or trailing slash,
+    and the remaining query parameters sorted.
+    """
+    parts = urlsplit(url.strip())
+    host = parts.netloc.lower()
+    if host.startswith("www."):
+        host = host[4:]
+    query = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if not k.lower().startswith(TRACKING_PARAMS))
+    return urlunsplit(("", host, parts.path.rstrip("/"), urlencode(query), ""))
+
+def _interleave(lists:list[list]) -> list:
+    """Round robin over the lists, so every query's best results come before anyone's worst."""
+    return [item for group in zip_longest(*lists) for item in group if item is not None]
+
+def _dedupe(items:list, key) -> list:
+    seen = set()
+    unique = []
+    for item in items:
+        k = key(item)
+        if k and k in seen:
+            continue
+        seen.add(k)
+        unique.append(item)
+    return unique
+
+def compact_serpapi_fanout(queries:list[str], results_list:list[dict], encoder, token_budget:int=1500, max_organic:int=5) -> str:
+    """
+    Merge the SerpAPI results of several queries into one compact text within the token budget.
+
+    Answer boxes and knowledge graphs are kept per query. Organic results, news, related questions and searches
+    are interleaved across queries and deduplicated, organic results and news by canonical url.
+
+    Args:
+    - queries (list[str]): The queries, in the order of results_list.
+    - results_list (list[dict]): Raw SerpAPI json response of each query.
+    - encoder: tiktoken encoder used to measure the output.
+    - token_budget (int): Maximum number of tokens of the returned text.
+    - max_organic (int): Organic results kept per query.
+
+    Returns:
+    - str: The compacted results.
+    """
+    if len(results_list) == 1:
+        return compact_serpapi_results(results_list[0], encoder, token_budget)
+    sections = []
+    for query, results in zip(queries, results_list):
+        if 'error' in results:
+            sections.append((f"error: {query}", [_compact_value(results['error'])]))
+            continue
+        direct = {key: results[key] for key in ('answer_box', 'knowledge_graph') if key in results}
+        sections.extend((f"{title}: {query}", lines) for title, lines in _serpapi_sections(direct) if title in ("answer", "knowledge"))
+
+    valid = [results for results in results_list if 'error' not in results]
+    link_key = lambda item: canonical_url(item.get('link') or '') if isinstance(item, dict) else None
+    organic = _dedupe(_interleave([results.get('organic_results', [])[:max_organic] for results in valid]), link_key)
+    merged = {
+        'organic_results': [{**item, 'position': position} for position, item in enumerate(organic, 1)],
+        'top_stories': _dedupe(_interleave([results.get('top_stories', []) for results in valid]), link_key),
+        'news_results': _dedupe(_interleave([results.get('news_results', []) for results in valid]), link_key),
+        'related_questions': _dedupe(_interleave([results.get('related_questions', []) for results in valid]),
+                                     lambda item: item.get('question')),
+        'related_searches': _dedupe(_interleave([results.get('related_searches', []) for results in valid]),
+                                    lambda item: item.get('query')),
+    }
+    sections.extend(_serpapi_sections(merged, max_organic=len(organic)))
+    return _pack_sections(sections, encoder, token_budget)
+
+# Coordinates of cities found so far. Misses and errors are not kept, a timeout is retried on the next call.
+_city_coordinates:dict = {}
+_city_coordinates_lock = threading.Lock()
+CITY_COORDINATES_MAX:int = 256
 
 def get_city_coordinates(city_name:str="Seoul", user_agent:str="MyUniqueProjectGeocoder") -> tuple[float]:
     """
@@ -112,64 +223,111 @@ def get_city_coordinates(city_name:str="Seoul", user_agent:str="MyUniqueProjectG
     Returns:
     - tuple: A tuple containing the latitude and longitude of the city, or None if not found.
     """
+    if city_name in _city_coordinates:
+        return _city_coordinates[city_name]
     # Initialize the Nominatim geocoder with a unique user-agent
     geolocator = Nominatim(user_agent=user_agent)
 
     try:
         # Attempt to geocode the given city name
-        location = geolocator.geocode(city_name)
+        location = get_resilience().call("nominatim", geolocator.geocode, city_name,
+                                         transient=(GeocoderTimedOut, GeocoderUnavailable, GeocoderRateLimited))
         if location:
+            with _city_coordinates_lock:
+                if len(_city_coordinates) >= CITY_COORDINATES_MAX:
+                    del _city_coordinates[next(iter(_city_coordinates))]
+                _city_coordinates[city_name] = (location.latitude, location.longitude)
             return (location.latitude, location.longitude)
         else:
             return None
-    except GeocoderTimedOut:
+    except (GeocoderTimedOut, GeocoderUnavailable, GeocoderRateLimited, UpstreamTimeout, UpstreamUnavailable) as e:
+        # Not cached, so the city is looked up again once Nominatim answers
+        print(f"Could not geocode {city_name}: {e}")
         return None
 
-def get_weather(coordinate:tuple[float], state:str) -> dict:
-    current_weather_arg_list:frozenset = frozenset(["temperature_2m", "relative_humidity_2m", "apparent_temperature", "is_day", "precipitation", "rain", "showers", "snowfall", "cloud_cover", "pressure_msl"])
-    forecast_weather_arg_list:frozenset = frozenset(["temperature_2m", "relative_humidity_2m", "apparent_temperature", "precipitation_probability", "precipitation", "rain", "showers", "snowfall", "snow_depth", "cloud_cover", "visibility", "wind_speed_10m", "wind_speed_80m", "wind_direction_10m", "wind_direction_80m", "uv_index", "is_day"])
-    base_url:str = "https://api.open-meteo.com/v1/forecast?"
-    latitude, longitude = coordinate
+current_weather_arg_list:frozenset = frozenset(["temperature_2m", "relative_humidity_2m", "apparent_temperature", "is_day", "precipitation", "rain", "showers", "snowfall", "cloud_cover", "pressure_msl"])
+forecast_weather_arg_list:frozenset = frozenset(["temperature_2m", "relative_humidity_2m", "apparent_temperature", "precipitation_probability", "precipitation", "rain", "showers", "snowfall", "snow_depth", "cloud_cover", "visibility", "wind_speed_10m", "wind_speed_80m", "wind_direction_10m", "wind_direction_80m", "uv_index", "is_day"])
+weather_summary_aggregations:dict = {
+    "max_temp": ("temperature_2m", "max"),
+    "min_temp": ("temperature_2m", "min"),
+    "avg_temp": ("temperature_2m", "mean"),
+    "avg_humidity": ("relative_humidity_2m", "mean"),
+    "avg_precipitation": ("precipitation", "mean"),
+    "avg_cloud_cover": ("cloud_cover", "mean"),
+    "avg_wind_speed": ("wind_speed_10m", "mean")
+}
+
+def html_to_text(html:str) -> str:
+    """
+    Extract the visible text of a html page, with whitespace collapsed.
+    """
+    soup = BeautifulSoup(html, 'html.parser')
+    for element in soup(["script", "style", "noscript"]):
+        element.decompose()
+    return ' '.join(soup.get_text().split())
+
+def get_weather_batch(coordinates:list[tuple[float]], state:str) -> tuple[list[dict], bool]:
+    """
+    Retrieve weather data for several coordinates with a single open-meteo request.
+
+    Args:
+    - coordinates (list): List of (latitude, longitude) tuples.
+    - state (str): Either 'current' or 'forecast'.
+
+    Returns:
+    - tuple: One open-meteo response per coordinate, in the same order, and whether they are a stale copy
+      served while open-meteo could not be reached.
+    """
     if state == "current":
-        request_url = f"{base_url}latitude={latitude}&longitude={longitude}&current={','.join(current_weather_arg_list)}"
+        variables = {"current": ','.join(sorted(current_weather_arg_list))}
     elif state == "forecast":
-        request_url = f"{base_url}latitude={latitude}&longitude={longitude}&hourly={','.join(forecast_weather_arg_list)}"
+        variables = {"hourly": ','.join(sorted(forecast_weather_arg_list)), "timezone": "auto"}
     else:
         raise ValueError("Invalid state, must be either 'current' or 'forecast'")
-    response = requests.get(request_url)
-    return response.json()['hourly'] if state == "forecast" else response.json()
-
-def convert_to_dataframe(data:dict) -> pd.DataFrame:
-    _dataframe:pd.DataFrame = pd.DataFrame(data)
-    _dataframe.set_index('time', inplace=True)
-    return _dataframe
-
-def summarize_weather(data:pd.DataFrame, return_days:int = 3) -> dict:
-    """
-    Write a summary for each day in the weather data.
-    """
-    # This function will give: max temp, min temp, avg temp, avg humidity, avg precipitation, avg cloud cover, avg wind speed
-    # For each day in the data
-    summary:dict = {}
-    # Make sure the data index is a datetime object
-    data.index = pd.to_datetime(data.index)
-    # Group the data by day
-    grouped = data.groupby(data.index.date)
-    for day, day_data in grouped:
-        summary[day] = {
-            "max_temp": day_data['temperature_2m'].max(),
-            "min_temp": day_data['temperature_2m'].min(),
-            "avg_temp": day_data['temperature_2m'].mean(),
-            "avg_humidity": day_data['relative_humidity_2m'].mean(),
-            "avg_precipitation": day_data['precipitation'].mean(),
-            "avg_cloud_cover": day_data['cloud_cover'].mean(),
-            "avg_wind_speed": day_data['wind_speed_10m'].mean()
-        }
-    # round all values to 2 decimal places
-    for day, day_summary in summary.items():
-        for key, value in day_summary.items():
-            summary[day][key] = round(value, 2)
-    return {str(k): v for k, v in summary.items() if (k <= pd.Timestamp.now().date() + pd.Timedelta(days=return_days)) and (k > pd.Timestamp.now().date())}
+    params = {
+        "latitude": ','.join(f"{latitude:.4f}" for latitude, _ in coordinates),
+        "longitude": ','.join(f"{longitude:.4f}" for _, longitude in coordinates),
+        **variables
+    }
+    # open-meteo updates its models hourly at most, so a response is reused for 15 minutes
+    response = get_http_cache().fetch("https://api.open-meteo.com/v1/forecast", params=params, default_ttl=15 * 60)
+    response.raise_for_status()
+    data = response.json()
+    # open-meteo returns a single object for a single coordinate and a list otherwise
+    return (data if isinstance(data, list) else [data]), response.stale
+
+def summarize_weather_batch(hourly_list:list[dict], return_days:int = 3, utc_offsets:list[int] = None) -> list[dict]:
+    """
+    Summarize hourly forecasts of several locations per day, in one vectorized groupby.
+
+    Args:
+    - hourly_list (list): open-meteo 'hourly' objects, one per location.
+    - return_days (int): Number of days after today to summarize.
+    - utc_offsets (list): utc_offset_seconds of each location, used to decide each location's today. Defaults to 0.
+
+    Returns:
+    - list: For each location, a dict of date string to max/min/avg temperature, avg humidity, precipitation, cloud cover and wind speed.
+    """
+    lengths = np.array([len(hourly['time']) for hourly in hourly_list])
+    location = np.repeat(np.arange(len(hourly_list)), lengths)
+    columns = {column: np.concatenate([np.asarray(hourly[column], dtype=float) for hourly in hourly_list])
+               for column in {source for source, _ in weather_summary_aggregations.values()}}
+    day = pd.to_datetime(np.concatenate([np.asarray(hourly['time']) for hourly in hourly_list])).normalize()
+
+    # Today is computed once, then shifted per location by its utc offset
+    offsets = np.asarray(utc_offsets if utc_offsets is not None else [0] * len(hourly_list), dtype='timedelta64[s]')
+    now = np.datetime64(pd.Timestamp.now(tz='UTC').tz_localize(None), 's')
+    today = (now + offsets).astype('datetime64[D]')[location]
+    days_ahead = (day.to_numpy().astype('datetime64[D]') - today).astype(int)
+    mask = (days_ahead > 0) & (days_ahead <= return_days)
+
+    frame = pd.DataFrame({"location": location[mask], "day": day[mask], **{k: v[mask] for k, v in columns.items()}})
+    summary = frame.groupby(["location", "day"]).agg(**weather_summary_aggregations).round(2)
+
+    result = [{} for _ in hourly_list]
+    for (index, date), row in zip(summary.index, summary.to_dict('records')):
+        result[index][str(date.date())] = row
+    return result
 
 def concat_current_weather(weather:dict) -> dict:
     """
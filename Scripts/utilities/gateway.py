@@ -0,0 +1,408 @@
+"""
+Gateway/worker deployment mode.
+
+The gateway process holds the discord connection and forwards message events and slash commands
+over a unix socket to N worker processes, which run the Chatbot pipeline and its tools.
+Events of one channel always go to the same worker, so each conversation keeps its state.
+Workers never talk to discord: replies come back to the gateway as actions (send, edit, followup)
+that the gateway performs. A crashed worker is respawned, and a worker stuck on one event for longer
+than the event timeout is killed and respawned, without the gateway losing its connection. The users of
+the events it was running are told to try again.
+
+Frames are a 4 byte big endian length followed by a json object.
+"""
+import os
+import sys
+import json
+import uuid
+import time
+import types
+import asyncio
+import tempfile
+from collections import OrderedDict
+
+import discord
+from discord import app_commands
+from discord.ext import commands
+
+from Scripts.utilities.channel_routes import ChannelRoutes
+
+DEFAULT_SOCKET_PATH:str = os.path.join(tempfile.gettempdir(), 'gpt_on_discord_gateway.sock')
+
+async def send_frame(writer:asyncio.StreamWriter, frame:dict) -> None:
+    data = json.dumps(frame, ensure_ascii=False).encode('utf-8')
+    writer.write(len(data).to_bytes(4, 'big') + data)
+    await writer.drain()
+
+async def read_frame(reader:asyncio.StreamReader) -> dict:
+    header = await reader.readexactly(4)
+    return json.loads(await reader.readexactly(int.from_bytes(header, 'big')))
+
+
+class WorkerSlot(object):
+    def __init__(self, index:int):
+        self.index = index
+        self.queue:asyncio.Queue = asyncio.Queue()
+        self.writer:asyncio.StreamWriter = None
+        self.process:asyncio.subprocess.Process = None
+        # event_id: (monotonic start, event) of the events sent to the worker and not done yet
+        self.inflight:dict = {}
+
+
+class GatewayServer(object):
+    def __init__(self, bot, worker_count:int, socket_path:str=DEFAULT_SOCKET_PATH,
+                 event_timeout:float=float(os.getenv('WORKER_EVENT_TIMEOUT') or 600)):
+        self.bot = bot
+        self.socket_path = socket_path
+        self.event_timeout = event_timeout
+        self.workers = [WorkerSlot(i) for i in range(max(worker_count, 1))]
+        self.interactions:dict = {}
+        self.messages:OrderedDict = OrderedDict()
+        self._tasks:list = []
+
+    async def start(self) -> None:
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self.server = await asyncio.start_unix_server(self._handle_worker, path=self.socket_path)
+        for slot in self.workers:
+            self._tasks.append(asyncio.create_task(self._supervise(slot)))
+        self._tasks.append(asyncio.create_task(self._watchdog()))
+
+    async def _supervise(self, slot:WorkerSlot) -> None:
+        """Spawn the worker process of the slot, and respawn it whenever it exits."""
+        main_path = os.path.join(os.getcwd(), 'main.py')
+        while True:
+            slot.process = await asyncio.create_subprocess_exec(
+                sys.executable, main_path, '--mode', 'worker', '--worker-id', str(slot.index),
+                '--socket', self.socket_path)
+            return_code = await slot.process.wait()
+            print(f"Worker {slot.index} exited with code {return_code}, respawning.")
+            slot.writer = None
+            for _, event in slot.inflight.values():
+                asyncio.create_task(self._report_lost(event))
+            slot.inflight.clear()
+            await asyncio.sleep(1)
+
+    async def _report_lost(self, event:dict) -> None:
+        """Tell the user of an event that died with its worker to retry. Rerunning it could crash the worker again."""
+        interaction = self.interactions.pop(event['event_id'], None)
+        text = "Sorry, the worker handling this crashed or timed out before finishing. Please try again."
+        try:
+            if interaction is not None:
+                await interaction.followup.send(text)
+            else:
+                channel = self.bot.get_channel(event['channel_id']) or await self.bot.fetch_channel(event['channel_id'])
+                await channel.send(text)
+        except Exception as e:
+            print(f"Could not report the lost event {event['event_id']}: {e}")
+
+    async def _watchdog(self) -> None:
+        while True:
+            await asyncio.sleep(min(self.event_timeout, 30))
+            now = time.monotonic()
+            for slot in self.workers:
+                if slot.process is not None and slot.process.returncode is None and \
+                        any(now - started > self.event_timeout for started, _ in slot.inflight.values()):
+                    print(f"Worker {slot.index} stuck for more than {self.event_timeout}s, killing it.")
+                    slot.process.kill()
+
+    async def _handle_worker(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter) -> None:
+        hello = await read_frame(reader)
+        slot = self.workers[hello['worker_id']]
+        slot.writer = writer
+        sender = asyncio.create_task(self._send_events(slot, writer))
+        try:
+            while True:
+                frame = await read_frame(reader)
+                if frame['type'] == 'action':
+                    asyncio.create_task(self._perform(writer, frame))
+                elif frame['type'] == 'done':
+                    slot.inflight.pop(frame['event_id'], None)
+                    self.interactions.pop(frame['event_id'], None)
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            print(f"Worker {slot.index} disconnected.")
+        finally:
+            sender.cancel()
+            if slot.writer is writer:
+                slot.writer = None
+
+    async def _send_events(self, slot:WorkerSlot, writer:asyncio.StreamWriter) -> None:
+        while True:
+            event = await slot.queue.get()
+            slot.inflight[event['event_id']] = (time.monotonic(), event)
+            try:
+                await send_frame(writer, event)
+            except (ConnectionResetError, BrokenPipeError):
+                # Keep the event for the respawned worker
+                slot.inflight.pop(event['event_id'], None)
+                slot.queue.put_nowait(event)
+                return
+
+    def dispatch(self, kind:str, channel_id:int, payload:dict, interaction:discord.Interaction=None) -> None:
+        """Queue an event on the worker owning the channel's conversation."""
+        event_id = uuid.uuid4().hex
+        if interaction is not None:
+            self.interactions[event_id] = interaction
+        slot = self.workers[channel_id % len(self.workers)]
+        slot.queue.put_nowait({"type": "event", "event_id": event_id, "kind": kind, "channel_id": channel_id,
+                               "bot_user_id": self.bot.user.id, "payload": payload})
+
+    def _remember(self, message:discord.Message) -> None:
+        self.messages[message.id] = message
+        while len(self.messages) > 512:
+            self.messages.popitem(last=False)
+
+    async def _perform(self, writer:asyncio.StreamWriter, action:dict) -> None:
+        result = {"type": "action_result", "action_id": action['action_id'], "error": None}
+        file_path = action.get('file_path')
+        try:
+            file = discord.File(file_path, filename=action.get('filename')) if file_path else None
+            kwargs = {"content": action.get('content')}
+            if file is not None:
+                kwargs["file"] = file
+            if action['op'] == 'send':
+                channel = self.bot.get_channel(action['channel_id']) or await self.bot.fetch_channel(action['channel_id'])
+                message = await channel.send(**kwargs)
+            elif action['op'] == 'edit':
+                message = self.messages.get(action['message_id'])
+                if message is None:
+                    channel = self.bot.get_channel(action['channel_id']) or await self.bot.fetch_channel(action['channel_id'])
+                    message = await channel.fetch_message(action['message_id'])
+                message = await message.edit(content=action.get('content'))
+            elif action['op'] == 'followup':
+                message = await self.interactions[action['event_id']].followup.send(**kwargs, wait=True)
+            else:
+                raise ValueError(f"Unknown action {action['op']}")
+            self._remember(message)
+            result["message_id"] = message.id
+            result["attachments"] = [attachment.url for attachment in message.attachments]
+        except Exception as e:
+            result["error"] = str(e)
+        finally:
+            if file_path and os.path.exists(file_path):
+                os.remove(file_path)
+        try:
+            await send_frame(writer, result)
+        except (ConnectionResetError, BrokenPipeError):
+            pass
+
+
+class GatewayForwarder(commands.Cog):
+    """Gateway side stand-in for the Chatbot cog, forwarding its events and slash commands to workers."""
+    required_intents = ("guilds", "guild_messages", "message_content")
+
+    def __init__(self, bot, server:GatewayServer):
+        self.bot = bot
+        self.server = server
+        # Only routed channels are forwarded, the workers resolve their profiles from the same table
+        self.channel_routes = ChannelRoutes()
+
+    async def cog_load(self):
+        await self.server.start()
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        print('Gateway Online and Ready.')
+        channel = self.bot.get_channel(self.channel_routes.announce_channel) if self.channel_routes.announce_channel else None
+        if channel:
+            await channel.send('Bot Online.')
+
+    @commands.command()
+    async def sync(self, ctx) -> None:
+        print("Syncing commands")
+        fmt = await ctx.bot.tree.sync(guild=ctx.guild)
+        await ctx.send(f"Synced {len(fmt)} commands to the current server")
+
+    @commands.Cog.listener()
+    async def on_message(self, message):
+        if self.channel_routes.route_for(message.channel, message.guild) is None or message.author == self.bot.user:
+            return
+        self.server.dispatch("message", message.channel.id, {
+            "guild_id": message.guild.id if message.guild else None,
+            "parent_id": getattr(message.channel, "parent_id", None),
+            "content": message.content,
+            "author": str(message.author),
+            "attachments": [{"url": attachment.url, "content_type": attachment.content_type, "filename": attachment.filename}
+                            for attachment in message.attachments]
+        })
+
+    async def forward_command(self, interaction:discord.Interaction, name:str, **args) -> None:
+        await interaction.response.defer()
+        self.server.dispatch("command", interaction.channel.id, {"command": name, "args": args, "guild_id": interaction.guild_id,
+                                                                 "parent_id": getattr(interaction.channel, "parent_id", None)}, interaction)
+
+    @app_commands.command(name="clear", description="Clear the chat history")
+    async def clear(self, ctx):
+        await self.forward_command(ctx, "clear")
+
+    @app_commands.command(name="clear_all", description="Clear the chat history")
+    async def clear_all(self, ctx):
+        await self.forward_command(ctx, "clear_all")
+
+    @app_commands.command(name="dialogue", description="Show the chat history, a page of it, or export it as gzip JSONL")
+    async def dialogue(self, ctx, start: int = None, end: int = None, last: int = None, role: str = None,
+                       compact: bool = False, export: bool = False):
+        await self.forward_command(ctx, "dialogue", start=start, end=end, last=last, role=role, compact=compact, export=export)
+
+    @app_commands.command(name="sysprompt", description="Change the system prompt")
+    async def sysprompt(self, ctx, arg: str):
+        await self.forward_command(ctx, "sysprompt", arg=arg)
+
+    @app_commands.command(name="profile", description="Profile the next turns in this channel")
+    @app_commands.default_permissions(administrator=True)
+    async def profile(self, ctx, turns: int = 1):
+        await self.forward_command(ctx, "profile", turns=turns)
+
+    @app_commands.command(name="routes", description="Show the model of each route with its latency and cost")
+    @app_commands.default_permissions(administrator=True)
+    async def routes(self, ctx):
+        await self.forward_command(ctx, "routes")
+
+    @app_commands.command(name="help", description="Show the help message")
+    async def bothelp(self, ctx):
+        await self.forward_command(ctx, "help")
+
+
+class RemoteMessage(object):
+    def __init__(self, worker, channel, message_id:int, attachment_urls:list):
+        self.worker = worker
+        self.channel = channel
+        self.id = message_id
+        self.attachments = [types.SimpleNamespace(url=url) for url in attachment_urls]
+
+    async def edit(self, content:str=None):
+        await self.worker.request({"op": "edit", "channel_id": self.channel.id, "message_id": self.id, "content": content})
+        return self
+
+
+class RemoteChannel(object):
+    def __init__(self, worker, channel_id:int, event_id:str, parent_id:int=None):
+        self.worker = worker
+        self.id = channel_id
+        self.event_id = event_id
+        self.parent_id = parent_id
+
+    async def send(self, content:str=None, file:discord.File=None, op:str="send") -> RemoteMessage:
+        action = {"op": op, "channel_id": self.id, "event_id": self.event_id,
+                  "content": str(content) if content is not None else None}
+        if file is not None:
+            action.update(self.worker.stage_file(file))
+        result = await self.worker.request(action)
+        return RemoteMessage(self.worker, self, result.get('message_id'), result.get('attachments', []))
+
+
+class RemoteInteraction(object):
+    """Minimal stand-in for discord.Interaction, enough for the Chatbot slash command callbacks."""
+    def __init__(self, channel:RemoteChannel, guild=None):
+        self.channel = channel
+        self.guild = guild
+        self.response = types.SimpleNamespace(defer=self._defer, send_message=self._followup)
+        self.followup = types.SimpleNamespace(send=self._followup)
+
+    async def _defer(self, *args, **kwargs):
+        # The gateway already deferred the interaction
+        return None
+
+    async def _followup(self, content=None, file=None, **kwargs):
+        return await self.channel.send(content, file=file, op="followup")
+
+
+class WorkerClient(object):
+    def __init__(self, worker_id:int, socket_path:str=DEFAULT_SOCKET_PATH):
+        self.worker_id = worker_id
+        self.socket_path = socket_path
+        self.staging_dir = os.path.join('Resource', 'cache', 'gateway')
+        self.pending:dict = {}
+        # Locks of the channels with events in progress, and how many events hold or wait for each
+        self.channel_locks:dict = {}
+        self._lock_users:dict = {}
+
+    async def run(self) -> None:
+        from Scripts.Cogs.chatbot import Chatbot
+
+        for _ in range(100):
+            try:
+                self.reader, self.writer = await asyncio.open_unix_connection(self.socket_path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                await asyncio.sleep(0.1)
+        else:
+            raise ConnectionError(f"Worker {self.worker_id} could not connect to the gateway at {self.socket_path}")
+        await send_frame(self.writer, {"type": "hello", "worker_id": self.worker_id})
+        self.bot = types.SimpleNamespace(user=types.SimpleNamespace(id=None))
+        self.cog = Chatbot(self.bot)
+        self.app_commands = {command.name: command for command in self.cog.get_app_commands()}
+        print(f"Worker {self.worker_id} ready.")
+
+        while True:
+            frame = await read_frame(self.reader)
+            if frame['type'] == 'event':
+                asyncio.create_task(self._handle_event(frame))
+            elif frame['type'] == 'action_result':
+                future = self.pending.pop(frame['action_id'], None)
+                if future is not None and not future.done():
+                    future.set_result(frame)
+
+    async def request(self, action:dict) -> dict:
+        action_id = uuid.uuid4().hex
+        future = asyncio.get_running_loop().create_future()
+        self.pending[action_id] = future
+        await send_frame(self.writer, {"type": "action", "action_id": action_id, **action})
+        result = await future
+        if result['error']:
+            raise RuntimeError(result['error'])
+        return result
+
+    def stage_file(self, file:discord.File) -> dict:
+        """Write an outgoing file where the gateway can pick it up."""
+        os.makedirs(self.staging_dir, exist_ok=True)
+        file_path = os.path.abspath(os.path.join(self.staging_dir, uuid.uuid4().hex))
+        source_path = getattr(file.fp, 'name', None)
+        if isinstance(source_path, str) and os.path.isfile(source_path):
+            # Files opened from disk, like stored image artifacts, are linked instead of copied
+            try:
+                os.link(source_path, file_path)
+                return {"file_path": file_path, "filename": file.filename}
+            except OSError:
+                pass
+        file.fp.seek(0)
+        with open(file_path, 'wb') as f:
+            while True:
+                block = file.fp.read(64 * 1024)
+                if not block:
+                    break
+                f.write(block.encode('utf-8') if isinstance(block, str) else block)
+        return {"file_path": file_path, "filename": file.filename}
+
+    async def _handle_event(self, event:dict) -> None:
+        payload = event['payload']
+        channel = RemoteChannel(self, event['channel_id'], event['event_id'], payload.get('parent_id'))
+        # Enough of a guild for routing
+        guild = types.SimpleNamespace(id=payload['guild_id']) if payload.get('guild_id') else None
+        channel_id = event['channel_id']
+        lock = self.channel_locks.setdefault(channel_id, asyncio.Lock())
+        self._lock_users[channel_id] = self._lock_users.get(channel_id, 0) + 1
+        self.bot.user.id = event['bot_user_id']
+        try:
+            async with lock:
+                if event['kind'] == 'message':
+                    message = types.SimpleNamespace(
+                        content=payload['content'], author=payload['author'], channel=channel, guild=guild,
+                        attachments=[types.SimpleNamespace(**attachment) for attachment in payload['attachments']])
+                    await self.cog.on_message(message)
+                elif event['kind'] == 'command':
+                    command = self.app_commands[payload['command']]
+                    await command.callback(self.cog, RemoteInteraction(channel, guild), **payload['args'])
+        except Exception as e:
+            print(f"Worker {self.worker_id} failed on event {event['kind']}: {e}")
+        finally:
+            # The lock goes with the channel's last event, so idle channels hold nothing
+            self._lock_users[channel_id] -= 1
+            if not self._lock_users[channel_id]:
+                del self._lock_users[channel_id]
+                del self.channel_locks[channel_id]
+            await send_frame(self.writer, {"type": "done", "event_id": event['event_id']})
+
+
+async def run_worker(worker_id:int, socket_path:str=DEFAULT_SOCKET_PATH) -> None:
+    await WorkerClient(worker_id, socket_path).run()
@@ -0,0 +1,272 @@
+import os
+import re
+import json
+import gzip
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+
+import requests
+
+from Scripts.utilities.resilience import get_resilience, upstream_for_url
+
+class CachedResponse(object):
+    __slots__ = ("url", "status_code", "headers", "content", "encoding", "from_cache", "parsed", "stale")
+
+    def __init__(self, url:str, status_code:int, headers:dict, content:bytes, encoding:str, from_cache:bool, parsed:str=None):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.encoding = encoding
+        self.from_cache = from_cache
+        self.parsed = parsed
+        # A stored copy past its freshness, served because the upstream could not be reached
+        self.stale = False
+
+    @property
+    def text(self) -> str:
+        return self.content.decode(self.encoding or 'utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self) -> None:
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} error for url: {self.url}")
+
+
+class HTTPCache(object):
+    """
+    Disk cache of GET responses that follows Cache-Control and revalidates with ETag/Last-Modified.
+
+    Bodies are stored gzip compressed, together with the text a parse function derived from them, so a fresh entry
+    or a 304 Not Modified answer skips both the download and the parsing. default_ttl gives a freshness lifetime to
+    responses that declare none. The least recently used entries are evicted once the store exceeds max_bytes,
+    from an in-memory index of each entry's files and sizes that is read from disk once at startup.
+    Requests go through the resilience layer under the upstream of their host. When it fails, times out or has its
+    breaker open, the stored copy is served even if stale, with .stale set so callers can refuse it.
+    """
+    _stored_headers = ("content-type", "etag", "last-modified", "cache-control", "expires", "date", "age")
+
+    def __init__(self, cache_dir:str=os.path.join('Resource', 'cache', 'http'),
+                 max_bytes:int=int(float(os.getenv('HTTP_CACHE_MAX_MB') or 128) * 1024 * 1024)):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.session = requests.Session()
+        self.session.headers["Accept-Encoding"] = "gzip, deflate"
+        self.hits:int = 0
+        self.revalidated:int = 0
+        self.misses:int = 0
+        self.stale:int = 0
+        self._lock = threading.Lock()
+        # key: {suffix: size} of its files, least recently used first, and their total size
+        self._index:OrderedDict = OrderedDict()
+        self._total:int = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+        used = {}
+        for entry in os.scandir(self.cache_dir):
+            key, _, suffix = entry.name.partition('.')
+            if suffix.endswith('.tmp'):
+                continue
+            stat = entry.stat()
+            self._index.setdefault(key, {})[suffix] = stat.st_size
+            self._total += stat.st_size
+            if suffix == "meta.json":
+                used[key] = stat.st_mtime
+        for key in sorted(self._index, key=lambda key: used.get(key, 0)):
+            self._index.move_to_end(key)
+
+    @staticmethod
+    def make_key(url:str, params:dict=None) -> str:
+        request = requests.Request('GET', url, params=params).prepare()
+        return hashlib.sha256(request.url.encode('utf-8')).hexdigest()
+
+    def _path(self, key:str, suffix:str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.{suffix}")
+
+    @staticmethod
+    def _parser_suffix(parse) -> str:
+        name = f"{parse.__module__}.{parse.__qualname__}"
+        return f"{hashlib.sha1(name.encode('utf-8')).hexdigest()[:8]}.txt.gz"
+
+    @staticmethod
+    def freshness(headers:dict, default_ttl:float=0) -> float:
+        """Seconds a response stays fresh after it was received, per Cache-Control, Expires and the RFC 7234 heuristic."""
+        directives = {}
+        for directive in headers.get("cache-control", "").lower().split(","):
+            name, _, value = directive.strip().partition("=")
+            directives[name] = value.strip('"')
+        if "no-cache" in directives or "no-store" in directives:
+            return 0
+        age = float(headers.get("age") or 0)
+        if directives.get("max-age", "").isdigit():
+            return max(0, int(directives["max-age"]) - age)
+        try:
+            if headers.get("expires"):
+                date = parsedate_to_datetime(headers["date"]) if headers.get("date") else None
+                expires = parsedate_to_datetime(headers["expires"])
+                return max(0, (expires - date).total_seconds() if date else expires.timestamp() - time.time())
+            if headers.get("last-modified") and headers.get("date") and not default_ttl:
+                # Heuristic freshness, 10% of the time since the last change, capped to one hour
+                since_modified = (parsedate_to_datetime(headers["date"]) - parsedate_to_datetime(headers["last-modified"])).total_seconds()
+                return min(3600, max(0, since_modified / 10))
+        except (TypeError, ValueError):
+            return 0
+        return default_ttl
+
+    def _load(self, key:str) -> dict:
+        try:
+            with open(self._path(key, "meta.json"), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def _write(self, key:str, suffix:str, data:bytes) -> None:
+        # Under _lock
+        path = self._path(key, suffix)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+        files = self._index.setdefault(key, {})
+        self._total += len(data) - files.get(suffix, 0)
+        files[suffix] = len(data)
+
+    def _remove(self, key:str, suffix:str) -> None:
+        # Under _lock
+        self._total -= self._index[key].pop(suffix)
+        try:
+            os.remove(self._path(key, suffix))
+        except FileNotFoundError:
+            pass
+
+    def _touch(self, key:str) -> None:
+        with self._lock:
+            if key in self._index:
+                self._index.move_to_end(key)
+
+    def _read_gzip(self, key:str, suffix:str) -> bytes:
+        try:
+            with gzip.open(self._path(key, suffix), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _store(self, key:str, meta:dict, content:bytes=None, parsed:tuple=None) -> None:
+        with self._lock:
+            if content is not None:
+                # A new body invalidates the text parsed from the old one
+                for suffix in [suffix for suffix in self._index.get(key, {}) if suffix.endswith(".txt.gz")]:
+                    self._remove(key, suffix)
+                self._write(key, "body.gz", gzip.compress(content))
+            if parsed is not None:
+                suffix, text = parsed
+                self._write(key, suffix, gzip.compress(text.encode('utf-8')))
+            self._write(key, "meta.json", json.dumps(meta).encode('utf-8'))
+            self._index.move_to_end(key)
+            self._evict()
+
+    def _evict(self) -> None:
+        # Under _lock
+        if self._total <= self.max_bytes:
+            return
+        while self._index and self._total > self.max_bytes * 0.9:
+            key = next(iter(self._index))
+            for suffix in list(self._index[key]):
+                self._remove(key, suffix)
+            del self._index[key]
+
+    def _cached(self, key:str, meta:dict, parse) -> CachedResponse:
+        content = self._read_gzip(key, "body.gz")
+        if content is None:
+            return None
+        self._touch(key)
+        response = CachedResponse(meta["url"], meta["status_code"], meta["headers"], content, meta["encoding"], True)
+        if parse is not None:
+            suffix = self._parser_suffix(parse)
+            parsed = self._read_gzip(key, suffix)
+            if parsed is None:
+                response.parsed = parse(response.text)
+                self._store(key, meta, parsed=(suffix, response.parsed))
+            else:
+                response.parsed = parsed.decode('utf-8')
+        return response
+
+    def _get(self, url:str, params:dict, headers:dict, timeout:float) -> requests.Response:
+        live = self.session.get(url, params=params, headers=headers, timeout=timeout)
+        if live.status_code >= 500 or live.status_code == 429:
+            # Counts as a failure of the upstream
+            live.raise_for_status()
+        return live
+
+    def fetch(self, url:str, params:dict=None, parse=None, default_ttl:float=0, timeout:float=None, headers:dict=None,
+              upstream:str=None) -> CachedResponse:
+        """
+        GET a url through the cache. parse, a function of the response text, is applied to new bodies only,
+        and its result is cached next to the body and returned in .parsed.
+        Only 200 responses are cached, others are returned as they come.
+        timeout overrides the upstream's deadline, upstream its name, which defaults to the one of the url's host.
+        """
+        key = self.make_key(url, params)
+        meta = self._load(key)
+        now = time.time()
+        if meta is not None and meta["fresh_until"] > now:
+            response = self._cached(key, meta, parse)
+            if response is not None:
+                self.hits += 1
+                return response
+            meta = None
+
+        request_headers = dict(headers or {})
+        if meta is not None:
+            if meta["headers"].get("etag"):
+                request_headers["If-None-Match"] = meta["headers"]["etag"]
+            if meta["headers"].get("last-modified"):
+                request_headers["If-Modified-Since"] = meta["headers"]["last-modified"]
+        resilience = get_resilience()
+        upstream = upstream or upstream_for_url(url)
+        timeout = timeout or resilience.upstream(upstream).deadline
+        stale = None
+        if meta is not None and os.path.exists(self._path(key, "body.gz")):
+            stale = lambda: self._cached(key, meta, parse)
+        live = resilience.call(upstream, self._get, url, params, request_headers, timeout, fallback=stale, deadline=timeout)
+        if isinstance(live, CachedResponse):
+            self.stale += 1
+            live.stale = True
+            return live
+
+        response_headers = {name: live.headers[name] for name in self._stored_headers if name in live.headers}
+        if live.status_code == 304 and meta is not None:
+            meta["headers"].update(response_headers)
+            meta["fresh_until"] = now + self.freshness(meta["headers"], default_ttl)
+            response = self._cached(key, meta, parse)
+            if response is not None:
+                self._store(key, meta)
+                self.revalidated += 1
+                return response
+            # The body went missing, fetch it again unconditionally
+            live = resilience.call(upstream, self._get, url, params, headers, timeout, deadline=timeout)
+            response_headers = {name: live.headers[name] for name in self._stored_headers if name in live.headers}
+
+        self.misses += 1
+        response = CachedResponse(live.url, live.status_code, response_headers, live.content, live.encoding, False)
+        if live.status_code != 200:
+            return response
+        if parse is not None:
+            response.parsed = parse(response.text)
+        if "no-store" not in response_headers.get("cache-control", "").lower():
+            meta = {"url": re.sub(r"\?.*", "", live.url), "status_code": 200, "headers": response_headers,
+                    "encoding": live.encoding, "fresh_until": now + self.freshness(response_headers, default_ttl)}
+            self._store(key, meta, content=live.content,
+                        parsed=(self._parser_suffix(parse), response.parsed) if parse is not None else None)
+        return response
+
+_http_cache:HTTPCache = None
+
+def get_http_cache() -> HTTPCache:
+    global _http_cache
+    if _http_cache is None:
+        _http_cache = HTTPCache()
+    return _http_cache
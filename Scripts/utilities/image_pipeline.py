@@ -0,0 +1,102 @@
+import os
+import json
+import asyncio
+import hashlib
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import requests
+
+from Scripts.utilities.resilience import get_resilience
+
+class ImagePipeline(object):
+    """
+    Image generation with its own worker pool, writing images to a content-addressed artifact store.
+
+    Images are requested as urls and streamed to disk in blocks while being hashed, so an image is never held
+    in memory whole, and stored as <sha256>.png. A request index maps (model, prompt, size, style) to its artifact,
+    so a repeated request returns the stored file without calling the API, and identical requests in flight
+    share one generation. The pool size caps concurrent generations. The oldest artifacts are deleted once
+    more than max_artifacts are stored.
+    """
+    def __init__(self, openai_client, store_dir:str=os.path.join('Resource', 'cache', 'images'), model:str="dall-e-3",
+                 max_concurrency:int=int(os.getenv('IMAGE_MAX_CONCURRENCY') or 2), max_artifacts:int=200):
+        self.openai_client = openai_client
+        self.store_dir = store_dir
+        self.model = model
+        self.max_artifacts = max_artifacts
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="image")
+        self.session = requests.Session()
+        self._inflight:dict = {}
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(self.store_dir, 'requests'), exist_ok=True)
+
+    def request_key(self, prompt:str, size:str, style:str) -> str:
+        payload = json.dumps([self.model, prompt.strip(), size, style], ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _request_path(self, key:str) -> str:
+        return os.path.join(self.store_dir, 'requests', f"{key}.json")
+
+    def lookup(self, key:str) -> dict:
+        """Stored artifact of a request, or None."""
+        try:
+            with open(self._request_path(key), 'r', encoding='utf-8') as f:
+                artifact = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        if not os.path.exists(artifact["path"]):
+            return None
+        os.utime(artifact["path"])
+        return {**artifact, "cached": True}
+
+    def _render(self, key:str, prompt:str, size:str, style:str) -> dict:
+        image = get_resilience().call("openai-images", self.openai_client.images.generate, idempotent=False,
+                                      model=self.model, prompt=prompt, n=1, size=size, style=style, response_format="url")
+        temp_path = os.path.join(self.store_dir, f"{key}.part")
+        digest = hashlib.sha256()
+        with self.session.get(image.data[0].url, stream=True, timeout=120) as response:
+            response.raise_for_status()
+            with open(temp_path, 'wb') as f:
+                for block in response.iter_content(chunk_size=64 * 1024):
+                    digest.update(block)
+                    f.write(block)
+        path = os.path.join(self.store_dir, f"{digest.hexdigest()}.png")
+        os.replace(temp_path, path)
+        artifact = {"path": path, "revised_prompt": image.data[0].revised_prompt or prompt}
+        with open(self._request_path(key) + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(artifact, f, ensure_ascii=False)
+        os.replace(self._request_path(key) + '.tmp', self._request_path(key))
+        self._evict()
+        return {**artifact, "cached": False}
+
+    def _evict(self) -> None:
+        artifacts = [os.path.join(self.store_dir, name) for name in os.listdir(self.store_dir) if name.endswith('.png')]
+        if len(artifacts) <= self.max_artifacts:
+            return
+        artifacts.sort(key=os.path.getmtime)
+        for path in artifacts[:len(artifacts) - self.max_artifacts]:
+            os.remove(path)
+        # Request entries pointing at a deleted artifact are dropped by lookup() on their next use
+
+    def submit(self, prompt:str, size:str="1024x1024", style:str="vivid") -> Future:
+        key = self.request_key(prompt, size, style)
+        with self._lock:
+            artifact = self.lookup(key)
+            if artifact is not None:
+                future = Future()
+                future.set_result(artifact)
+                return future
+            future = self._inflight.get(key)
+            if future is None:
+                future = self.executor.submit(self._render, key, prompt, size, style)
+                self._inflight[key] = future
+                future.add_done_callback(lambda _: self._inflight.pop(key, None))
+            return future
+
+    async def generate(self, prompt:str, size:str="1024x1024", style:str="vivid") -> dict:
+        """Artifact dict with path, revised_prompt and cached, without blocking the event loop."""
+        return await asyncio.wrap_future(self.submit(prompt, size, style))
+
+    def generate_blocking(self, prompt:str, size:str="1024x1024", style:str="vivid") -> dict:
+        return self.submit(prompt, size, style).result()
@@ -0,0 +1,160 @@
+import os
+import re
+import json
+import threading
+import numpy as np
+
+from Scripts.utilities.message import Message, get_encoder
+
+class LongTermMemory(object):
+    """
+    Per session vector index of past turns and tool results, kept on disk so recall survives dialogue resets.
+
+    Entry texts are appended to entries.jsonl and their normalized embeddings to vectors.f32, a float32 matrix
+    memory mapped from disk that doubles its capacity when full. recall() embeds the new user message, scores
+    it against every stored vector in one matrix product, and packs the best snippets into a token budgeted
+    system message. Entries still present in the live dialogue are skipped.
+    """
+    SNIPPET_CHARS:int = 1500
+
+    def __init__(self, session:str, client, store_dir:str=os.path.join('Resource', 'cache', 'memory'),
+                 model:str=os.getenv('MEMORY_EMBED_MODEL') or "text-embedding-3-small",
+                 top_k:int=int(os.getenv('MEMORY_TOP_K') or 5),
+                 token_budget:int=int(os.getenv('MEMORY_TOKEN_BUDGET') or 800), min_similarity:float=0.3):
+        self.session = session
+        self.client = client
+        self.model = model
+        self.top_k = top_k
+        self.token_budget = token_budget
+        self.min_similarity = min_similarity
+        self.session_dir = os.path.join(store_dir, re.sub(r"[^\w.-]", "_", session))
+        self._lock = threading.Lock()
+        self.entries:list[dict] = []
+        self.vectors:np.memmap = None
+        self.dim:int = None
+        self.capacity:int = 0
+        os.makedirs(self.session_dir, exist_ok=True)
+        self._load()
+
+    def _path(self, name:str) -> str:
+        return os.path.join(self.session_dir, name)
+
+    def _load(self) -> None:
+        try:
+            with open(self._path("meta.json"), 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return
+        with open(self._path("entries.jsonl"), 'r', encoding='utf-8') as f:
+            self.entries = [json.loads(line) for line in f if line.strip()]
+        self.dim = meta["dim"]
+        self.capacity = meta["capacity"]
+        # Entries written after the last vector flush have no vector, drop them
+        self.entries = self.entries[:meta["count"]]
+        self.vectors = np.memmap(self._path("vectors.f32"), dtype=np.float32, mode='r+', shape=(self.capacity, self.dim))
+
+    def _save_meta(self) -> None:
+        with open(self._path("meta.json.tmp"), 'w', encoding='utf-8') as f:
+            json.dump({"dim": self.dim, "capacity": self.capacity, "count": len(self.entries), "model": self.model}, f)
+        os.replace(self._path("meta.json.tmp"), self._path("meta.json"))
+
+    def _reserve(self, count:int) -> None:
+        if len(self.entries) + count <= self.capacity:
+            return
+        capacity = max(256, self.capacity)
+        while capacity < len(self.entries) + count:
+            capacity *= 2
+        if self.vectors is not None:
+            self.vectors.flush()
+            del self.vectors
+        # Growing the file keeps the existing rows in place
+        with open(self._path("vectors.f32"), 'ab') as f:
+            f.truncate(capacity * self.dim * 4)
+        self.capacity = capacity
+        self.vectors = np.memmap(self._path("vectors.f32"), dtype=np.float32, mode='r+', shape=(self.capacity, self.dim))
+
+    def close(self) -> None:
+        """Flush the vectors and release their memory map and file descriptor."""
+        with self._lock:
+            if self.vectors is not None:
+                self.vectors.flush()
+                # The last reference to the memmap, dropping it unmaps the file and closes its descriptor
+                self.vectors = None
+
+    def embed(self, texts:list[str]) -> np.ndarray:
+        response = self.client.embeddings.create(model=self.model, input=[text[:self.SNIPPET_CHARS * 4] for text in texts])
+        vectors = np.array([item.embedding for item in response.data], dtype=np.float32)
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+    def add(self, items:list[tuple[str, str]], vectors:np.ndarray=None) -> None:
+        """
+        Store (role, text) items. Pass their vectors when already embedded, otherwise they are embedded in one request.
+        """
+        items = [(role, text) for role, text in items if text and text.strip()]
+        if not items:
+            return
+        if vectors is None:
+            vectors = self.embed([text for _, text in items])
+        with self._lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+            elif vectors.shape[1] != self.dim:
+                print(f"Embedding size changed from {self.dim} to {vectors.shape[1]}, not storing to memory {self.session}")
+                return
+            self._reserve(len(items))
+            start = len(self.entries)
+            self.vectors[start:start + len(items)] = vectors
+            self.vectors.flush()
+            with open(self._path("entries.jsonl"), 'a', encoding='utf-8') as f:
+                for role, text in items:
+                    entry = {"role": role, "text": text[:self.SNIPPET_CHARS]}
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                    self.entries.append(entry)
+            self._save_meta()
+
+    def search(self, vector:np.ndarray, exclude:set=frozenset()) -> list[tuple[float, dict]]:
+        # Stores run in the background, take a consistent snapshot of the rows written so far
+        with self._lock:
+            count = len(self.entries)
+            vectors = self.vectors
+        if not count:
+            return []
+        scores = np.asarray(vectors[:count] @ vector)
+        candidates = min(len(scores), self.top_k + len(exclude))
+        best = np.argpartition(-scores, candidates - 1)[:candidates]
+        results = []
+        for index in best[np.argsort(-scores[best])]:
+            entry = self.entries[index]
+            if scores[index] < self.min_similarity or entry["text"] in exclude:
+                continue
+            results.append((float(scores[index]), entry))
+            if len(results) == self.top_k:
+                break
+        return results
+
+    def recall(self, query:str, exclude:set=frozenset(), vision:bool=False) -> tuple[np.ndarray, Message]:
+        """
+        Embed the query and return its vector, to be stored with add() later, and a system message of
+        the relevant snippets within the token budget, or None when nothing relevant is stored.
+        """
+        vector = self.embed([query])[0]
+        if self.dim is not None and vector.shape[0] != self.dim:
+            # The embedding model changed, the stored vectors can't be compared with the new ones
+            return vector, None
+        # Stored texts are cut to SNIPPET_CHARS, compare them cut the same way
+        exclude = {text[:self.SNIPPET_CHARS] for text in exclude}
+        encoder = get_encoder()
+        lines = []
+        tokens = 0
+        for score, entry in self.search(vector, exclude):
+            line = f"[{entry['role']}] {entry['text']}"
+            line_tokens = len(encoder.encode(line))
+            if tokens + line_tokens > self.token_budget:
+                continue
+            lines.append(line)
+            tokens += line_tokens
+        if not lines:
+            return vector, None
+        text = ("Relevant excerpts from earlier conversations, recalled from long-term memory. "
+                "Use them only if they help with the current message:\n" + "\n".join(lines))
+        return vector, Message.text_message("system", text, vision=vision, name="memory")
@@ -0,0 +1,121 @@
+import os
+import sys
+import time
+import asyncio
+import threading
+import traceback
+from collections import deque
+
+class BlockingSite(object):
+    def __init__(self, key:str, stack:str):
+        self.key = key
+        self.stack = stack
+        self.count:int = 0
+        self.total:float = 0.0
+        self.max:float = 0.0
+
+    def add(self, duration:float) -> None:
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+
+
+class LoopWatchdog(object):
+    """
+    Measures event loop lag and finds out what is blocking the loop.
+
+    A heartbeat coroutine wakes up every interval seconds and records how late it woke up.
+    A helper thread checks the heartbeat, and when the loop has not beaten for more than threshold seconds
+    it samples the loop thread's stack. Blocking episodes are grouped by the project function that was
+    running (and the innermost call it was stuck in), with counts and durations.
+    """
+    def __init__(self, threshold:float=float(os.getenv('LOOP_LAG_THRESHOLD') or 0.25), interval:float=0.1,
+                 history:int=4096):
+        self.threshold = threshold
+        self.interval = interval
+        self.lags:deque = deque(maxlen=history)
+        self.sites:dict = {}
+        self.project_root = os.path.abspath(os.getcwd())
+        self._last_beat:float = time.monotonic()
+        self._loop_thread_id:int = None
+        self._task:asyncio.Task = None
+        self._thread:threading.Thread = None
+        self._stop = threading.Event()
+
+    def start(self) -> None:
+        if self._task is not None and not self._task.done():
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.get_running_loop().create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._monitor, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _heartbeat(self) -> None:
+        while True:
+            before = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self.lags.append(max(now - before - self.interval, 0.0))
+            self._last_beat = now
+
+    def _monitor(self) -> None:
+        blocked_since = None
+        samples = []
+        while not self._stop.wait(self.threshold / 4):
+            now = time.monotonic()
+            last_beat = self._last_beat
+            if now - last_beat > self.threshold + self.interval:
+                if blocked_since is None:
+                    blocked_since = last_beat
+                frame = sys._current_frames().get(self._loop_thread_id)
+                if frame is not None:
+                    samples.append(traceback.extract_stack(frame))
+            elif blocked_since is not None:
+                self._record(last_beat - blocked_since - self.interval, samples)
+                blocked_since = None
+                samples = []
+
+    def _is_project_frame(self, frame:traceback.FrameSummary) -> bool:
+        filename = os.path.abspath(frame.filename)
+        return filename.startswith(self.project_root) and 'site-packages' not in filename \
+            and not filename.endswith('loop_watchdog.py')
+
+    def _record(self, duration:float, samples:list) -> None:
+        if not samples:
+            return
+        # The first sample is the closest to where the loop got stuck
+        stack = samples[0]
+        project_frames = [frame for frame in stack if self._is_project_frame(frame)]
+        owner = project_frames[-1] if project_frames else stack[-1]
+        innermost = stack[-1]
+        key = f"{owner.name} ({os.path.relpath(owner.filename, self.project_root)}:{owner.lineno})"
+        if innermost is not owner:
+            key += f" -> {innermost.name} ({os.path.basename(innermost.filename)}:{innermost.lineno})"
+        site = self.sites.get(key)
+        if site is None:
+            site = self.sites[key] = BlockingSite(key, "".join(traceback.format_list(stack)))
+        site.add(duration)
+        print(f"Event loop blocked for {duration:.2f}s in {key}")
+
+    def percentiles(self, points:tuple=(50, 90, 99, 100)) -> dict:
+        lags = sorted(self.lags)
+        if not lags:
+            return {p: 0.0 for p in points}
+        return {p: lags[min(int(len(lags) * p / 100), len(lags) - 1)] for p in points}
+
+    def report(self, limit:int=10) -> str:
+        lines = [f"Loop lag over last {len(self.lags)} beats: " +
+                 ", ".join(f"p{p} {lag * 1000:.1f}ms" for p, lag in self.percentiles().items())]
+        sites = sorted(self.sites.values(), key=lambda site: site.total, reverse=True)[:limit]
+        if not sites:
+            lines.append(f"No blocking over {self.threshold}s recorded.")
+        for site in sites:
+            lines.append(f"{site.count}x total {site.total:.2f}s max {site.max:.2f}s: {site.key}")
+        return "\n".join(lines)
@@ -0,0 +1,113 @@
+import os
+import inspect
+import resource
+import importlib
+import tracemalloc
+import linecache
+
+import discord
+from discord.ext import commands
+
+def collect_required_intents(module_names:list[str], extra_cogs:list=()) -> set[str]:
+    """
+    Collect the intents declared by the cogs of the given modules in their required_intents attribute.
+    A cog without the attribute is assumed to need every intent.
+
+    Returns:
+    - set: Intent flag names, or None when some cog did not declare its intents.
+    """
+    intents = set()
+    cog_classes = list(extra_cogs)
+    for module_name in module_names:
+        module = importlib.import_module(module_name)
+        cog_classes += [obj for obj in vars(module).values()
+                        if inspect.isclass(obj) and issubclass(obj, commands.Cog) and obj.__module__ == module.__name__]
+    for cog_class in cog_classes:
+        required = getattr(cog_class, 'required_intents', None)
+        if required is None:
+            print(f"{cog_class.__name__} does not declare required_intents, using all intents.")
+            return None
+        intents.update(required)
+    return intents
+
+def build_client_options(profile:str, required_intents:set[str]=None) -> dict:
+    """
+    Keyword arguments for commands.Bot for the given memory profile.
+
+    - full: every intent, discord.py's default member and message caches.
+    - lean: only the intents the cogs declared, no member cache and a small message cache.
+    """
+    if profile == 'full' or required_intents is None:
+        intents = discord.Intents.all()
+        intents.message_content = True
+        return {"intents": intents}
+    intents = discord.Intents.none()
+    for name in required_intents:
+        setattr(intents, name, True)
+    return {
+        "intents": intents,
+        "member_cache_flags": discord.MemberCacheFlags.none(),
+        "max_messages": int(os.getenv('BOT_MESSAGE_CACHE') or 100),
+        "chunk_guilds_at_startup": False,
+    }
+
+def get_rss_bytes() -> tuple[int, int]:
+    """Current and peak resident set size of the process, in bytes."""
+    current = 0
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            current = int(f.read().split()[1]) * resource.getpagesize()
+    except (FileNotFoundError, IndexError, ValueError):
+        pass
+    # ru_maxrss is in kilobytes on linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return current, peak
+
+def format_bytes(size:float) -> str:
+    for unit in ("B", "KiB", "MiB"):
+        if abs(size) < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GiB"
+
+
+class MemorySnapshotter(object):
+    """Takes tracemalloc snapshots and reports top allocation sites and growth since the previous snapshot."""
+    def __init__(self, frames:int=1):
+        self.frames = frames
+        self.previous:tracemalloc.Snapshot = None
+        self.filters = [
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, linecache.__file__),
+        ]
+
+    def snapshot(self) -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces(self.filters)
+
+    def report(self, limit:int=10) -> str:
+        current_rss, peak_rss = get_rss_bytes()
+        lines = [f"RSS: {format_bytes(current_rss)} (peak {format_bytes(peak_rss)})"]
+        if not tracemalloc.is_tracing():
+            lines.append("tracemalloc is disabled, start the bot with --tracemalloc for allocation sites.")
+            return "\n".join(lines)
+
+        traced, traced_peak = tracemalloc.get_traced_memory()
+        lines.append(f"Traced: {format_bytes(traced)} (peak {format_bytes(traced_peak)}), "
+                     f"tracemalloc overhead: {format_bytes(tracemalloc.get_tracemalloc_memory())}")
+        snapshot = self.snapshot()
+
+        lines.append(f"Top {limit} allocation sites:")
+        for stat in snapshot.statistics('lineno')[:limit]:
+            frame = stat.traceback[0]
+            lines.append(f"  {frame.filename}:{frame.lineno} {format_bytes(stat.size)} in {stat.count} blocks")
+
+        if self.previous is not None:
+            lines.append(f"Top {limit} growth since last snapshot:")
+            for stat in snapshot.compare_to(self.previous, 'lineno')[:limit]:
+                frame = stat.traceback[0]
+                lines.append(f"  {frame.filename}:{frame.lineno} {format_bytes(stat.size_diff):>12} "
+                             f"({stat.count_diff:+d} blocks)")
+        self.previous = snapshot
+        return "\n".join(lines)
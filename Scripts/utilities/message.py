@@ -0,0 +1,182 @@
+import json
+import gzip
+from collections import deque
+import tiktoken
+
+_encoder = None
+
+def get_encoder():
+    global _encoder
+    if _encoder is None:
+        _encoder = tiktoken.encoding_for_model("gpt-4")
+    return _encoder
+
+class Message(object):
+    """
+    A dialogue entry with an immutable content payload.
+
+    Content is either a str, or a tuple of parts for the vision model, each part being
+    ("text", text) or ("image_url", url, detail).
+    The token count is computed once at creation, and the API ready dict and its json bytes are
+    built on first use and memoized, so building a request or dumping the dialogue never re-serializes
+    a message. The API dict is shared, do not mutate it.
+    """
+    __slots__ = ("role", "content", "name", "token_count", "_api", "_json")
+
+    # Per message overhead of the chat format, and a flat estimate for an image part
+    MESSAGE_OVERHEAD:int = 4
+    IMAGE_TOKENS:int = 765
+
+    def __init__(self, role:str, content, name:str=None):
+        if isinstance(content, list):
+            content = tuple(self._freeze_part(part) for part in content)
+        self.role = role
+        self.content = content
+        self.name = name
+        self.token_count = self._count_tokens()
+        self._api = None
+        self._json = None
+
+    @staticmethod
+    def _freeze_part(part) -> tuple:
+        if isinstance(part, tuple):
+            return part
+        if part["type"] == "text":
+            return ("text", part["text"])
+        return ("image_url", part["image_url"]["url"], part["image_url"].get("detail"))
+
+    def _count_tokens(self) -> int:
+        encoder = get_encoder()
+        count = self.MESSAGE_OVERHEAD + (len(encoder.encode(self.name)) if self.name else 0)
+        if isinstance(self.content, str):
+            return count + len(encoder.encode(self.content))
+        for part in self.content:
+            count += len(encoder.encode(part[1])) if part[0] == "text" else self.IMAGE_TOKENS
+        return count
+
+    @property
+    def text(self) -> str:
+        """Text of the message, with image parts left out."""
+        if isinstance(self.content, str):
+            return self.content
+        return "\n".join(part[1] for part in self.content if part[0] == "text")
+
+    @property
+    def has_parts(self) -> bool:
+        return not isinstance(self.content, str)
+
+    def _build_api(self) -> dict:
+        if isinstance(self.content, str):
+            content = self.content
+        else:
+            content = []
+            for part in self.content:
+                if part[0] == "text":
+                    content.append({"type": "text", "text": part[1]})
+                else:
+                    image_url = {"url": part[1]}
+                    if part[2]:
+                        image_url["detail"] = part[2]
+                    content.append({"type": "image_url", "image_url": image_url})
+        api = {"role": self.role, "content": content}
+        if self.name:
+            api["name"] = self.name
+        return api
+
+    def to_api(self) -> dict:
+        if self._api is None:
+            self._api = self._build_api()
+        return self._api
+
+    def to_json(self) -> bytes:
+        if self._json is None:
+            self._json = json.dumps(self.to_api(), ensure_ascii=False).encode('utf-8')
+        return self._json
+
+    def with_content(self, content) -> "Message":
+        """A copy of the message with a different content, keeping the text/parts shape of the original."""
+        if self.has_parts and isinstance(content, str):
+            content = (("text", content),)
+        return Message(self.role, content, self.name)
+
+    @classmethod
+    def text_message(cls, role:str, text:str, vision:bool=False, name:str=None) -> "Message":
+        return cls(role, (("text", text),) if vision else text, name)
+
+    @classmethod
+    def tool_result(cls, name:str, text:str, vision:bool=False, image_url:str=None) -> "Message":
+        """
+        Tool result entry. The vision model has no function role, so there the result is given as a
+        system message named function.
+        """
+        if not vision:
+            return cls("function", text, name)
+        parts = [("text", f"{name} result:\n {text}")]
+        if image_url is not None:
+            parts.append(("image_url", image_url, None))
+        return cls("system", tuple(parts), "function")
+
+
+def to_api_messages(dialogue:list[Message]) -> list[dict]:
+    return [message.to_api() for message in dialogue]
+
+def dialogue_json(dialogue:list[Message]) -> bytes:
+    """Json array of the dialogue, joined from the memoized bytes of each message."""
+    return b"[\n" + b",\n".join(message.to_json() for message in dialogue) + b"\n]"
+
+def dialogue_tokens(dialogue:list[Message]) -> int:
+    return sum(message.token_count for message in dialogue)
+
+def select_dialogue(dialogue:list[Message], start:int=None, end:int=None, last:int=None, role:str=None) -> list[tuple[int, Message]]:
+    """(index, message) of the entries in [start, end), of the given role if any, and only the last N of them if last is set."""
+    entries = ((index, dialogue[index]) for index in range(len(dialogue))[start:end])
+    if role:
+        entries = ((index, message) for index, message in entries if message.role == role)
+    if last:
+        return list(deque(entries, maxlen=last))
+    return list(entries)
+
+def compact_api(message:Message, max_chars:int=300) -> dict:
+    """The message's API dict with image parts replaced by a marker, and tool results cut to max_chars."""
+    def cut(text:str) -> str:
+        if len(text) <= max_chars or not (message.role == "function" or message.name == "function"):
+            return text
+        return f"{text[:max_chars]}… [{len(text) - max_chars} chars elided]"
+    if isinstance(message.content, str):
+        content = cut(message.content)
+    else:
+        content = "\n".join(cut(part[1]) if part[0] == "text" else "[image]" for part in message.content)
+    compact = {"role": message.role, "content": content}
+    if message.name:
+        compact["name"] = message.name
+    return compact
+
+def dialogue_jsonl_line(index:int, message:Message, compact:bool=False) -> bytes:
+    # Serialized without memoizing, so exporting a whole session keeps no copy of it
+    if compact:
+        payload = json.dumps(compact_api(message), ensure_ascii=False).encode('utf-8')
+    else:
+        payload = message._json or json.dumps(message._api or message._build_api(), ensure_ascii=False).encode('utf-8')
+    return b'{"index": %d, "message": ' % index + payload + b'}\n'
+
+def write_dialogue_jsonl(entries:list[tuple[int, Message]], fileobj, compact:bool=False, chunk_bytes:int=64 * 1024) -> int:
+    """
+    Stream (index, message) entries into fileobj as gzip compressed JSONL, written in chunks of about chunk_bytes,
+    so memory use does not grow with the dialogue. Returns the number of lines written.
+    """
+    count = 0
+    chunk = []
+    size = 0
+    with gzip.GzipFile(fileobj=fileobj, mode='wb') as gz:
+        for index, message in entries:
+            line = dialogue_jsonl_line(index, message, compact)
+            chunk.append(line)
+            size += len(line)
+            count += 1
+            if size >= chunk_bytes:
+                gz.write(b"".join(chunk))
+                chunk.clear()
+                size = 0
+        if chunk:
+            gz.write(b"".join(chunk))
+    return count
@@ -0,0 +1,150 @@
+import os
+import re
+import json
+import time
+
+from Scripts.utilities.turn_budget import estimate_cost
+from Scripts.utilities.completion_cache import get_completion_cache
+from Scripts.utilities.resilience import get_resilience
+
+DEFAULT_ROUTES:dict = {
+    "chat": "gpt-4-1106-preview",
+    "chat_hard": "gpt-4-1106-preview",
+    "vision": "gpt-4-turbo",
+    "summarize": "gpt-4-turbo-preview",
+    "tool_post": "gpt-4-turbo-preview",
+    "classification": "gpt-4-turbo-preview",
+}
+
+# Models without native tool calls, driven through the xml protocol instead
+XML_TOOL_MODELS:tuple = ("gpt-4-vision-preview", "gpt-4-1106-vision-preview")
+
+class RouteStats(object):
+    __slots__ = ("calls", "cache_hits", "latency", "max_latency", "prompt_tokens", "completion_tokens", "cost")
+
+    def __init__(self):
+        self.calls = 0
+        self.cache_hits = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cost = 0.0
+
+
+class ModelRouter(object):
+    """
+    Chooses the model of every completion by task route, and tracks latency and cost per route.
+
+    Routes are read from Resource/model_routes.json (reloaded when the file changes) or the MODEL_ROUTES env var,
+    both as {"routes": {"chat": "...", ...}, "escalate": true, "xml_tool_models": [...]}. With escalate on, chat turns
+    go to the "chat" model unless the local heuristic finds them hard, in which case they go to "chat_hard".
+    xml_tool_models lists the models that have no native tool calls.
+    """
+    _hard_patterns = re.compile(r"```|\b(why|explain|compare|prove|analy[sz]e|derive|step by step|algorithm|debug|optimi[sz]e)\b|"
+                                r"왜|설명|비교|증명|분석|유도|단계별|알고리즘|디버그|최적화|코드|계산")
+
+    def __init__(self, config_path:str=os.path.join('Resource', 'model_routes.json')):
+        self.config_path = config_path
+        self.routes:dict = dict(DEFAULT_ROUTES)
+        self.escalate:bool = False
+        self.xml_tool_models:tuple = XML_TOOL_MODELS
+        self.stats:dict = {}
+        self._config_mtime:float = None
+        self.reload()
+
+    def reload(self) -> None:
+        config = {}
+        try:
+            mtime = os.path.getmtime(self.config_path)
+            if mtime == self._config_mtime:
+                return
+            with open(self.config_path, 'r', encoding='utf-8') as f:
+                config = json.load(f)
+            self._config_mtime = mtime
+        except FileNotFoundError:
+            if self._config_mtime is None and os.getenv('MODEL_ROUTES'):
+                config = json.loads(os.getenv('MODEL_ROUTES'))
+            self._config_mtime = -1.0
+        except json.JSONDecodeError as e:
+            print(f"Invalid model route config, keeping current routes: {e}")
+            return
+        if not config:
+            return
+        self.routes = {**DEFAULT_ROUTES, **config.get("routes", {})}
+        self.escalate = bool(config.get("escalate", False))
+        self.xml_tool_models = tuple(config.get("xml_tool_models", XML_TOOL_MODELS))
+
+    def is_hard(self, text:str) -> bool:
+        """Cheap local guess of whether a chat turn needs the stronger model."""
+        if not text:
+            return False
+        return len(text) > 400 or text.count("?") > 1 or self._hard_patterns.search(text.lower()) is not None
+
+    def model_for(self, route:str, text:str=None) -> str:
+        self.reload()
+        if route == "chat" and self.escalate and self.is_hard(text):
+            route = "chat_hard"
+        return self.routes.get(route, DEFAULT_ROUTES.get(route, DEFAULT_ROUTES["chat"]))
+
+    def supports_native_tools(self, model:str) -> bool:
+        return model not in self.xml_tool_models
+
+    def record(self, route:str, model:str, latency:float, prompt_tokens:int=0, completion_tokens:int=0) -> None:
+        stats = self.stats.setdefault((route, model), RouteStats())
+        stats.calls += 1
+        stats.latency += latency
+        stats.max_latency = max(stats.max_latency, latency)
+        stats.prompt_tokens += prompt_tokens
+        stats.completion_tokens += completion_tokens
+        stats.cost += estimate_cost(model, prompt_tokens, completion_tokens)
+
+    def create(self, client, route:str, text:str=None, model:str=None, **kwargs):
+        """
+        chat.completions.create on the route's model, or the given one, recording latency and usage.
+        Runs under the openai upstream's deadline and breaker, without hedging since completions are billed.
+        """
+        model = model or self.model_for(route, text)
+        start = time.perf_counter()
+        response = get_resilience().call("openai", client.chat.completions.create, idempotent=False, model=model, **kwargs)
+        usage = getattr(response, 'usage', None)
+        self.record(route, model, time.perf_counter() - start,
+                    usage.prompt_tokens if usage else 0, usage.completion_tokens if usage else 0)
+        return response
+
+    def complete(self, client, route:str, text:str=None, cache_ttl:float=None, **kwargs) -> str:
+        """
+        Text of a completion on the route's model. With cache_ttl set, the answer is looked up in and stored to the
+        completion cache for that many seconds, so only opt in where the same input must give the same answer.
+        """
+        if cache_ttl is None:
+            return self.create(client, route, text, **kwargs).choices[0].message.content
+        cache = get_completion_cache()
+        model = self.model_for(route, text)
+        params = {name: value for name, value in kwargs.items() if name != "messages"}
+        key = cache.make_key(model, kwargs.get("messages", []), params)
+        content = cache.get(key)
+        if content is not None:
+            self.stats.setdefault((route, model), RouteStats()).cache_hits += 1
+            return content
+        content = self.create(client, route, text, model=model, **kwargs).choices[0].message.content
+        if content:
+            cache.put(key, content, cache_ttl)
+        return content
+
+    def report(self) -> str:
+        lines = [f"{'route':<15}{'model':<24}{'calls':>6}{'hits':>6}{'avg s':>8}{'max s':>8}{'tokens':>10}{'cost $':>9}"]
+        for (route, model), stats in sorted(self.stats.items()):
+            lines.append(f"{route:<15}{model:<24}{stats.calls:>6}{stats.cache_hits:>6}{stats.latency / max(stats.calls, 1):>8.2f}{stats.max_latency:>8.2f}"
+                         f"{stats.prompt_tokens + stats.completion_tokens:>10}{stats.cost:>9.3f}")
+        return "\n".join(lines)
+
+
+_router:ModelRouter = None
+
+def get_router() -> ModelRouter:
+    """The model router shared by the chatbot, the tool handler and the DART agent."""
+    global _router
+    if _router is None:
+        _router = ModelRouter()
+    return _router
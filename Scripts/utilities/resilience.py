@@ -0,0 +1,259 @@
+import os
+import time
+import threading
+from collections import deque, OrderedDict
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import openai
+import requests
+
+# name: (deadline in seconds, hedge idempotent calls)
+UPSTREAM_DEFAULTS:dict = {
+    "openai": (120.0, False),
+    "openai-images": (120.0, False),
+    "serpapi": (20.0, True),
+    "open-meteo": (10.0, True),
+    "nominatim": (10.0, True),
+    "youtube": (30.0, True),
+    "nasa": (30.0, True),
+    "dart": (30.0, True),
+    "crawl": (30.0, True),
+}
+
+# Hosts fetched through the http cache, other hosts are crawl targets with a breaker each
+UPSTREAM_HOSTS:dict = {
+    "api.open-meteo.com": "open-meteo",
+    "api.nasa.gov": "nasa",
+    "serpapi.com": "serpapi",
+    "opendart.fss.or.kr": "dart",
+}
+
+def upstream_for_url(url:str) -> str:
+    host = urlsplit(url).netloc.lower()
+    return UPSTREAM_HOSTS.get(host, f"crawl:{host}")
+
+# Errors that say the upstream is unhealthy rather than the request bad, along with 5xx and 429 answers
+TRANSIENT_ERRORS:tuple = (TimeoutError, ConnectionError, requests.ConnectionError, requests.Timeout, openai.APIConnectionError)
+
+def is_transient(error:BaseException, transient:tuple=()) -> bool:
+    if isinstance(error, TRANSIENT_ERRORS + tuple(transient)):
+        return True
+    # openai's status errors carry status_code, requests' HTTPError its response
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return isinstance(status, int) and (status >= 500 or status == 429)
+
+
+class UpstreamUnavailable(Exception):
+    """Raised without calling the upstream while its circuit breaker is open."""
+    def __init__(self, upstream:str, retry_after:float):
+        super().__init__(f"{upstream} is unavailable, retry in {retry_after:.0f}s")
+        self.upstream = upstream
+        self.retry_after = retry_after
+
+
+class UpstreamTimeout(TimeoutError):
+    def __init__(self, upstream:str, deadline:float):
+        super().__init__(f"{upstream} did not answer within {deadline:g}s")
+        self.upstream = upstream
+        self.deadline = deadline
+
+
+class Upstream(object):
+    """
+    Deadline, latency window and circuit breaker of one external dependency.
+
+    The breaker opens after failure_threshold consecutive failures or timeouts, rejects calls for reset_timeout
+    seconds, then lets a single probe through (half open): a success closes it, a failure opens it again.
+    """
+    def __init__(self, name:str, deadline:float, hedge:bool, failure_threshold:int=5, reset_timeout:float=30.0,
+                 window:int=200, min_samples:int=20):
+        self.name = name
+        self.deadline = deadline
+        self.hedge = hedge
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.min_samples = min_samples
+        self.latencies:deque = deque(maxlen=window)
+        self.state:str = "closed"
+        self.consecutive_failures:int = 0
+        self.opened_at:float = 0.0
+        self.calls:int = 0
+        self.failures:int = 0
+        self.timeouts:int = 0
+        self.rejected:int = 0
+        self.hedged:int = 0
+        self.hedge_wins:int = 0
+        self._probing:bool = False
+        self._lock = threading.Lock()
+
+    def p95(self) -> float:
+        """95th percentile latency of recent successful calls, or None until min_samples are recorded."""
+        if len(self.latencies) < self.min_samples:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    def retry_after(self) -> float:
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "open" and self.retry_after() == 0:
+                self.state = "half_open"
+            if self.state == "half_open":
+                if self._probing:
+                    self.rejected += 1
+                    return False
+                self._probing = True
+            elif self.state == "open":
+                self.rejected += 1
+                return False
+            self.calls += 1
+            return True
+
+    def record_hedge(self) -> None:
+        with self._lock:
+            self.hedged += 1
+
+    def record_success(self, latency:float, hedge_won:bool=False) -> None:
+        with self._lock:
+            self.hedge_wins += hedge_won
+            self.latencies.append(latency)
+            self.consecutive_failures = 0
+            self.state = "closed"
+            self._probing = False
+
+    def record_failure(self, timeout:bool=False) -> None:
+        with self._lock:
+            self.failures += 1
+            self.timeouts += timeout
+            self.consecutive_failures += 1
+            if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold:
+                if self.state != "open":
+                    print(f"Circuit breaker for {self.name} opened after {self.consecutive_failures} failures")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+            self._probing = False
+
+    def release(self) -> None:
+        """End a call that tells nothing about the upstream's health, letting the next call probe a half open breaker."""
+        with self._lock:
+            self._probing = False
+
+
+class Resilience(object):
+    """
+    Runs calls to external dependencies under a per upstream deadline, hedging and circuit breaker.
+
+    Calls run on a shared worker pool so the caller can stop waiting at the deadline. Once an upstream has enough
+    latency samples, an idempotent call still running at its p95 gets a duplicate request, and the first answer wins,
+    which cuts the tail without doubling the load. While a breaker is open calls fail fast, with the fallback's
+    result when the caller passes one (a stale cached copy or a degraded answer) or with UpstreamUnavailable.
+    Only timeouts, connection errors and 5xx or 429 answers count against the breaker. Other errors, such as a
+    video without a transcript or a prompt over the context length, are the request's fault and are raised as is.
+    The request threads of abandoned calls finish in the background, bounded by their socket timeouts.
+    Crawled hosts get a breaker each, only the max_crawl_upstreams most recently used are kept.
+    """
+    def __init__(self, max_workers:int=int(os.getenv('RESILIENCE_MAX_WORKERS') or 32),
+                 max_crawl_upstreams:int=int(os.getenv('RESILIENCE_MAX_CRAWL_HOSTS') or 256)):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="upstream")
+        self.max_crawl_upstreams = max_crawl_upstreams
+        # Least recently used crawl upstreams first
+        self.upstreams:OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def upstream(self, name:str) -> Upstream:
+        upstream = self.upstreams.get(name)
+        crawl = name.startswith("crawl:")
+        if upstream is None or crawl:
+            with self._lock:
+                upstream = self.upstreams.get(name)
+                if upstream is None:
+                    deadline, hedge = UPSTREAM_DEFAULTS.get(name.split(":")[0], (30.0, False))
+                    upstream = self.upstreams[name] = Upstream(name, deadline, hedge)
+                    if crawl:
+                        self._evict_crawl_upstreams()
+                elif crawl:
+                    self.upstreams.move_to_end(name)
+        return upstream
+
+    def _evict_crawl_upstreams(self) -> None:
+        """Drop the least recently used crawl upstream over the limit, preferring a closed breaker. Under the lock."""
+        crawl = [name for name in self.upstreams if name.startswith("crawl:")]
+        if len(crawl) <= self.max_crawl_upstreams:
+            return
+        closed = [name for name in crawl if self.upstreams[name].state == "closed"]
+        del self.upstreams[(closed or crawl)[0]]
+
+    def call(self, name:str, fn, *args, fallback=None, idempotent:bool=True, deadline:float=None, transient:tuple=(),
+             **kwargs):
+        """
+        fn(*args, **kwargs) under the upstream's policy. fallback, a function without arguments, answers instead
+        when the breaker is open or the call fails transiently or times out. transient adds the exception types
+        of fn's client that mean the upstream is unhealthy.
+        """
+        upstream = self.upstream(name)
+        if not upstream.allow():
+            if fallback is not None:
+                return fallback()
+            raise UpstreamUnavailable(name, upstream.retry_after())
+
+        deadline = deadline or upstream.deadline
+        hedge_delay = upstream.p95() if idempotent and upstream.hedge else None
+        if hedge_delay is not None and hedge_delay >= deadline:
+            hedge_delay = None
+        start = time.monotonic()
+        first = self.executor.submit(fn, *args, **kwargs)
+        pending = {first}
+        error = None
+        while pending:
+            elapsed = time.monotonic() - start
+            if elapsed >= deadline:
+                break
+            timeout = deadline - elapsed
+            if hedge_delay is not None:
+                timeout = min(timeout, max(0.0, hedge_delay - elapsed))
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                error = future.exception()
+                if error is None:
+                    upstream.record_success(time.monotonic() - start, hedge_won=future is not first)
+                    return future.result()
+                if not is_transient(error, transient):
+                    upstream.release()
+                    raise error
+            if hedge_delay is not None and pending and time.monotonic() - start >= hedge_delay:
+                # Still running at the p95, send a duplicate and take whichever answers first
+                pending.add(self.executor.submit(fn, *args, **kwargs))
+                upstream.record_hedge()
+                hedge_delay = None
+
+        upstream.record_failure(timeout=bool(pending))
+        if fallback is not None:
+            return fallback()
+        if pending:
+            raise UpstreamTimeout(name, deadline)
+        raise error
+
+    def report(self) -> str:
+        lines = [f"{'upstream':<28}{'state':<10}{'calls':>6}{'fail':>6}{'t/o':>5}{'rej':>5}{'hedge':>6}{'won':>5}{'p95 s':>7}"]
+        with self._lock:
+            upstreams = list(self.upstreams.items())
+        for name, upstream in sorted(upstreams):
+            p95 = upstream.p95()
+            lines.append(f"{name[:27]:<28}{upstream.state:<10}{upstream.calls:>6}{upstream.failures:>6}{upstream.timeouts:>5}"
+                         f"{upstream.rejected:>5}{upstream.hedged:>6}{upstream.hedge_wins:>5}{p95 if p95 is not None else 0:>7.2f}")
+        return "\n".join(lines)
+
+
+_resilience:Resilience = None
+
+def get_resilience() -> Resilience:
+    """The resilience layer shared by every upstream call of the bot."""
+    global _resilience
+    if _resilience is None:
+        _resilience = Resilience()
+    return _resilience
@@ -0,0 +1,72 @@
+import os
+import hashlib
+
+class ResultStore(object):
+    """
+    Local store for large tool results.
+
+    A result over digest_tokens is written to disk under a short handle, and the dialogue only gets a
+    token capped digest telling the model how to page through the rest with read_result.
+    The oldest results are deleted once more than max_results are stored.
+    """
+    def __init__(self, encoder, store_dir:str=os.path.join('Resource', 'cache', 'results'),
+                 digest_tokens:int=int(os.getenv('RESULT_DIGEST_TOKENS') or 500), max_results:int=256,
+                 max_page_chars:int=8000):
+        self.encoder = encoder
+        self.store_dir = store_dir
+        self.digest_tokens = digest_tokens
+        self.max_results = max_results
+        self.max_page_chars = max_page_chars
+        os.makedirs(self.store_dir, exist_ok=True)
+
+    def _path(self, handle:str) -> str:
+        return os.path.join(self.store_dir, f"{handle}.txt")
+
+    def store(self, text:str) -> str:
+        handle = "res_" + hashlib.sha1(text.encode('utf-8')).hexdigest()[:10]
+        path = self._path(handle)
+        if not os.path.exists(path):
+            with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                f.write(text)
+            os.replace(path + '.tmp', path)
+            self._evict()
+        else:
+            os.utime(path)
+        return handle
+
+    def _evict(self) -> None:
+        files = [os.path.join(self.store_dir, name) for name in os.listdir(self.store_dir) if name.endswith('.txt')]
+        if len(files) <= self.max_results:
+            return
+        files.sort(key=os.path.getmtime)
+        for path in files[:len(files) - self.max_results]:
+            os.remove(path)
+
+    def digest(self, name:str, text:str) -> str:
+        """
+        Return the text as is when it is small enough, otherwise store it and return its head with a paging note.
+        """
+        tokens = self.encoder.encode(text)
+        if len(tokens) <= self.digest_tokens:
+            return text
+        handle = self.store(text)
+        head = self.encoder.decode(tokens[:self.digest_tokens])
+        return (f"{head}\n[{name} result truncated: {len(text)} chars / {len(tokens)} tokens in total, "
+                f"stored as handle \"{handle}\". Call read_result with handle=\"{handle}\", offset={len(head)} "
+                f"and a length of up to {self.max_page_chars} chars to read more.]")
+
+    def read(self, handle:str, offset:int=0, length:int=4000) -> str:
+        path = self._path(os.path.basename(handle))
+        if not os.path.exists(path):
+            return f"No stored result with handle {handle}."
+        length = max(1, min(int(length), self.max_page_chars))
+        offset = max(0, int(offset))
+        with open(path, 'r', encoding='utf-8') as f:
+            text = f.read()
+        page = text[offset:offset + length]
+        end = offset + len(page)
+        if end < len(text):
+            page += f"\n[chars {offset}-{end} of {len(text)}, continue with offset={end}]"
+        else:
+            page += f"\n[chars {offset}-{end} of {len(text)}, end of result]"
+        return page
@@ -0,0 +1,140 @@
+import os
+import json
+import asyncio
+import datetime
+
+class ScheduledJob(object):
+    def __init__(self, name:str, at:datetime.time, callback, prefetch=None, prefetch_lead:datetime.timedelta=datetime.timedelta(minutes=5)):
+        self.name = name
+        self.at = at if at.tzinfo is not None else at.replace(tzinfo=datetime.timezone.utc)
+        self.callback = callback
+        self.prefetch = prefetch
+        self.prefetch_lead = prefetch_lead
+        self.prefetch_task:asyncio.Task = None
+        self.prefetch_due:datetime.datetime = None
+        self.retry_at:datetime.datetime = None
+
+    def due_on(self, date:datetime.date) -> datetime.datetime:
+        return datetime.datetime.combine(date, self.at.replace(tzinfo=None), tzinfo=self.at.tzinfo)
+
+
+class JobScheduler(object):
+    """
+    Runs daily jobs of cogs at exact wall-clock times.
+
+    The last run date of each job is persisted, so a restart neither posts twice nor skips a day:
+    a run missed while the bot was down is caught up if it is less than catch_up old.
+    A job whose callback raises is retried every retry_delay, within the same catch_up window.
+    Jobs can have an async prefetch coroutine, started prefetch_lead before the due time,
+    whose result is passed to the job callback.
+    """
+    def __init__(self, bot, state_path:str=os.path.join('Resource', 'cache', 'scheduler_state.json'),
+                 catch_up:datetime.timedelta=datetime.timedelta(hours=12),
+                 retry_delay:datetime.timedelta=datetime.timedelta(minutes=5)):
+        self.bot = bot
+        self.state_path = state_path
+        self.catch_up = catch_up
+        self.retry_delay = retry_delay
+        self.jobs:dict = {}
+        self.state:dict = self.load_state()
+        self._task:asyncio.Task = None
+        self._wakeup = asyncio.Event()
+
+    def load_state(self) -> dict:
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def save_state(self) -> None:
+        os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.state, f, indent=4)
+        os.replace(tmp_path, self.state_path)
+
+    def add_daily_job(self, name:str, at:datetime.time, callback, prefetch=None,
+                      prefetch_lead:datetime.timedelta=datetime.timedelta(minutes=5)) -> ScheduledJob:
+        job = ScheduledJob(name, at, callback, prefetch, prefetch_lead)
+        self.jobs[name] = job
+        self._wakeup.set()
+        return job
+
+    def remove_job(self, name:str) -> None:
+        job = self.jobs.pop(name, None)
+        if job is not None and job.prefetch_task is not None:
+            job.prefetch_task.cancel()
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+
+    def next_due(self, job:ScheduledJob, now:datetime.datetime) -> datetime.datetime:
+        last_run = self.state.get(job.name, {}).get('last_run')
+        due = job.due_on(now.astimezone(job.at.tzinfo).date())
+        if last_run is not None and last_run >= due.date().isoformat():
+            return job.due_on(due.date() + datetime.timedelta(days=1))
+        if due <= now and now - due > self.catch_up:
+            return job.due_on(due.date() + datetime.timedelta(days=1))
+        return due
+
+    async def _run(self) -> None:
+        await self.bot.wait_until_ready()
+        while True:
+            self._wakeup.clear()
+            now = datetime.datetime.now(datetime.timezone.utc)
+            wake_at = now + datetime.timedelta(hours=1)
+            for job in list(self.jobs.values()):
+                if job.retry_at is not None and now < job.retry_at:
+                    wake_at = min(wake_at, job.retry_at)
+                    continue
+                due = self.next_due(job, now)
+                if job.prefetch is not None and job.prefetch_due != due and now >= due - job.prefetch_lead:
+                    job.prefetch_due = due
+                    job.prefetch_task = asyncio.create_task(job.prefetch())
+                if now >= due:
+                    await self._run_job(job, due)
+                    continue
+                wake_at = min(wake_at, due)
+                if job.prefetch is not None and job.prefetch_due != due:
+                    wake_at = min(wake_at, due - job.prefetch_lead)
+            delay = (wake_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(delay, 0))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run_job(self, job:ScheduledJob, due:datetime.datetime) -> None:
+        prefetched = None
+        if job.prefetch_task is not None and job.prefetch_due == due:
+            try:
+                prefetched = await job.prefetch_task
+            except Exception as e:
+                print(f"Prefetch of job {job.name} failed: {e}")
+        job.prefetch_task = None
+        job.prefetch_due = None
+        try:
+            await job.callback(prefetched)
+        except Exception as e:
+            print(f"Scheduled job {job.name} failed, retrying in {self.retry_delay}: {e}")
+            job.retry_at = datetime.datetime.now(datetime.timezone.utc) + self.retry_delay
+            return
+        job.retry_at = None
+        self.state[job.name] = {'last_run': due.date().isoformat(),
+                                'ran_at': datetime.datetime.now(datetime.timezone.utc).isoformat()}
+        self.save_state()
+
+
+def get_scheduler(bot) -> JobScheduler:
+    """Return the scheduler shared by all cogs of the bot, creating and starting it on first use."""
+    scheduler = getattr(bot, 'scheduler', None)
+    if scheduler is None:
+        scheduler = JobScheduler(bot)
+        bot.scheduler = scheduler
+    scheduler.start()
+    return scheduler
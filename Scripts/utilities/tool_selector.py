@@ -0,0 +1,90 @@
+import os
+import re
+import math
+
+# Extra trigger words per tool, in English and Korean. Matched as substrings, since Korean attaches particles to words.
+TOOL_KEYWORDS:dict = {
+    "search_online": ["search", "google", "news", "latest", "recent", "who is", "when", "price", "stock", "score",
+                      "검색", "찾아", "뉴스", "최신", "최근", "누구", "언제", "어디", "가격", "주가", "결과"],
+    "execute_custom_code": ["code", "python", "calculate", "compute", "random", "plot", "math", "sqrt",
+                            "계산", "코드", "파이썬", "실행", "운세", "랜덤", "확률", "수학"],
+    "execute_shell_command": ["shell", "command", "bash", "file", "directory", "folder", "install", "disk", "cpu",
+                              "파일", "명령", "쉘", "터미널", "폴더", "디렉토리", "설치", "시스템"],
+    "get_weather": ["weather", "temperature", "rain", "snow", "forecast", "humid", "umbrella",
+                    "날씨", "기온", "온도", "비가", "비 와", "눈이", "예보", "습도", "우산", "미세먼지"],
+    "youtube_transcript": ["youtube", "youtu.be", "video", "transcript", "유튜브", "영상", "동영상", "자막"],
+    "crawl_from_url": ["http://", "https://", "www.", "url", "link", "website", "web page", "article",
+                       "링크", "사이트", "페이지", "기사", "주소"],
+    "draw_image": ["draw", "image", "picture", "paint", "illustration", "sketch", "logo",
+                   "그려", "그림", "이미지", "사진", "일러스트", "로고"],
+    "read_result": ["res_", "handle", "continue", "rest of", "more of", "계속", "나머지", "더 보여"],
+}
+
+class ToolSelector(object):
+    """
+    Picks the tool schemas relevant to a user message, to keep them out of prompts that don't need them.
+
+    A keyword index is built once from the trigger words above and the words of each tool's name and description,
+    weighted by inverse document frequency so words shared by many tools count less.
+    The top_k tools scoring at least min_score are selected, so one shared description word alone does not select a tool.
+    When nothing matches, a short follow-up ("and in Busan?") reuses the tools of the previous user message.
+    Any other message without a match gets the full set, so the model is never left without tools.
+    A channel that enables only some tools selects among those, and falls back to all of them.
+    """
+    _word = re.compile(r"[a-z_]{3,}")
+    STOPWORDS:frozenset = frozenset(["the", "and", "for", "from", "with", "that", "this", "you", "your", "are", "can",
+                                     "will", "used", "use", "when", "what", "must", "should", "always", "default", "given",
+                                     "get", "via", "its", "into", "result", "return", "one", "which", "example"])
+
+    def __init__(self, tool_list:list[dict], top_k:int=int(os.getenv('TOOL_SELECT_TOP_K') or 3),
+                 fallback_chars:int=int(os.getenv('TOOL_SELECT_FALLBACK_CHARS') or 40), min_score:float=1.5):
+        self.tool_list = tool_list
+        self.top_k = top_k
+        self.min_score = min_score
+        self.fallback_chars = fallback_chars
+        self.tools = {tool["function"]["name"]: tool for tool in tool_list}
+        terms = {}
+        for name, tool in self.tools.items():
+            description = tool["function"]["name"].replace("_", " ") + " " + tool["function"].get("description", "")
+            words = set(self._word.findall(description.lower())) - self.STOPWORDS
+            keywords = set(keyword.lower() for keyword in TOOL_KEYWORDS.get(name, []))
+            terms[name] = (keywords, words - keywords)
+        document_frequency = {}
+        for keywords, words in terms.values():
+            for term in keywords | words:
+                document_frequency[term] = document_frequency.get(term, 0) + 1
+        tool_count = len(self.tools)
+        # Description words shared by most tools tell nothing apart
+        terms = {name: (keywords, {word for word in words if document_frequency[word] <= tool_count / 2})
+                 for name, (keywords, words) in terms.items()}
+        # Trigger words weigh more than plain description words
+        self.index = {name: [(term, 2.0 * math.log(1 + tool_count / document_frequency[term])) for term in keywords] +
+                            [(term, 0.5 * math.log(1 + tool_count / document_frequency[term])) for term in words]
+                      for name, (keywords, words) in terms.items()}
+
+    def score(self, text:str) -> dict:
+        text = text.lower()
+        words = set(self._word.findall(text))
+        scores = {}
+        for name, terms in self.index.items():
+            score = sum(weight for term, weight in terms if (term in words if term.isalpha() and term.isascii() else term in text))
+            if score >= self.min_score:
+                scores[name] = score
+        return scores
+
+    def _top(self, text:str, allowed:frozenset=None) -> list[str]:
+        scores = {name: score for name, score in self.score(text).items() if allowed is None or name in allowed}
+        return sorted(scores, key=scores.get, reverse=True)[:self.top_k]
+
+    def select(self, text:str, always:list[str]=(), previous:str=None, allowed:frozenset=None) -> list[dict]:
+        """
+        Tool schemas for text. previous is the user message before it, whose tools a short follow-up reuses.
+        allowed limits the selection to those tool names, None allows every tool.
+        """
+        names = self._top(text, allowed)
+        if not names and previous and len(text.strip()) <= self.fallback_chars:
+            names = self._top(previous, allowed)
+        if not names:
+            return [tool for name, tool in self.tools.items() if allowed is None or name in allowed]
+        names += [name for name in always if name in self.tools and name not in names and (allowed is None or name in allowed)]
+        return [self.tools[name] for name in names]
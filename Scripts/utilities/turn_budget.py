@@ -0,0 +1,73 @@
+import os
+import time
+
+# USD per 1K tokens, (prompt, completion)
+MODEL_PRICES:dict = {
+    "gpt-4": (0.03, 0.06),
+    "gpt-4-1106-preview": (0.01, 0.03),
+    "gpt-4-turbo-preview": (0.01, 0.03),
+    "gpt-4-turbo": (0.01, 0.03),
+    "gpt-4-vision-preview": (0.01, 0.03),
+    "gpt-4o": (0.005, 0.015),
+    "gpt-4o-mini": (0.00015, 0.0006),
+    "gpt-3.5-turbo": (0.0005, 0.0015),
+}
+
+def estimate_cost(model:str, prompt_tokens:int, completion_tokens:int) -> float:
+    # Dated snapshots such as gpt-3.5-turbo-0125 are priced as their base model
+    prices = MODEL_PRICES.get(model) or next((MODEL_PRICES[name] for name in sorted(MODEL_PRICES, key=len, reverse=True)
+                                             if model.startswith(name)), MODEL_PRICES["gpt-4-turbo"])
+    prompt_price, completion_price = prices
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+
+class TurnBudget(object):
+    """
+    Hard limits of one chat turn: tool rounds, wall time, cumulative tokens and cost.
+
+    The tool-calling loop records every completion and tool round, and checks exceeded() before asking
+    the model again. Once a limit is hit the loop makes one last call with tools disabled, to force an answer.
+    """
+    def __init__(self, max_tool_rounds:int=None, max_seconds:float=None, max_tokens:int=None, max_cost:float=None):
+        self.max_tool_rounds = max_tool_rounds if max_tool_rounds is not None else int(os.getenv('TURN_MAX_TOOL_ROUNDS') or 5)
+        self.max_seconds = max_seconds if max_seconds is not None else float(os.getenv('TURN_MAX_SECONDS') or 120)
+        self.max_tokens = max_tokens if max_tokens is not None else int(os.getenv('TURN_MAX_TOKENS') or 60000)
+        self.max_cost = max_cost if max_cost is not None else float(os.getenv('TURN_MAX_COST') or 0.5)
+        self.started = time.monotonic()
+        self.tool_rounds:int = 0
+        self.tokens:int = 0
+        self.cost:float = 0.0
+        self.forced:str = None
+
+    def record_completion(self, model:str, prompt_tokens:int, completion_tokens:int) -> None:
+        self.tokens += prompt_tokens + completion_tokens
+        self.cost += estimate_cost(model, prompt_tokens, completion_tokens)
+
+    def record_tool_round(self) -> None:
+        self.tool_rounds += 1
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def exceeded(self) -> str:
+        """Name of the first limit reached, or None."""
+        if self.tool_rounds >= self.max_tool_rounds:
+            return f"tool rounds {self.tool_rounds}/{self.max_tool_rounds}"
+        if self.elapsed >= self.max_seconds:
+            return f"wall time {self.elapsed:.0f}s/{self.max_seconds:.0f}s"
+        if self.tokens >= self.max_tokens:
+            return f"tokens {self.tokens}/{self.max_tokens}"
+        if self.cost >= self.max_cost:
+            return f"cost ${self.cost:.3f}/${self.max_cost:.2f}"
+        return None
+
+    def force_answer_prompt(self, reason:str) -> str:
+        self.forced = reason
+        return (f"The budget of this turn is used up ({reason}). Do not call any more tools. "
+                "Answer the user now with the information you already have, and mention what is missing if anything.")
+
+    def report(self) -> str:
+        text = f"rounds {self.tool_rounds}, {self.elapsed:.1f}s, {self.tokens} tokens, ${self.cost:.3f}"
+        if self.forced:
+            text += f" (limit reached: {self.forced})"
+        return text
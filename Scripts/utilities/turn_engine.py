@@ -0,0 +1,309 @@
+import json
+import time
+import asyncio
+import threading
+import yaml
+import discord
+
+from Scripts.utilities.message import Message, to_api_messages, dialogue_tokens
+from Scripts.utilities.turn_budget import TurnBudget
+from Scripts.utilities.xml_stream_parser import XMLStreamParser
+from Scripts.utilities.resilience import get_resilience, is_transient, UpstreamTimeout
+
+XML_PROTOCOL_PROMPT:str = r'''
+Your response should be in xml format, in the template:
+```xml
+<root>
+    <thought> (your thought) </thought>
+    <answer> (your response) </answer>
+    <function_call> (function call argument in json, loads ready) </function_call>
+</root>
+```
+where you will give your thought(This must ALWAYS be in English), answer(This should be in language user spoke in), and function_call argument. For example, for user input "안녕!", your response should be
+```xml
+<root>
+    <thought>User greeted me, I should greet back.</thought>
+    <answer>안녕하세요!</answer>
+    <function_call></function_call>
+</root>
+```
+and when using function call, the function_call node should include a json object, json.loads ready in form:
+(For instance, when asked to calculate sqrt(2) using python)
+```xml
+<root>
+    <thought>Using execute_custom_code, I can calculate the value of sqrt(2). </thought>
+    <answer>파이썬 코드를 이용해 sqrt(2)의 값을 구하겠습니다.</answer>
+    <function_call>{"name": "execute_custom_code", "argument": {"code_str": "import math\nresult = math.sqrt(2)\nresult"}</function_call>
+</root>
+```
+Your xml response should ALWAYS contain a thought, and EITHER One of <answer> or <function_call> MUST NOT BE EMPTY.
+ALWAYS REMEMBER to answer to user with <answer> node, DO NOT leave them blank. Even after using function, you should answer to user with <answer> node.'''
+
+# (role, text) of the few-shot turns sent with the xml protocol
+XML_FEW_SHOT:tuple = (
+    ("user", "(23-11-15/11:32:42|nemit)안녕"),
+    ("assistant", """<root>
+    <thought>User greeted me, I should greet back.</thought>
+    <answer>안녕하세요!</answer>
+    <function_call></function_call>
+</root>""")
+)
+
+class TurnEngine(object):
+    """
+    Runs a user turn to its answer, for the text and the vision channel alike: model call, tool dispatch and
+    result feedback, until the model answers without calling a tool or the turn budget is used up.
+
+    Models with native tool calls get the selected tool schemas and return structured calls, so the dialogue
+    carries no protocol overhead. Only models listed as xml_tool_models in the router fall back to the xml
+    protocol: its instructions, the catalog of the selected tools and a few-shot example are added to the request
+    at call time and never stored, and the answer is streamed into the channel as it is parsed.
+    Both paths store the same entries, plain answers, tool call echoes and function role results, so a dialogue
+    can switch between them when its route changes model.
+    """
+    def __init__(self, client, router, function_handler, select_tools, encoder):
+        self.client = client
+        self.router = router
+        self.function_handler = function_handler
+        self.select_tools = select_tools
+        self.encoder = encoder
+        self.xml_prompt_cache:dict = {}
+        self.xml_few_shot:tuple = tuple(Message.text_message(role, text, vision=True) for role, text in XML_FEW_SHOT)
+
+    async def run(self, channel, dialogue:list[Message], route:str, user_text:str, recalled:Message=None,
+                  model:str=None, tools:frozenset=None, budgets:dict=None) -> None:
+        """
+        Run the turn of the user message that ends the dialogue. Answers and tool results are appended to it.
+        recalled is an optional message placed before the user message for this turn's requests only.
+        model overrides the route's model, tools limits the tools to those names and budgets sets TurnBudget limits.
+        """
+        turn_start = len(dialogue) - 1
+        budget = TurnBudget(**(budgets or {}))
+        model = model or self.router.model_for(route, user_text)
+        step = self._native_step if self.router.supports_native_tools(model) else self._xml_step
+        vision = route == "vision"
+        while True:
+            try:
+                # Selected among the channel's tools, so a turn is not left without any when its matches are disabled
+                selected = self.select_tools(user_text, dialogue, tools)
+                limit = budget.exceeded()
+                calls = await step(channel, dialogue, route, model, user_text, selected, budget, limit, recalled, turn_start)
+                if not calls or limit:
+                    break
+                budget.record_tool_round()
+                for name, arguments in calls:
+                    if tools is not None and name not in tools:
+                        arguments_text = arguments if isinstance(arguments, str) else json.dumps(arguments, ensure_ascii=False)
+                        dialogue.append(Message("assistant", f"Function(arguments='{arguments_text}', name='{name}')"))
+                        dialogue.append(Message.tool_result(name, f"Tool {name} is not enabled in this channel."))
+                        continue
+                    await self.run_tool(channel, dialogue, name, arguments, vision)
+            except Exception as e:
+                print(e)
+                break
+
+    async def _native_step(self, channel, dialogue, route, model, user_text, tools, budget, limit, recalled, turn_start) -> list:
+        messages = to_api_messages(dialogue)
+        if recalled is not None:
+            messages.insert(turn_start, recalled.to_api())
+        if limit:
+            # Out of budget, force a final answer with tools disabled
+            messages.append({"role": "system", "content": budget.force_answer_prompt(limit)})
+        # Only the tools relevant to this message are sent
+        tool_args = {"tools": tools, "tool_choice": "none" if limit else "auto"} if tools else {}
+        # The router waits on the resilience pool for up to the openai deadline, off the event loop
+        response = await asyncio.to_thread(self.router.create, self.client, route, text=user_text, model=model,
+                                           messages=messages, temperature=0.7, **tool_args)
+        print(response)
+        budget.record_completion(response.model, response.usage.prompt_tokens, response.usage.completion_tokens)
+        response_message = response.choices[0].message
+
+        if response_message.content:
+            dialogue.append(Message("assistant", response_message.content))
+            usage = f"\nToken used: {response.usage.total_tokens}"
+            if limit:
+                usage += f" | Turn budget: {budget.report()}"
+            await channel.send(response_message.content + usage)
+        return [(call.function.name, call.function.arguments) for call in response_message.tool_calls or []]
+
+    def xml_system_message(self, base:Message, tools:list[dict]) -> tuple[dict, int]:
+        """The system prompt with the xml protocol and the selected tools' catalog, and its token count, memoized per tool set."""
+        key = (base.text, tuple(tool["function"]["name"] for tool in tools))
+        cached = self.xml_prompt_cache.get(key)
+        if cached is None:
+            if tools:
+                catalog = "\nThe list of functions you can use are:\n" + yaml.dump(tools, allow_unicode=True)
+            else:
+                catalog = "\nNo functions are available for this message, leave <function_call> empty."
+            if len(self.xml_prompt_cache) > 32:
+                self.xml_prompt_cache.clear()
+            message = Message.text_message("system", base.text + XML_PROTOCOL_PROMPT + catalog, vision=True)
+            cached = self.xml_prompt_cache[key] = (message.to_api(), message.token_count)
+        return cached
+
+    def xml_messages(self, dialogue:list[Message], tools:list[dict]) -> tuple[list[dict], int]:
+        """Request messages and prompt token count for the xml protocol. It has no function role, results go as system messages."""
+        system, tokens = self.xml_system_message(dialogue[0], tools)
+        messages = [system] + to_api_messages(self.xml_few_shot)
+        tokens += dialogue_tokens(self.xml_few_shot)
+        for entry in dialogue[1:]:
+            if entry.role == "function":
+                entry = Message.tool_result(entry.name, entry.text, vision=True)
+            messages.append(entry.to_api())
+            tokens += entry.token_count
+        return messages, tokens
+
+    def _read_xml_stream(self, route:str, put, stop:threading.Event, kwargs:dict) -> None:
+        """
+        Worker thread side of stream_xml_response: opens the stream under the openai upstream's deadline and breaker,
+        parses it and hands each event to put. Ends with ("done", (raw_text, parsed_result)), or the error, then None.
+        """
+        upstream = get_resilience().upstream("openai")
+        try:
+            parser = XMLStreamParser()
+            raw_text = ""
+            start = time.perf_counter()
+            stream = get_resilience().call("openai", self.client.chat.completions.create, idempotent=False,
+                                           stream=True, **kwargs)
+            try:
+                for chunk in stream:
+                    if stop.is_set():
+                        return
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if not delta:
+                        continue
+                    raw_text += delta
+                    events = parser.feed(delta)
+                    for event in events:
+                        put(event)
+                    if any(event == "function_call" for event, _ in events):
+                        break
+            except Exception as e:
+                # The stream broke after it opened, which the breaker only sees from here
+                if is_transient(e):
+                    upstream.record_failure()
+                raise
+            finally:
+                stream.close()
+            # Streams carry no usage, the caller records tokens in its turn budget
+            self.router.record(route, kwargs["model"], time.perf_counter() - start)
+            for event in parser.close():
+                put(event)
+            put(("done", (raw_text, parser.result())))
+        except Exception as e:
+            put(e)
+        finally:
+            put(None)
+
+    async def stream_xml_response(self, route:str, **kwargs):
+        """
+        Stream a completion through the incremental xml parser.
+        Yields (event, value) tuples, and stops reading the stream as soon as a function call is complete
+        so the tool can be dispatched before generation finishes.
+        Last yielded item is ("done", (raw_text, parsed_result)).
+        The stream is read on a worker thread that feeds the events to the loop, a silence longer than the openai
+        deadline raises UpstreamTimeout.
+        """
+        loop = asyncio.get_running_loop()
+        events:asyncio.Queue = asyncio.Queue()
+        stop = threading.Event()
+        loop.run_in_executor(None, self._read_xml_stream, route,
+                             lambda item: loop.call_soon_threadsafe(events.put_nowait, item), stop, kwargs)
+        upstream = get_resilience().upstream("openai")
+        try:
+            while True:
+                try:
+                    item = await asyncio.wait_for(events.get(), timeout=upstream.deadline)
+                except asyncio.TimeoutError:
+                    upstream.record_failure(timeout=True)
+                    raise UpstreamTimeout(upstream.name, upstream.deadline)
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # A stalled reader finishes in the background, bounded by the client's socket timeout
+            stop.set()
+
+    async def _xml_step(self, channel, dialogue, route, model, user_text, tools, budget, limit, recalled, turn_start) -> list:
+        messages, prompt_tokens = self.xml_messages(dialogue, tools)
+        if recalled is not None:
+            # Shifted by the few-shot example
+            messages.insert(turn_start + len(self.xml_few_shot), recalled.to_api())
+            prompt_tokens += recalled.token_count
+        if limit:
+            # Out of budget, ask for a final answer and ignore any function call
+            messages.append(Message.text_message("system", budget.force_answer_prompt(limit), vision=True).to_api())
+        answer_message = None
+        answer_text = ""
+        last_edit = 0.0
+        raw_text, parsed = "", None
+        async for event, value in self.stream_xml_response(route, model=model, messages=messages, max_tokens=1024,
+                                                            temperature=0.7):
+            if event == "answer_delta":
+                # Show the answer as it arrives, editing the message at most once a second
+                answer_text += value
+                if answer_message is None:
+                    answer_message = await channel.send(answer_text)
+                    last_edit = time.monotonic()
+                elif time.monotonic() - last_edit > 1.0:
+                    await answer_message.edit(content=answer_text[:2000])
+                    last_edit = time.monotonic()
+            elif event == "done":
+                raw_text, parsed = value
+
+        completion_tokens = len(self.encoder.encode(raw_text))
+        budget.record_completion(model, prompt_tokens, completion_tokens)
+        if parsed['Error']:
+            print(parsed['Error'])
+
+        if parsed['answer']:
+            dialogue.append(Message("assistant", parsed['answer']))
+            final_text = f"{parsed['answer']}\nToken: {prompt_tokens + completion_tokens}"
+            if limit:
+                final_text += f" | Turn budget: {budget.report()}"
+            if answer_message is None:
+                await channel.send(final_text)
+            else:
+                await answer_message.edit(content=final_text[:2000])
+        function_call = parsed['function_call']
+        return [(function_call['name'], function_call['argument'])] if function_call else []
+
+    async def run_tool(self, channel, dialogue:list[Message], name:str, arguments, vision:bool=False) -> None:
+        """Dispatch one tool call, arguments given as a json string or a dict, and append its result to the dialogue."""
+        arguments_text = arguments if isinstance(arguments, str) else json.dumps(arguments, ensure_ascii=False)
+        await channel.send(f"Using tool: {name} with arguments:\n{arguments_text}\n")
+        dialogue.append(Message("assistant", f"Function(arguments='{arguments_text}', name='{name}')"))
+        try:
+            tool_result = await self.function_handler.async_function_call_handler(
+                name=name, arg=json.loads(arguments) if isinstance(arguments, str) else arguments)
+
+            if type(tool_result) == str:
+                if len(tool_result) > 500:
+                    await channel.send(f"Tool result:\n{tool_result[0:128]}...\n")
+                else:
+                    await channel.send(f"Tool result:\n{tool_result}\n")
+                dialogue.append(Message.tool_result(name, tool_result))
+            elif type(tool_result) == dict:
+                response_str = tool_result["response_text"]
+                if tool_result["data"]["name"] == "draw_image":
+                    response_str += f"With prompt {tool_result['data']['prompt']}"
+                    dialogue.append(Message.tool_result(name, response_str))
+                    file_name = tool_result['data']['prompt'][:50] + ".png"
+                    # Uploaded straight from the artifact store
+                    sent_message = await channel.send(file=discord.File(tool_result["data"]["image_path"], filename=file_name))
+                    if vision and sent_message is not None and sent_message.attachments:
+                        # Only user messages can carry images, this lets the vision model see what it drew
+                        dialogue.append(Message("user", (("text", f"({name} output)"),
+                                                         ("image_url", sent_message.attachments[0].url, None))))
+                else:
+                    dialogue.append(Message.tool_result(name, response_str))
+                    await channel.send(response_str)
+
+        except Exception as e:
+            print(e)
+            await channel.send(f"Failed to use tool: {name}||{e}")
+            dialogue.append(Message.tool_result(name, f"Failed to use tool: {name}||{e}"))
@@ -0,0 +1,191 @@
+import os
+import sys
+import time
+import threading
+import contextlib
+from io import StringIO
+from collections import Counter
+
+import discord
+
+class ProfileSession(object):
+    def __init__(self, channel_id:int, turns:int):
+        self.channel_id = channel_id
+        self.turns = turns
+        self.remaining = turns
+        self.stacks:Counter = Counter()
+        self.wall_time:float = 0.0
+
+
+class ProfiledMessage(object):
+    """Wraps a discord message so that the sends and edits of a profiled turn are counted as Discord I/O."""
+    def __init__(self, message, profiler):
+        self._message = message
+        self._profiler = profiler
+        self.channel = ProfiledChannel(message.channel, profiler)
+
+    def __getattr__(self, name):
+        return getattr(self._message, name)
+
+    async def edit(self, **kwargs):
+        with self._profiler.discord_io():
+            return await self._message.edit(**kwargs)
+
+
+class ProfiledChannel(object):
+    def __init__(self, channel, profiler):
+        self._channel = channel
+        self._profiler = profiler
+
+    def __getattr__(self, name):
+        return getattr(self._channel, name)
+
+    async def send(self, *args, **kwargs):
+        with self._profiler.discord_io():
+            message = await self._channel.send(*args, **kwargs)
+        return ProfiledMessage(message, self._profiler) if message is not None else None
+
+
+class TurnProfiler(object):
+    """
+    Sampling profiler for chat turns, armed for the next N turns of a channel.
+
+    While a profiled turn runs, a helper thread samples the event loop thread's stack every interval seconds.
+    Each sample is attributed to a phase: model wait (inside openai, or the loop idling while a worker thread
+    reads a completion stream or waits in the model router), tool execution (inside the tool handlers),
+    serialization (json, yaml, tiktoken, xml parsing), Discord I/O (discord/aiohttp frames, or the loop idling
+    while a send or edit is awaited) or other.
+    The report is a collapsed stack file, with the phase as root frame so it is flame graph ready,
+    and a table of the top functions.
+    """
+    TOOL_FILES:tuple = ("func_call_handler.py", "func_call_logics.py", "dart_agent.py")
+    # Completions run on the resilience pool, a worker thread waits for them in the router
+    MODEL_FILES:tuple = ("model_router.py",)
+    SERIALIZATION_MODULES:tuple = ("json", "yaml", "tiktoken", "xml_stream_parser.py", "base64")
+
+    def __init__(self, interval:float=0.005):
+        self.interval = interval
+        self.session:ProfileSession = None
+        self.active_turns:int = 0
+        self.discord_inflight:int = 0
+        self._loop_thread_id:int = None
+        self._thread:threading.Thread = None
+
+    def arm(self, channel_id:int, turns:int) -> None:
+        self.session = ProfileSession(channel_id, max(turns, 1))
+
+    def armed(self, channel_id:int) -> bool:
+        return self.session is not None and self.session.channel_id == channel_id and self.session.remaining > 0
+
+    @contextlib.contextmanager
+    def discord_io(self):
+        self.discord_inflight += 1
+        try:
+            yield
+        finally:
+            self.discord_inflight -= 1
+
+    @contextlib.asynccontextmanager
+    async def profile_turn(self, message):
+        session = self.session
+        self._loop_thread_id = threading.get_ident()
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._sample, name="turn-profiler", daemon=True)
+            self._thread.start()
+        self.active_turns += 1
+        start = time.perf_counter()
+        try:
+            yield ProfiledMessage(message, self)
+        finally:
+            self.active_turns -= 1
+            session.wall_time += time.perf_counter() - start
+            session.remaining -= 1
+            if session.remaining == 0 and self.session is session:
+                self.session = None
+                await self.send_report(message.channel, session)
+
+    def _sample(self) -> None:
+        while self.session is not None:
+            time.sleep(self.interval)
+            session = self.session
+            if session is None or self.active_turns == 0:
+                continue
+            frames = sys._current_frames()
+            frame = frames.get(self._loop_thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+                frame = frame.f_back
+            stack.reverse()
+            phase = self._phase(stack)
+            if phase == "idle" and self._model_waiting(frames):
+                phase = "model_wait"
+            session.stacks[(phase,) + tuple(stack)] += 1
+
+    def _model_waiting(self, frames:dict) -> bool:
+        """Whether a thread other than the loop's is inside openai or the model router."""
+        for thread_id, frame in frames.items():
+            if thread_id == self._loop_thread_id:
+                continue
+            while frame is not None:
+                if self._is_model_file(frame.f_code.co_filename):
+                    return True
+                frame = frame.f_back
+        return False
+
+    def _is_model_file(self, filename:str) -> bool:
+        return f"{os.sep}openai{os.sep}" in filename or f"{os.sep}httpx{os.sep}" in filename or filename.endswith(self.MODEL_FILES)
+
+    def _phase(self, stack:list) -> str:
+        files = [filename for _, filename, _ in stack]
+        if any(filename.endswith(self.TOOL_FILES) for filename in files):
+            return "tool_execution"
+        if any(self._is_model_file(filename) for filename in files):
+            return "model_wait"
+        if any(f"{os.sep}{module}{os.sep}" in filename or filename.endswith(module) for filename in files
+               for module in self.SERIALIZATION_MODULES):
+            return "serialization"
+        idle = stack and stack[-1][0] in ("select", "poll", "_run_once")
+        if (idle and self.discord_inflight > 0) or \
+                any(f"{os.sep}discord{os.sep}" in filename or f"{os.sep}aiohttp{os.sep}" in filename for filename in files):
+            return "discord_io"
+        return "idle" if idle else "other"
+
+    @staticmethod
+    def _frame_label(frame:tuple) -> str:
+        name, filename, lineno = frame
+        return f"{name} ({os.path.basename(filename)}:{lineno})"
+
+    def collapsed_stacks(self, session:ProfileSession) -> str:
+        lines = []
+        for stack, count in session.stacks.most_common():
+            lines.append(";".join([stack[0]] + [self._frame_label(frame) for frame in stack[1:]]) + f" {count}")
+        return "\n".join(lines) + "\n"
+
+    def top_functions(self, session:ProfileSession, limit:int=25) -> str:
+        total = sum(session.stacks.values()) or 1
+        phases, own, inclusive = Counter(), Counter(), Counter()
+        for stack, count in session.stacks.items():
+            phases[stack[0]] += count
+            if len(stack) > 1:
+                own[stack[-1]] += count
+            for frame in set(stack[1:]):
+                inclusive[frame] += count
+
+        lines = [f"Profiled {session.turns} turn(s), wall time {session.wall_time:.2f}s, "
+                 f"{total} samples every {self.interval * 1000:.0f}ms", "", "Phase breakdown:"]
+        for phase, count in phases.most_common():
+            lines.append(f"  {phase:<16} {count * self.interval:8.3f}s {count / total:6.1%}")
+        lines += ["", f"{'self':>8} {'total':>8}  function"]
+        for frame, count in own.most_common(limit):
+            lines.append(f"{count * self.interval:7.3f}s {inclusive[frame] * self.interval:7.3f}s  {self._frame_label(frame)}")
+        return "\n".join(lines) + "\n"
+
+    async def send_report(self, channel, session:ProfileSession) -> None:
+        try:
+            summary = self.top_functions(session)
+            await channel.send(file=discord.File(StringIO(summary), filename="profile_top.txt"))
+            await channel.send(file=discord.File(StringIO(self.collapsed_stacks(session)), filename="profile_collapsed.txt"))
+        except Exception as e:
+            print(f"Failed to send profile report: {e}")
@@ -0,0 +1,210 @@
+import re
+import json
+import html
+
+class XMLStreamParser(object):
+    """
+    Incremental, tolerant parser for the <root><thought><answer><function_call> protocol
+    used by the vision channel.
+
+    Chunks of the completion are passed in with feed(), which returns a list of
+    (event, value) tuples as soon as they can be decided:
+    - ("thought", str): the <thought> node has been closed.
+    - ("answer_delta", str): new text of the <answer> node, emitted while it is still streaming.
+    - ("answer", str): the <answer> node has been closed.
+    - ("function_call", dict): the <function_call> node has been closed and parsed.
+    Missing closing tags, a <response> node used instead of <answer>, code fences and
+    plain text with no xml at all are recovered from in close().
+    """
+    TAGS:frozenset = frozenset(["thought", "answer", "function_call"])
+    # Elements whose payload may quote other tags, only their own closing tag ends them
+    VERBATIM_TAGS:frozenset = frozenset(["answer", "function_call"])
+    ALIASES:dict = {"response": "answer"}
+    _open_tag = re.compile(r"<\s*([A-Za-z_]+)\s*/?\s*>")
+
+    def __init__(self):
+        self._buffer:str = ""
+        self._pos:int = 0
+        self._current:str = None
+        self._content_start:int = 0
+        # Where the search for the current element's closing tag resumes
+        self._scan:int = 0
+        self._emitted:int = 0
+        self._seen_tag:bool = False
+        self.values:dict = {"thought": None, "answer": None, "function_call": None}
+        self.errors:list = []
+
+    def feed(self, chunk:str) -> list:
+        if not chunk:
+            return []
+        self._buffer += chunk
+        return self._advance(final=False)
+
+    def close(self) -> list:
+        events = self._advance(final=True)
+        if self._current is not None:
+            # Generation ended inside an element, keep whatever arrived.
+            events += self._finish(self._current, self._buffer[self._content_start:])
+            self._current = None
+        if not self._seen_tag and self.values["answer"] is None:
+            # No xml at all, the model answered in plain text.
+            text = self._strip_fence(self._buffer).strip()
+            if text:
+                self.values["answer"] = text
+                events.append(("answer", text))
+        return events
+
+    def result(self) -> dict:
+        error = "; ".join(self.errors) if self.errors else None
+        return {"thought": self.values["thought"], "answer": self.values["answer"],
+                "function_call": self.values["function_call"], "Error": error}
+
+    def _canonical(self, name:str) -> str:
+        name = name.lower()
+        return self.ALIASES.get(name, name)
+
+    def _advance(self, final:bool) -> list:
+        events = []
+        while True:
+            if self._current is None:
+                match = self._open_tag.search(self._buffer, self._pos)
+                if match is None:
+                    # Keep a possibly incomplete tag at the end of the buffer for the next chunk.
+                    tail = self._buffer.rfind("<", self._pos)
+                    self._pos = tail if tail != -1 and not final else len(self._buffer)
+                    break
+                self._pos = match.end()
+                name = self._canonical(match.group(1))
+                if name == "root":
+                    self._seen_tag = True
+                if name not in self.TAGS:
+                    continue
+                self._seen_tag = True
+                if match.group(0).rstrip(">").rstrip().endswith("/"):
+                    # Self closing node such as <function_call/>
+                    continue
+                self._current = name
+                self._content_start = self._emitted = self._scan = self._pos
+            else:
+                end, resume = self._find_end(self._current, final)
+                if end is None:
+                    if self._current == "answer":
+                        events += self._answer_delta(len(self._buffer) if final else self._safe_end())
+                    break
+                if self._current == "answer":
+                    events += self._answer_delta(end)
+                events += self._finish(self._current, self._buffer[self._content_start:end])
+                self._current = None
+                self._pos = resume
+        return events
+
+    def _find_end(self, name:str, final:bool) -> tuple:
+        """
+        Find where the current element ends: at its closing tag or </root>. A missing
+        </thought> is also tolerated when the next known element starts, which is only
+        decided at </root> or the end of the stream since a thought may quote a tag.
+        """
+        names = [name] + [alias for alias, target in self.ALIASES.items() if target == name]
+        close = re.compile(r"<\s*/\s*(?:%s|root)\s*>" % "|".join(names), re.IGNORECASE)
+        match = close.search(self._buffer, self._scan)
+        if match is not None:
+            best = (match.start(), match.end())
+        else:
+            best = (None, None)
+            # Only a tag cut at the end of the buffer can still complete, the next chunk resumes from it
+            tail = self._buffer.rfind("<", self._scan)
+            self._scan = tail if tail != -1 else len(self._buffer)
+        if name in self.VERBATIM_TAGS or (best[0] is None and not final) or \
+                (best[0] is not None and not self._is_root_close(best)):
+            return self._root_end(best)
+        end = best[0] if best[0] is not None else len(self._buffer)
+        for other in self._open_tag.finditer(self._buffer, self._content_start, end):
+            other_name = self._canonical(other.group(1))
+            if other_name in self.TAGS and other_name != name:
+                return other.start(), other.start()
+        return self._root_end(best)
+
+    def _is_root_close(self, best:tuple) -> bool:
+        return re.sub(r"\s", "", self._buffer[best[0]:best[1]]).lower() == "</root>"
+
+    def _root_end(self, best:tuple) -> tuple:
+        # </root> ends the element but is left for the outer loop
+        if best[0] is not None and self._is_root_close(best):
+            return best[0], best[0]
+        return best
+
+    def _safe_end(self) -> int:
+        """
+        Position up to which the current element can be emitted without cutting a
+        tag or an entity in half.
+        """
+        end = len(self._buffer)
+        for marker, terminator in (("<", ">"), ("&", ";")):
+            idx = self._buffer.rfind(marker, self._emitted)
+            if idx != -1 and terminator not in self._buffer[idx:]:
+                end = min(end, idx)
+        return end
+
+    def _answer_delta(self, end:int) -> list:
+        if end <= self._emitted:
+            return []
+        text = self._buffer[self._emitted:end]
+        if self._emitted == self._content_start:
+            text = text.lstrip()
+        self._emitted = end
+        return [("answer_delta", html.unescape(text))] if text else []
+
+    def _finish(self, name:str, raw:str) -> list:
+        text = html.unescape(raw).strip()
+        if text.startswith("<![CDATA[") and text.endswith("]]>"):
+            text = text[9:-3].strip()
+        if text == "":
+            return []
+        if name == "function_call":
+            call = self._parse_function_call(text)
+            if call is None:
+                return []
+            self.values[name] = call
+            return [(name, call)]
+        self.values[name] = text
+        return [(name, text)]
+
+    def _parse_function_call(self, text:str) -> dict:
+        text = self._strip_fence(text)
+        try:
+            call = json.loads(text)
+        except json.JSONDecodeError:
+            # Recover the outermost json object if the model wrapped it with extra text.
+            start, end = text.find("{"), text.rfind("}")
+            try:
+                call = json.loads(text[start:end + 1]) if start != -1 and end > start else None
+            except json.JSONDecodeError as e:
+                call = None
+                self.errors.append(f"Error: invalid function_call json: {e}")
+        if not isinstance(call, dict) or "name" not in call:
+            if call is not None:
+                self.errors.append("Error: function_call is missing a name")
+            return None
+        if "argument" not in call:
+            call["argument"] = call.pop("arguments", {})
+        if isinstance(call["argument"], str):
+            try:
+                call["argument"] = json.loads(call["argument"])
+            except json.JSONDecodeError:
+                pass
+        return call
+
+    @staticmethod
+    def _strip_fence(text:str) -> str:
+        match = re.search(r"```(?:xml|json)?\s*\n?([\s\S]*?)(?:\n?```|$)", text)
+        return match.group(1) if match else text
+
+
+def parse_xml_response(text:str) -> dict:
+    """
+    Parse a complete response in one go with the same tolerance as the streaming parser.
+    """
+    parser = XMLStreamParser()
+    parser.feed(text)
+    parser.close()
+    return parser.result()
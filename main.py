@@ -1,30 +1,61 @@
 import discord
 from discord.ext import commands
 import asyncio
+import argparse
 from dotenv import load_dotenv
 import os
 import tracemalloc
+from Scripts.utilities.memory_profile import collect_required_intents, build_client_options
 
 if __name__ == "__main__":
-
-    tracemalloc.start()
     # Set env
     load_dotenv()
+
+    parser = argparse.ArgumentParser()
+    # single: one process does everything. gateway: discord connection only, chatbot runs in worker processes.
+    parser.add_argument('--mode', choices=['single', 'gateway', 'worker'], default=os.getenv('BOT_MODE') or 'single')
+    parser.add_argument('--workers', type=int, default=int(os.getenv('BOT_WORKERS') or os.cpu_count() or 1))
+    parser.add_argument('--worker-id', type=int, default=0)
+    parser.add_argument('--socket', default=None)
+    # lean: only the intents the cogs declare, no member cache, small message cache
+    parser.add_argument('--profile', choices=['full', 'lean'], default=os.getenv('BOT_PROFILE') or 'full')
+    parser.add_argument('--tracemalloc', action='store_true', default=bool(os.getenv('BOT_TRACEMALLOC')))
+    args = parser.parse_args()
+
+    if args.mode == 'worker':
+        from Scripts.utilities.gateway import run_worker, DEFAULT_SOCKET_PATH
+        asyncio.run(run_worker(args.worker_id, args.socket or DEFAULT_SOCKET_PATH))
+        raise SystemExit(0)
+
+    if args.tracemalloc:
+        tracemalloc.start()
     bot_token = os.getenv("DISCORD_TOKEN")
 
-    intents = discord.Intents.all()
-    intents.message_content = True
+    cog_modules = [f'Scripts.Cogs.{filename[:-3]}' for filename in sorted(os.listdir(os.path.join(os.getcwd(), 'Scripts', 'Cogs')))
+                   if filename.endswith('.py') and filename != '__init__.py'
+                   and not (args.mode == 'gateway' and filename == 'chatbot.py')]  # The chatbot runs in the worker processes
 
-    bot = commands.Bot(command_prefix='.', intents=intents, application_id=int(os.getenv('APPLICATION_ID')))
+    extra_cogs = []
+    if args.mode == 'gateway':
+        from Scripts.utilities.gateway import GatewayServer, GatewayForwarder, DEFAULT_SOCKET_PATH
+        extra_cogs.append(GatewayForwarder)
+
+    required_intents = collect_required_intents(cog_modules, extra_cogs) if args.profile == 'lean' else None
+    client_options = build_client_options(args.profile, required_intents)
+
+    bot = commands.Bot(command_prefix='.', application_id=int(os.getenv('APPLICATION_ID')), **client_options)
     @bot.event
     async def on_ready():
         print('Online.')
 
     async def load():
-        for filename in os.listdir(os.path.join(os.getcwd(), 'Scripts', 'Cogs')):
-            if filename.endswith('.py') and filename != '__init__.py':
-                await bot.load_extension(f'Scripts.Cogs.{filename[:-3]}')
-                
+        for module_name in cog_modules:
+            await bot.load_extension(module_name)
+        if args.mode == 'gateway':
+            server = GatewayServer(bot, args.workers, args.socket or DEFAULT_SOCKET_PATH)
+            forwarder = GatewayForwarder(bot, server)
+            await bot.add_cog(forwarder, guilds=[discord.Object(id=guild_id) for guild_id in sorted(forwarder.channel_routes.guild_ids)])
+
     async def main():
         await load()
         await bot.start(bot_token)
@@ -0,0 +1,101 @@
+import os
+import json
+import time
+import shutil
+
+import pytest
+import requests
+
+from Scripts.utilities.corp_code_resolver import CorpCodeResolver, normalize_corp_name
+
+FIXTURE = os.path.join(os.path.dirname(__file__), "data", "CORPCODE.xml")
+
+
+@pytest.fixture
+def resolver(tmp_path) -> CorpCodeResolver:
+    return CorpCodeResolver.build(FIXTURE, str(tmp_path / "index"))
+
+
+def test_normalize_drops_legal_forms_spacing_and_case():
+    assert normalize_corp_name("주식회사 삼성전자") == "삼성전자"
+    assert normalize_corp_name("(주)삼성 전자") == "삼성전자"
+    assert normalize_corp_name("SAMSUNG ELECTRONICS CO,.LTD") == normalize_corp_name("Samsung Electronics Co., Ltd.")
+
+
+def test_exact_name(resolver):
+    result = resolver.resolve("삼성전자")
+    assert result["corp_code"] == "00126380"
+    assert result["stock_code"] == "005930"
+    assert result["match"] == "exact"
+
+
+@pytest.mark.parametrize("query, corp_code", [
+    ("주식회사 삼성전자", "00126380"),
+    ("(주)삼성전자", "00126380"),
+    ("㈜ 삼성 전자", "00126380"),
+    ("Samsung Electronics Co., Ltd.", "00126380"),
+    ("sk hynix", "00164779"),
+    ("카카오뱅크", "01133217"),
+])
+def test_normalized_name(resolver, query, corp_code):
+    result = resolver.resolve(query)
+    assert result["corp_code"] == corp_code
+    assert result["match"] == "normalized"
+
+
+def test_prefix_ranks_listed_companies_first(resolver):
+    candidates = resolver.search("삼성", limit=10)
+    assert {candidate["match"] for candidate in candidates} == {"prefix"}
+    assert {candidate["corp_code"] for candidate in candidates} == {"00126380", "00126371", "00149655", "00258999"}
+    # The unlisted company comes last
+    assert candidates[-1]["corp_code"] == "00258999"
+    assert candidates[-1]["stock_code"] is None
+
+
+def test_fuzzy_name(resolver):
+    result = resolver.resolve("삼송전자")
+    assert result["corp_code"] == "00126380"
+    assert result["match"] == "fuzzy"
+    assert 0.6 <= result["score"] < 1.0
+
+
+def test_unknown_or_empty_name(resolver):
+    assert resolver.resolve("없는회사") is None
+    assert resolver.search("(주)") == []
+
+
+def test_load_or_build_refreshes_an_old_dump(tmp_path, monkeypatch):
+    index_dir = str(tmp_path / "index")
+    downloads = []
+
+    def download_dump(cls, api_key, path):
+        downloads.append(path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(FIXTURE, path)
+        return path
+
+    monkeypatch.setattr(CorpCodeResolver, "download_dump", classmethod(download_dump))
+    CorpCodeResolver.load_or_build("key", index_dir, max_age=3600)
+    assert len(downloads) == 1
+    # A recent dump is reused
+    CorpCodeResolver.load_or_build("key", index_dir, max_age=3600)
+    assert len(downloads) == 1
+    # An old one is downloaded and built again
+    meta_path = os.path.join(index_dir, "meta.json")
+    with open(meta_path, 'r', encoding='utf-8') as f:
+        meta = json.load(f)
+    meta["source_mtime"] = time.time() - 2 * 3600
+    with open(meta_path, 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    resolver = CorpCodeResolver.load_or_build("key", index_dir, max_age=3600)
+    assert len(downloads) == 2
+    assert resolver.resolve("삼성전자")["corp_code"] == "00126380"
+
+
+def test_load_or_build_keeps_the_index_when_refresh_fails(resolver, monkeypatch):
+    def download_dump(cls, api_key, path):
+        raise requests.ConnectionError("DART is down")
+
+    monkeypatch.setattr(CorpCodeResolver, "download_dump", classmethod(download_dump))
+    reopened = CorpCodeResolver.load_or_build("key", resolver.index_dir, max_age=0)
+    assert reopened.resolve("LG전자")["corp_code"] == "00401731"
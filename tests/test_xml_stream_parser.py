@@ -0,0 +1,53 @@
+import json
+
+from Scripts.utilities.xml_stream_parser import XMLStreamParser, parse_xml_response
+
+
+def stream(text:str, size:int=3) -> tuple:
+    parser = XMLStreamParser()
+    events = []
+    for i in range(0, len(text), size):
+        events += parser.feed(text[i:i + size])
+    events += parser.close()
+    return parser.result(), events
+
+
+def test_function_call_with_tag_in_code():
+    call = {"name": "execute_python_code", "argument": {"code_str": "print('<answer>')"}}
+    text = f"<root><thought>Run it</thought><function_call>{json.dumps(call)}</function_call></root>"
+    for result in (parse_xml_response(text), stream(text)[0]):
+        assert result["function_call"] == call
+        assert result["answer"] is None
+        assert result["thought"] == "Run it"
+
+
+def test_answer_quoting_other_tags():
+    text = "<root><thought>t</thought><answer>The tag <thought> is <function_call> here</answer></root>"
+    result, events = stream(text)
+    assert result["answer"] == "The tag <thought> is <function_call> here"
+    assert result["function_call"] is None
+    assert "".join(value for event, value in events if event == "answer_delta") == result["answer"]
+
+
+def test_answer_closed_by_root_or_end_of_stream():
+    assert parse_xml_response("<root><answer>Hi <b></root>")["answer"] == "Hi <b>"
+    assert parse_xml_response("<root><answer>Hi there")["answer"] == "Hi there"
+    assert parse_xml_response("<root><response>Alias</response></root>")["answer"] == "Alias"
+
+
+def test_unclosed_thought_still_ends_at_next_element():
+    result = parse_xml_response("<root><thought>thinking<answer>Done</answer></root>")
+    assert result["thought"] == "thinking"
+    assert result["answer"] == "Done"
+
+
+def test_thought_quoting_function_call():
+    text = "<root><thought>I will use <function_call></thought><answer>hi</answer></root>"
+    for result in (parse_xml_response(text), stream(text)[0]):
+        assert result["thought"] == "I will use <function_call>"
+        assert result["answer"] == "hi"
+        assert result["function_call"] is None
+
+
+def test_plain_text_answer():
+    assert parse_xml_response("Just text")["answer"] == "Just text"